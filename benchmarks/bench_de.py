@@ -0,0 +1,51 @@
+"""
+Latency of differential expression between two groups of cells, against scanpy
+
+Usage:
+    python benchmarks/bench_de.py --n-cell 200000 --n-gene 2000 --n-jobs 4
+"""
+import argparse
+import os
+import tempfile
+import numpy as np
+from walnut.expression import Expression
+from walnut.models import FAST_PROFILE
+from walnut.de import differential_expression
+from bench_write_profile import make_counts, timeit
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n-cell", type=int, default=50000)
+    parser.add_argument("--n-gene", type=int, default=2000)
+    parser.add_argument("--density", type=float, default=0.05)
+    parser.add_argument("--n-jobs", type=int, default=4)
+    parser.add_argument("--scanpy", action="store_true", help="also time scanpy.tl.rank_genes_groups")
+    args = parser.parse_args()
+
+    raw = make_counts(args.n_gene, args.n_cell, args.density).astype("int32")
+    h5path = os.path.join(tempfile.mkdtemp(), "matrix.hdf5")
+    writer = Expression(h5path)
+    writer.add_expression_data(raw_matrix=raw, barcodes=["cell_%d" % i for i in range(args.n_cell)],
+                               features=["gene_%d" % i for i in range(args.n_gene)])
+    writer.write(profile=FAST_PROFILE)
+
+    labels = np.random.default_rng(2).integers(0, 2, args.n_cell)
+    expression = Expression(h5path)
+    print("%-20s %10s" % ("method", "best s"))
+    for method in ["wilcoxon", "t-test"]:
+        for n_jobs in sorted({1, args.n_jobs}):
+            best = timeit(lambda: differential_expression(expression, labels, method=method, n_jobs=n_jobs))
+            print("%-20s %10.2f" % ("%s/%d" % (method, n_jobs), best))
+
+    if args.scanpy:
+        import scanpy as sc
+        adata = sc.AnnData(expression.norm_matrix.T.tocsr())
+        sc.pp.log1p(adata, base=2)
+        adata.obs["group"] = labels.astype(str)
+        for method in ["wilcoxon", "t-test"]:
+            best = timeit(lambda: sc.tl.rank_genes_groups(adata, "group", groups=["0"], reference="1",
+                                                          method=method), repeat=1)
+            print("%-20s %10.2f" % ("scanpy/%s" % method, best))
+
+if __name__ == "__main__":
+    main()
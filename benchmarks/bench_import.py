@@ -0,0 +1,44 @@
+"""
+Import time of walnut entry points, each measured in a fresh interpreter
+
+Fails when a module meant to be imported lazily (scanpy, anndata) is pulled in.
+
+Usage:
+    python benchmarks/bench_import.py --repeat 5
+"""
+import argparse
+import subprocess
+import sys
+
+MODULES = ["walnut.expression", "walnut.study"]
+LAZY = ["scanpy", "anndata"]
+
+CODE = """
+import sys, time
+start = time.perf_counter()
+import %s
+print(time.perf_counter() - start)
+print(",".join(m for m in %r if m in sys.modules))
+"""
+
+def measure(module: str):
+    out = subprocess.run([sys.executable, "-c", CODE % (module, LAZY)],
+                         capture_output=True, text=True, check=True).stdout.splitlines()
+    return float(out[0]), [m for m in out[1].split(",") if m]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    failed = False
+    print("%-20s %10s  %s" % ("module", "best ms", "eager heavy imports"))
+    for module in MODULES:
+        runs = [measure(module) for _ in range(args.repeat)]
+        eager = runs[0][1]
+        failed |= len(eager) > 0
+        print("%-20s %10.1f  %s" % (module, min(x for x, _ in runs) * 1000, ", ".join(eager) or "-"))
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Compare file size and read latency of matrix.hdf5 across write profiles
+
+Usage:
+    python benchmarks/bench_write_profile.py --n-cell 100000 --n-gene 20000
+"""
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+from scipy import sparse
+from walnut.expression import Expression
+from walnut.models import WriteProfile, LEGACY_PROFILE, FAST_PROFILE, COMPACT_PROFILE
+
+PROFILES = {
+    "legacy": LEGACY_PROFILE,
+    "auto": WriteProfile(),
+    "lzf+shuffle": FAST_PROFILE,
+    "gzip4+shuffle": COMPACT_PROFILE,
+    "gzip4+shuffle/cell": WriteProfile(compression="gzip", compression_opts=4, shuffle=True, access="cell"),
+}
+
+def make_counts(n_gene: int, n_cell: int, density: float, seed: int=0) -> sparse.csc_matrix:
+    rng = np.random.default_rng(seed)
+    mtx = sparse.random(n_gene, n_cell, density=density, format="csc", random_state=rng,
+                        data_rvs=lambda n: rng.poisson(2, n) + 1)
+    return mtx.astype("float64")
+
+def timeit(fn, repeat: int=3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n-cell", type=int, default=20000)
+    parser.add_argument("--n-gene", type=int, default=10000)
+    parser.add_argument("--density", type=float, default=0.05)
+    parser.add_argument("--n-query", type=int, default=20, help="genes per gene-wise query")
+    args = parser.parse_args()
+
+    raw = make_counts(args.n_gene, args.n_cell, args.density)
+    barcodes = ["cell_%d" % i for i in range(args.n_cell)]
+    features = ["gene_%d" % i for i in range(args.n_gene)]
+    rng = np.random.default_rng(1)
+    genes = list(rng.choice(features, args.n_query, replace=False))
+    cells = np.sort(rng.choice(args.n_cell, args.n_cell // 50, replace=False))
+
+    out_dir = tempfile.mkdtemp()
+    print("%-20s %10s %10s %10s %10s %10s" % ("profile", "size MB", "write s", "full s", "genes ms", "cells ms"))
+    for name, profile in PROFILES.items():
+        h5path = os.path.join(out_dir, "%s.hdf5" % name.replace("/", "_"))
+        writer = Expression(h5path)
+        writer.add_expression_data(raw_matrix=raw, barcodes=barcodes, features=features)
+        start = time.perf_counter()
+        writer.write(profile=profile)
+        write_time = time.perf_counter() - start
+
+        full = timeit(lambda: Expression(h5path, cache=False).raw_matrix, repeat=1)
+        expression = Expression(h5path, cache=False)
+        gene_time = timeit(lambda: expression.get_genes(genes))
+        cell_time = timeit(lambda: expression.get_cells(cells))
+        expression.close()
+
+        print("%-20s %10.1f %10.2f %10.2f %10.1f %10.1f" % (name, os.path.getsize(h5path) / 2**20,
+                                                          write_time, full, gene_time * 1000, cell_time * 1000))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Fake expression data and study setup shared by the tests
+"""
+from walnut.expression import Expression
+from walnut.study import Study
+from walnut.gene_db import GeneDB
+from walnut.models import LEGACY_PROFILE
+from walnut import common
+import os
+import scanpy as sc
+import json
+import numpy as np
+import scipy.sparse as sparse
+
+
+# Generating fake data
+
+n_gene = 2000
+n_cell = 1000
+data = sparse.random(n_cell, n_gene, density=.2, format="csr",
+                 data_rvs=np.ones,   # fill with ones
+                 dtype="f"           # use float32 first
+                 ).astype("int8")    # then convert to int8
+
+gene_db = GeneDB(os.path.join(common.get_pkg_data(), "db"), "human")
+gene_db.read()
+df = gene_db.to_df()
+
+adata = sc.AnnData(data, dtype=data.dtype)
+gene_ids = df["gene_id"][0:n_gene]
+
+
+adata.var_names = gene_ids
+
+barcodes = adata.obs_names.tolist()
+features = adata.var_names.tolist()
+
+
+def write_expression(path, raw_matrix=None, cells=None, profile=LEGACY_PROFILE, **kwargs) -> Expression:
+    """
+    Write `raw_matrix` (the fake data by default) to `path`, keeping the
+    barcodes of `cells` (all by default). Returns the writer
+    """
+    raw_matrix = adata.X.T if raw_matrix is None else raw_matrix
+    cell_barcodes = barcodes if cells is None else barcodes[cells]
+    expression = Expression(path)
+    expression.add_expression_data(raw_matrix=raw_matrix, barcodes=cell_barcodes, features=features)
+    assert expression.write(profile=profile, **kwargs)
+    return expression
+
+def make_study(study_path, raw_matrix=None, cells=None, profile=LEGACY_PROFILE, **run_info) -> Study:
+    """
+    New study of `raw_matrix` (the fake data by default) in `study_path`, with
+    a run_info.json holding `run_info` on top of the required fields
+    """
+    raw_matrix = adata.X.T if raw_matrix is None else raw_matrix
+    cell_barcodes = barcodes if cells is None else barcodes[cells]
+    study = Study(study_path, "human")
+    assert study.write_expression_data(raw_matrix=raw_matrix, barcodes=cell_barcodes, features=features,
+                                       profile=profile)
+    with open(os.path.join(study_path, "run_info.json"), "w") as fopen:
+        json.dump({"hash_id": "test", "title": "test", "n_cell": len(cell_barcodes), "species": "human",
+                   **run_info}, fopen)
+    return Study(study_path)
+
+def add_subcluster(study_path, cells, subcluster_id="abc") -> str:
+    """ Subcluster of the root cluster selecting `cells` """
+    cells = [int(i) for i in cells]
+    os.makedirs(os.path.join(study_path, "sub", subcluster_id))
+    with open(os.path.join(study_path, "sub", subcluster_id, "cluster_info.json"), "w") as fopen:
+        json.dump({"id": subcluster_id, "name": "test", "history": [common.create_history().dict()],
+                   "length": len(cells), "version": 2, "parent_id": "root", "selectedArr": cells}, fopen)
+    return subcluster_id
@@ -0,0 +1,46 @@
+from helpers import n_gene, n_cell, adata, features, make_study, add_subcluster
+import tempfile
+import numpy as np
+import scipy.sparse as sparse
+
+
+def test_coexpression():
+    from scipy import stats
+    from walnut.coexpression import correlate, top_partners
+
+    raw = adata.X.T.toarray()
+    raw[1] = raw[0] * 2 + raw[2] # Correlated with genes 0 and 2
+    study_path = tempfile.mkdtemp()
+    study = make_study(study_path, sparse.csc_matrix(raw, dtype="int8"))
+    values = np.log2(study.expression.norm_matrix.toarray().astype("float64") + 1)
+    cells = np.arange(0, n_cell, 2)
+
+    for method, n_jobs in [("pearson", 1), ("spearman", 2)]:
+        corr = correlate(study.expression, features[:3], method=method, cells=cells, chunk_size=50000, n_jobs=n_jobs)
+        assert corr.shape == (3, n_gene)
+        subset = values[:, cells]
+        expected = np.corrcoef(subset)[:3] if method == "pearson" else stats.spearmanr(subset.T).correlation[:3]
+        assert np.allclose(corr, expected, atol=1e-6)
+
+    # Means and norms of untransformed values from the gene statistics
+    assert study.expression.has_gene_stats("norm")
+    calls = []
+    get_gene_stats = study.expression.get_gene_stats
+    study.expression.get_gene_stats = lambda unit: calls.append(unit) or get_gene_stats(unit)
+    norm = study.expression.norm_matrix.toarray().astype("float64")
+    corr = correlate(study.expression, features[:3], transform="none", chunk_size=50000, n_jobs=2)
+    assert calls == ["norm"] and np.allclose(corr, np.corrcoef(norm)[:3], atol=1e-6)
+    corr = correlate(study.expression, features[:3], transform="none", cells=cells)
+    assert calls == ["norm"] and np.allclose(corr, np.corrcoef(norm[:, cells])[:3], atol=1e-6)
+    study.expression.get_gene_stats = get_gene_stats
+
+    partners = top_partners(study.expression, [features[1], features[7]], top_k=5)
+    assert len(partners) == 10 and set(partners[partners["query"] == features[1]]["gene"][:2]) == set(features[:3:2])
+    assert features[1] not in partners[partners["query"] == features[1]]["gene"].tolist()
+    assert (np.diff(partners["correlation"][:5]) <= 0).all()
+
+    add_subcluster(study_path, cells)
+    panel = study.correlate_genes(features[:3], subcluster_id="abc")
+    assert np.allclose(panel.values, np.corrcoef(values[:3, cells]), atol=1e-6)
+    top = study.top_correlated_genes(features[:2], top_k=3, method="spearman")
+    assert top["query"].tolist() == [features[0]] * 3 + [features[1]] * 3
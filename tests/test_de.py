@@ -0,0 +1,76 @@
+from walnut.expression import Expression
+from helpers import n_cell, adata, features, write_expression, make_study
+import os
+import tempfile
+import numpy as np
+import scipy.sparse as sparse
+
+
+def test_differential_expression():
+    from scipy import stats
+    from walnut.de import differential_expression, fdr_bh
+
+    raw = adata.X.T.toarray()
+    raw[:, :100] = raw[:, :100] * 3
+    raw[5, 200:] = 0 # Only expressed in group 0
+    expression = Expression(write_expression(os.path.join(tempfile.mkdtemp(), "matrix.hdf5"),
+                                             sparse.csc_matrix(raw, dtype="int8")).path)
+
+    labels = np.full(n_cell, 2)
+    labels[:400], labels[500:] = 0, 1
+    norm = expression.norm_matrix.toarray().astype("float64")
+    values = np.log2(norm + 1)
+    x, y = values[:, :400], values[:, 500:]
+    for method, n_jobs in [("wilcoxon", 1), ("t-test", 2)]:
+        df = differential_expression(expression, labels, method=method, chunk_size=10000, n_jobs=n_jobs)
+        assert df.index.tolist() == features
+        for i in [0, 5, 7, 1999]:
+            if method == "wilcoxon":
+                expected = stats.mannwhitneyu(x[i], y[i], use_continuity=False, method="asymptotic").pvalue
+            else:
+                expected = stats.ttest_ind(x[i], y[i], equal_var=False).pvalue
+            assert np.isclose(df["p_value"].iloc[i], expected, rtol=1e-6)
+        assert np.allclose(df["fdr"], fdr_bh(df["p_value"]))
+        assert np.allclose(df["pct_1"], (x != 0).mean(axis=1))
+        assert np.isclose(df["logFC"].iloc[0], np.log2(norm[0, :400].mean() / norm[0, 500:].mean()))
+
+    assert df["p_value"].iloc[5] < 1e-6 and df["logFC"].iloc[5] > 10
+    genes = features[3:8][::-1]
+    sub = differential_expression(expression, labels, genes, method="t-test")
+    assert sub.index.tolist() == genes and np.allclose(sub["p_value"], df.loc[genes, "p_value"])
+
+    study_path = tempfile.mkdtemp()
+    study = make_study(study_path)
+    meta_id = study.metadata.add_category("cluster", np.array(["a", "b", "c"])[labels].tolist())
+    by_label = study.differential_expression("a", ["b"], meta_id=meta_id, genes=features[:50])
+    by_cells = study.differential_expression(np.arange(400), np.arange(500, n_cell), genes=features[:50], n_jobs=2)
+    assert by_label.index.tolist() == by_cells.index.tolist()
+    assert np.allclose(by_label["p_value"], by_cells["p_value"]) and (np.diff(by_label["p_value"]) >= 0).all()
+    rest = study.differential_expression("a", meta_id=meta_id, genes=features[:50])
+    assert np.allclose(rest["pct_2"].sort_index(),
+                       (adata.X[400:, :50].toarray() != 0).mean(axis=0)[np.argsort(features[:50])])
+
+def test_rank_markers():
+    from walnut.de import differential_expression, rank_markers
+
+    study_path = tempfile.mkdtemp()
+    study = make_study(study_path)
+    labels = np.arange(n_cell) % 4
+    labels[:100] = -1 # Left out
+    genes = features[:300]
+
+    for method in ["wilcoxon", "t-test"]:
+        markers = rank_markers(study.expression, labels, genes, top_n=None, method=method, chunk_size=20000)
+        assert len(markers) == 4 * len(genes)
+        for group in range(4):
+            pairs = np.where(labels == group, 0, np.where(labels >= 0, 1, -1))
+            expected = differential_expression(study.expression, pairs, genes, method=method)
+            found = markers[markers["group"] == group].set_index("gene").loc[genes]
+            for column in ["logFC", "statistic", "p_value", "fdr", "pct_1", "pct_2"]:
+                assert np.allclose(found[column], expected[column])
+            assert (np.diff(markers[markers["group"] == group]["statistic"]) <= 0).all()
+
+    meta_id = study.metadata.add_category("cluster", np.array(["a", "b", "c", "d"])[np.arange(n_cell) % 4].tolist())
+    markers = study.rank_markers(meta_id, top_n=5, genes=genes)
+    assert markers["group"].value_counts().to_dict() == {"a": 5, "b": 5, "c": 5, "d": 5}
+    assert set(markers.columns) >= {"group", "gene", "name", "logFC", "p_value", "fdr"}
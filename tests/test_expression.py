@@ -1,41 +1,15 @@
 from walnut.expression import Expression
 from walnut.study import Study
 from walnut.models import ExpressionData
-from walnut.gene_db import GeneDB
-from walnut import common
+from helpers import (n_gene, n_cell, adata, gene_ids, barcodes, features, write_expression, make_study,
+                     add_subcluster)
 import os
 import scanpy as sc
-import tarfile, tempfile
+import tempfile
 import json
-import pathlib
 import numpy as np
 import scipy.sparse as sparse
-
-
-# Generating fake data
-
-tmp_dir = tempfile.mkdtemp()
-n_gene = 2000
-n_cell = 1000
-data = sparse.random(n_cell, n_gene, density=.2, format="csr",
-                 data_rvs=np.ones,   # fill with ones
-                 dtype="f"           # use float32 first
-                 ).astype("int8")    # then convert to int8
-
-gene_db = GeneDB(os.path.join(common.get_pkg_data(), "db"), "human")
-gene_db.read()
-df = gene_db.to_df()
-
-adata = sc.AnnData(data, dtype=data.dtype)
-gene_ids = df["gene_id"][0:n_gene]
-
-
-adata.var_names = gene_ids
-
-barcodes = adata.obs_names.tolist()
-features = adata.var_names.tolist()
-
-study_path = tempfile.mkdtemp()
+import h5py
 
 
 
@@ -113,4 +87,650 @@ def test_expression_existing_study():
     assert study.expression.norm_matrix.shape == adata.X.T.shape
     assert len(study.expression.barcodes) == len(barcodes)
     assert len(study.expression.features) == len(features)
-    assert len(study.expression.feature_type) == len(features)
\ No newline at end of file
+    assert len(study.expression.feature_type) == len(features)
+
+def test_expression_cache():
+    study_path = tempfile.mkdtemp()
+    h5path = write_expression(os.path.join(study_path, "matrix.hdf5")).path
+
+    expression = Expression(h5path)
+    raw = expression.raw_matrix
+    assert expression.raw_matrix is raw
+    expression.evict("raw_matrix")
+    assert "raw_matrix" not in expression.cache_info()["keys"]
+    assert expression.raw_matrix is not raw
+
+    expression = Expression(h5path)
+    expression.read_expression_data()
+    info = expression.cache_info()
+    assert info["misses"] == 6 # raw, norm (csr and csc), barcodes, features, feature_type
+    assert info["hits"] == 4
+
+    # Touching the file invalidates everything
+    stat = os.stat(h5path)
+    os.utime(h5path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    expression = Expression(h5path)
+    features_before = expression.features
+    os.utime(h5path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10**9))
+    assert expression.features is not features_before
+    assert expression.features == features_before
+
+    uncached = Expression(h5path, cache=False)
+    assert uncached.barcodes is not uncached.barcodes
+    assert uncached.cache_info()["hits"] == 0
+    expression.close()
+    uncached.close()
+
+
+def test_get_genes():
+    study_path = tempfile.mkdtemp()
+    expression = Expression(os.path.join(study_path, "matrix.hdf5"))
+    expression.add_expression_data(raw_matrix=adata.X.T, barcodes=barcodes, features=features)
+    genes = [features[5], features[2], features[3], features[1999], features[5]]
+    in_memory = expression.get_genes(genes)
+    assert expression.write()
+
+    expression = Expression(os.path.join(study_path, "matrix.hdf5"))
+    raw = expression.raw_matrix.tocsr()
+    idx = [5, 2, 3, 1999, 5]
+    block = expression.get_genes(genes)
+    assert block.shape == (len(genes), n_cell)
+    assert (block != raw[idx, :]).nnz == 0
+    assert (in_memory != raw[idx, :]).nnz == 0
+
+    norm = expression.norm_matrix.tocsr()
+    block = expression.get_genes(genes, unit="norm")
+    assert np.allclose(block.toarray(), norm[idx, :].toarray())
+
+    assert expression.get_genes([]).shape == (0, n_cell)
+    try:
+        expression.get_genes(["NOT_A_GENE"])
+        assert 1 == 0
+    except ValueError as e:
+        print(e)
+
+
+def test_get_cells():
+    study_path = tempfile.mkdtemp()
+    study = Study(study_path, "human")
+    assert study.write_expression_data(raw_matrix=adata.X.T, barcodes=barcodes, features=features)
+
+    expression = Expression(os.path.join(study_path, "main", "matrix.hdf5"))
+    raw = expression.raw_matrix
+    norm = expression.norm_matrix
+    idx = [10, 11, 12, 500, 3, 999, 11]
+    sub = expression.get_cells(idx)
+    assert sub.shape == (n_gene, len(idx))
+    assert (sub != raw[:, idx]).nnz == 0
+    assert np.allclose(expression.get_cells(idx, unit="norm").toarray(), norm[:, idx].toarray())
+
+    # Subcluster reads go through get_cells
+    add_subcluster(study_path, [3, 5, 7])
+    sub = study.get_expression("abc", type="norm")
+    assert np.allclose(sub.toarray(), norm[:, [3, 5, 7]].toarray())
+    assert study.get_expression().shape == raw.shape
+
+
+def test_backed_expression():
+    study_path = tempfile.mkdtemp()
+    h5path = write_expression(os.path.join(study_path, "matrix.hdf5")).path
+
+    in_memory = Expression(h5path)
+    expression = Expression(h5path, backed=True)
+    for backed, mtx in [(expression.raw_matrix, in_memory.raw_matrix),
+                        (expression.norm_matrix, in_memory.norm_matrix)]:
+        assert backed.shape == mtx.shape
+        assert backed.nnz == mtx.nnz
+        assert np.allclose(backed[:, 10:20].toarray(), mtx[:, 10:20].toarray())
+        assert np.allclose(backed[[5, 1, 5], :].toarray(), mtx[[5, 1, 5], :].toarray())
+        assert np.allclose(backed[2:50, [7, 3]].toarray(), mtx[2:50, [7, 3]].toarray())
+        assert np.allclose(backed.sum(axis=0), mtx.sum(axis=0))
+        assert np.allclose(backed.sum(axis=1), mtx.sum(axis=1))
+        assert np.isclose(backed.sum(), mtx.sum())
+
+        n_major = backed.shape[1] if backed.format_str == "csc" else backed.shape[0]
+        covered = 0
+        for start, end, block in backed.chunks(chunk_size=10000):
+            assert start == covered
+            covered = end
+        assert covered == n_major
+    expression.close()
+
+
+def test_norm_matrix_orientation():
+    study_path = tempfile.mkdtemp()
+    h5path = os.path.join(study_path, "matrix.hdf5")
+    writer = Expression(h5path)
+    writer.add_expression_data(raw_matrix=adata.X.T, barcodes=barcodes, features=features)
+    assert sparse.isspmatrix_csr(writer.norm_matrix) # Same orientation before and after writing
+    assert sparse.isspmatrix_csc(writer.get_norm_matrix("csc"))
+    assert writer.norm_matrix is writer.norm_matrix # Converted once
+    assert np.allclose(writer.get_genes(features[:3]).toarray(), adata.X.T[:3].toarray())
+    writer.add_expression_data(raw_matrix=adata.X.T * 2, barcodes=barcodes, features=features)
+    assert np.allclose(writer.get_genes(features[:3]).toarray(), adata.X.T[:3].toarray() * 2) # Not the old copy
+    writer.add_expression_data(raw_matrix=adata.X.T, barcodes=barcodes, features=features)
+    expected = writer.norm_matrix.toarray()
+    assert writer.write()
+
+    expression = Expression(h5path)
+    norm = expression.norm_matrix
+    assert sparse.isspmatrix_csr(norm)
+    assert norm.shape == (n_gene, n_cell)
+    assert np.allclose(norm.toarray(), expected)
+
+    norm_csc = expression.get_norm_matrix("csc")
+    assert sparse.isspmatrix_csc(norm_csc)
+    assert expression.get_norm_matrix("csc") is norm_csc
+    assert np.allclose(norm_csc.toarray(), expected)
+
+
+def test_write_blocks():
+    study_path = tempfile.mkdtemp()
+    reference = write_expression(os.path.join(study_path, "reference.hdf5"))
+
+    raw = adata.X.T.tocsc()
+    blocks = [(raw[:, i:i + 300], barcodes[i:i + 300]) for i in range(0, n_cell, 300)]
+    expression = Expression(os.path.join(study_path, "matrix.hdf5"))
+    assert expression.write_blocks(iter(blocks), features, chunk_size=5000)
+    assert not os.path.exists(expression.path + ".tmp")
+    assert not expression.write_blocks(iter(blocks), features)
+
+    assert expression.barcodes == reference.barcodes
+    assert expression.features == reference.features
+    assert expression.feature_type == reference.feature_type
+    assert (expression.raw_matrix != reference.raw_matrix).nnz == 0
+    assert np.allclose(expression.norm_matrix.toarray(), reference.norm_matrix.toarray())
+    assert (expression.get_genes(features[:50]) != reference.get_genes(features[:50])).nnz == 0
+    with h5py.File(expression.path, "r") as fopen, h5py.File(reference.path, "r") as fref:
+        for key in ["raw", "log", "lognorm"]:
+            assert np.allclose(fopen["colsum"][key][:], fref["colsum"][key][:])
+        for key in ["countsT", "normalizedT"]:
+            assert list(fopen[key]["shape"][:]) == list(fref[key]["shape"][:])
+            assert np.array_equal(fopen[key]["indptr"][:], fref[key]["indptr"][:])
+
+    study = Study(tempfile.mkdtemp(), "human")
+    assert study.write_expression_blocks(iter(blocks), features)
+    assert study.expression.barcodes == barcodes
+
+    # Duplicated barcodes across blocks are rejected and nothing is left behind
+    h5path = os.path.join(study_path, "duplicated.hdf5")
+    try:
+        Expression(h5path).write_blocks([blocks[0], blocks[0]], features)
+        assert 1 == 0
+    except ValueError as e:
+        print(e)
+    assert not os.path.exists(h5path)
+    assert not os.path.exists(h5path + ".tmp")
+
+
+def test_write_profile():
+    from walnut.models import WriteProfile, COMPACT_PROFILE
+    from walnut.expression import tune_chunk_size
+
+    # Gene slices of countsT get small chunks, the cell-major group large ones
+    assert tune_chunk_size(10**8, 30000, 4, sliced=True) < tune_chunk_size(10**8, 10**6, 4, sliced=False)
+    assert tune_chunk_size(10, 5, 4, sliced=True) == 10
+
+    try:
+        WriteProfile(compression="lzf", compression_opts=4)
+        assert 1 == 0
+    except ValueError as e:
+        print(e)
+
+    study_path = tempfile.mkdtemp()
+    reference = write_expression(os.path.join(study_path, "reference.hdf5"))
+
+    for name, profile in [("compact", COMPACT_PROFILE),
+                          ("custom", WriteProfile(compression="lzf", chunk_size=777, access="cell",
+                                                  chunk_cache_nbytes=1 << 22))]:
+        expression = write_expression(os.path.join(study_path, "%s.hdf5" % name), profile=profile)
+        with h5py.File(expression.path, "r") as fopen:
+            for key in ["bioturing", "countsT", "normalizedT"]:
+                assert fopen[key]["data"].compression == profile.compression
+            if profile.chunk_size:
+                assert fopen["countsT"]["data"].chunks == (profile.chunk_size, )
+
+        expression = Expression(expression.path, chunk_cache=1 << 22)
+        assert (expression.raw_matrix != reference.raw_matrix).nnz == 0
+        assert (expression.get_genes(features[:10]) != reference.get_genes(features[:10])).nnz == 0
+
+    raw = adata.X.T.tocsc()
+    expression = Expression(os.path.join(study_path, "blocks.hdf5"))
+    assert expression.write_blocks([(raw[:, :500], barcodes[:500]), (raw[:, 500:], barcodes[500:])],
+                                   features, profile=COMPACT_PROFILE)
+    assert (expression.raw_matrix != reference.raw_matrix).nnz == 0
+
+
+def test_parallel_write():
+    from walnut.models import COMPACT_PROFILE, FAST_PROFILE, WriteProfile
+    from walnut.expression import write_array_parallel
+    from concurrent.futures import ThreadPoolExecutor
+
+    study_path = tempfile.mkdtemp()
+    reference = write_expression(os.path.join(study_path, "reference.hdf5"))
+
+    for name, profile in [("compact", COMPACT_PROFILE), ("fast", FAST_PROFILE),
+                          ("gzip", WriteProfile(compression="gzip", chunk_size=1001))]:
+        expression = Expression(write_expression(os.path.join(study_path, "%s.hdf5" % name), profile=profile,
+                                                 n_jobs=4).path)
+        assert (expression.raw_matrix != reference.raw_matrix).nnz == 0
+        assert np.allclose(expression.norm_matrix.toarray(), reference.norm_matrix.toarray())
+        assert (expression.get_genes(features[:10]) != reference.get_genes(features[:10])).nnz == 0
+        with h5py.File(expression.path, "r") as fopen, h5py.File(reference.path, "r") as fref:
+            for key in ["raw", "log", "lognorm"]:
+                assert np.allclose(fopen["colsum"][key][:], fref["colsum"][key][:])
+
+    # Chunks encoded by walnut are decoded by the HDF5 filters
+    value = np.arange(12345, dtype="float32") / 7
+    with h5py.File(os.path.join(study_path, "direct.hdf5"), "w") as fopen, ThreadPoolExecutor(3) as executor:
+        write_array_parallel(fopen, "x", value, executor, chunks=(1000, ), compression="gzip", shuffle=True)
+        assert np.array_equal(fopen["x"][:], value)
+
+
+def test_compact_dtypes():
+    from walnut.models import WriteProfile, COMPACT_PROFILE
+    from walnut.expression import compact_counts_dtype
+
+    assert compact_counts_dtype(np.array([0., 3., 255.])) == np.uint8
+    assert compact_counts_dtype(np.array([1., 70000.])) == np.uint32
+    assert compact_counts_dtype(np.array([1.5, 2.])) == np.float64
+
+    study_path = tempfile.mkdtemp()
+    raw = adata.X.T.tocsc().astype("float64")
+    raw.data = raw.data * 300 # Needs uint16
+    reference = write_expression(os.path.join(study_path, "reference.hdf5"), raw)
+
+    compact = WriteProfile(dtypes="compact")
+    expression = write_expression(os.path.join(study_path, "compact.hdf5"), raw, profile=compact)
+    blocks = Expression(os.path.join(study_path, "blocks.hdf5"))
+    assert blocks.write_blocks([(raw[:, :500], barcodes[:500]), (raw[:, 500:], barcodes[500:])],
+                               features, profile=COMPACT_PROFILE)
+
+    for path, counts_dtype in [(expression.path, "uint16"), (blocks.path, "uint32")]:
+        with h5py.File(path, "r") as fopen:
+            for key in ["bioturing", "countsT"]:
+                assert fopen[key]["data"].dtype == counts_dtype
+            assert fopen["normalizedT"]["data"].dtype == "float32"
+            for key in ["bioturing", "countsT", "normalizedT"]:
+                assert fopen[key]["indices"].dtype == "int32"
+            assert fopen["countsT"]["indptr"].dtype == "int32"
+        assert os.path.getsize(path) < os.path.getsize(reference.path)
+
+        stored = Expression(path)
+        assert stored.raw_matrix.dtype == counts_dtype
+        assert stored.get_genes(features[:5]).dtype == counts_dtype
+        upcast = Expression(path, dtype="float64")
+        assert upcast.raw_matrix.dtype == "float64"
+        assert upcast.get_genes(features[:5]).dtype == "float64"
+        assert upcast.get_cells([1, 2], unit="norm").dtype == "float64"
+        assert (upcast.raw_matrix != reference.raw_matrix).nnz == 0
+        assert np.allclose(upcast.norm_matrix.toarray(), reference.norm_matrix.toarray(), rtol=1e-6)
+
+    # Later blocks must fit the types picked from the first one
+    fractional = raw[:, 500:].copy()
+    fractional.data = fractional.data + 0.5
+    try:
+        Expression(os.path.join(study_path, "bad.hdf5")).write_blocks(
+            [(raw[:, :500], barcodes[:500]), (fractional, barcodes[500:])], features, profile=compact)
+        assert 1 == 0
+    except ValueError as e:
+        print(e)
+
+
+def test_gene_stats():
+    study_path = tempfile.mkdtemp()
+    raw = adata.X.T.tocsc().astype("float64")
+    raw.data = raw.data * np.arange(1, raw.nnz + 1) % 7 + 1
+    expression = Expression(os.path.join(study_path, "matrix.hdf5"))
+    expression.add_expression_data(raw_matrix=raw, barcodes=barcodes, features=features)
+    in_memory = expression.get_gene_stats()
+    assert expression.write()
+    blocks = Expression(os.path.join(study_path, "blocks.hdf5"))
+    assert blocks.write_blocks([(raw[:, :400], barcodes[:400]), (raw[:, 400:], barcodes[400:])],
+                               features, chunk_size=3000)
+
+    dense = raw.toarray()
+    expression = Expression(expression.path)
+    norm = expression.norm_matrix.toarray()
+    for stats in [in_memory, expression.get_gene_stats(), Expression(blocks.path).get_gene_stats()]:
+        assert list(stats.index) == features
+        assert np.array_equal(stats["nnz"], (dense > 0).sum(axis=1))
+        assert np.allclose(stats["percent"], (dense > 0).mean(axis=1) * 100)
+        assert np.allclose(stats["mean"], dense.mean(axis=1))
+        assert np.allclose(stats["var"], dense.var(axis=1, ddof=1))
+        assert np.allclose(stats["max"], dense.max(axis=1))
+    norm_stats = expression.get_gene_stats(unit="norm")
+    assert np.allclose(norm_stats["mean"], norm.mean(axis=1), rtol=1e-5)
+    assert np.allclose(norm_stats["var"], norm.var(axis=1, ddof=1), rtol=1e-4)
+
+    # Studies written before genestat existed are scanned
+    expression.close()
+    with h5py.File(expression.path, "a") as fopen:
+        del fopen["genestat"]
+    assert np.allclose(Expression(expression.path).get_gene_stats()["var"], dense.var(axis=1, ddof=1))
+
+
+def test_gene_cache():
+    from walnut.expression import GeneCache
+
+    study_path = tempfile.mkdtemp()
+    h5path = write_expression(os.path.join(study_path, "matrix.hdf5")).path
+
+    cache = GeneCache(max_bytes=1 << 20)
+    expression = Expression(h5path, gene_cache=cache)
+    reference = Expression(h5path, gene_cache=None).raw_matrix.tocsr()
+
+    block = expression.get_genes(features[:10])
+    assert cache.info()["misses"] == 10 and cache.info()["hits"] == 0
+    block = expression.get_genes(features[5:15] + [features[5]])
+    assert cache.info()["misses"] == 15 and cache.info()["hits"] == 6
+    assert (block != reference[list(range(5, 15)) + [5], :]).nnz == 0
+    assert len(cache) == 15
+
+    # Units do not share entries
+    expression.get_genes(features[:1], unit="norm")
+    assert cache.info()["misses"] == 16
+
+    # Least recently used genes go first when the budget is exceeded
+    cache.resize(cache.nbytes // 2)
+    assert cache.nbytes <= cache.max_bytes
+    misses = cache.info()["misses"]
+    expression.get_genes([features[0]])
+    assert cache.info()["misses"] == misses + 1
+    expression.get_genes(features[:300])
+    assert cache.nbytes <= cache.max_bytes
+    assert (expression.get_genes(features[:300]) != reference[:300, :]).nnz == 0
+
+def test_mmap_expression():
+    from walnut.models import MMAP_PROFILE, WriteProfile
+
+    try:
+        WriteProfile(layout="contiguous", compression="gzip")
+        assert 1 == 0
+    except ValueError as e:
+        print(e)
+
+    study_path = tempfile.mkdtemp()
+    reference = write_expression(os.path.join(study_path, "reference.hdf5"))
+
+    writer = write_expression(os.path.join(study_path, "matrix.hdf5"), profile=MMAP_PROFILE)
+
+    expression = Expression(writer.path, mmap=True, gene_cache=None)
+    raw_matrix = expression.raw_matrix
+    # scipy wraps the maps in plain read-only views, nothing is copied
+    assert not raw_matrix.data.flags.writeable and not raw_matrix.indices.flags.writeable
+    assert (raw_matrix != reference.raw_matrix).nnz == 0
+    assert not expression.norm_matrix.data.flags.writeable
+    assert abs(expression.norm_matrix - reference.norm_matrix).max() < 1e-6
+    assert (expression.get_genes(features[:10]) != reference.get_genes(features[:10])).nnz == 0
+    assert "mmap/countsT/data" in expression.cache_info()["keys"]
+    assert (expression.get_cells([3, 1, 2]) != reference.get_cells([3, 1, 2])).nnz == 0
+    assert abs(expression.get_cells([3, 1, 2], unit="norm") - reference.get_cells([3, 1, 2], unit="norm")).max() < 1e-6
+
+    # Chunked datasets cannot be mapped, they are read as usual
+    fallback = Expression(reference.path, mmap=True, gene_cache=None)
+    assert fallback.raw_matrix.data.flags.writeable
+    assert (fallback.raw_matrix != reference.raw_matrix).nnz == 0
+    assert (fallback.get_genes(features[:10]) != reference.get_genes(features[:10])).nnz == 0
+    assert (fallback.get_cells([3, 1, 2]) != reference.get_cells([3, 1, 2])).nnz == 0
+    assert abs(fallback.get_genes(features[:10], unit="norm") - reference.get_genes(features[:10], unit="norm")).max() == 0
+    assert not any(key.startswith("mmap/") for key in fallback.cache_info()["keys"]) # Slices only, nothing held
+
+def test_derived_norm():
+    from walnut.models import WriteProfile
+
+    study_path = tempfile.mkdtemp()
+    reference = write_expression(os.path.join(study_path, "reference.hdf5"))
+
+    writer = write_expression(os.path.join(study_path, "matrix.hdf5"), profile=WriteProfile(store_norm=False))
+    with h5py.File(writer.path, "r") as fopen:
+        assert "normalizedT" not in fopen
+    assert os.path.getsize(writer.path) < os.path.getsize(reference.path)
+
+    expression = Expression(writer.path, gene_cache=None)
+    assert abs(expression.norm_matrix - reference.norm_matrix).max() < 1e-4
+    assert abs(expression.get_genes(features[:10], unit="norm") -
+               reference.get_genes(features[:10], unit="norm")).max() < 1e-4
+    assert abs(expression.get_cells([3, 1, 2], unit="norm") -
+               reference.get_cells([3, 1, 2], unit="norm")).max() < 1e-4
+    log_genes = expression.get_genes(features[:10], unit="norm", transform="log2")
+    assert np.allclose(log_genes.toarray(), np.log2(reference.get_genes(features[:10], unit="norm").toarray() + 1),
+                       atol=1e-4)
+    assert np.allclose(expression.get_gene_stats("norm").values, reference.get_gene_stats("norm").values,
+                       rtol=1e-4, atol=1e-4)
+
+    backed = Expression(writer.path, backed=True)
+    assert abs(backed.norm_matrix[:10, :].toarray() - reference.norm_matrix[:10, :].toarray()).max() < 1e-4
+    assert np.allclose(backed.norm_matrix.sum(axis=0), reference.norm_matrix.sum(axis=0), rtol=1e-4)
+
+    raw = adata.X.T.tocsc()
+    blocks = Expression(os.path.join(study_path, "blocks.hdf5"))
+    assert blocks.write_blocks([(raw[:, :500], barcodes[:500]), (raw[:, 500:], barcodes[500:])],
+                               features, profile=WriteProfile(store_norm=False))
+    assert abs(blocks.norm_matrix - reference.norm_matrix).max() < 1e-4
+    assert np.allclose(blocks.get_gene_stats("norm").values, reference.get_gene_stats("norm").values,
+                       rtol=1e-4, atol=1e-4)
+
+    # A given normalized matrix would be lost
+    given = Expression(os.path.join(study_path, "given.hdf5"))
+    given.add_expression_data(raw_matrix=raw, barcodes=barcodes, features=features, norm_matrix=raw)
+    try:
+        given.write(profile=WriteProfile(store_norm=False))
+        assert 1 == 0
+    except ValueError as e:
+        print(e)
+    try:
+        Expression(given.path).write_blocks([(raw, barcodes, raw)], features, profile=WriteProfile(store_norm=False))
+        assert 1 == 0
+    except ValueError as e:
+        print(e)
+    assert not os.path.exists(given.path)
+
+def test_fixed_strings():
+    from walnut.models import WriteProfile
+    from walnut.expression import encode_strings, decode_strings
+
+    assert Expression.detect_feature_types(["ADT-CD3", "PRTB-x", "CD3E", "RNA-"]) == ["ADT", "PRTB", "RNA", "RNA"]
+    assert encode_strings(np.array(["a", "bc"]), fixed=True).dtype == np.dtype("S2")
+    assert encode_strings(np.array(["a", "é"]), fixed=True).dtype.kind == "O" # Not ASCII
+    assert decode_strings(np.array([b"a", "é".encode()], dtype=object)).tolist() == ["a", "é"]
+
+    study_path = tempfile.mkdtemp()
+    profile = WriteProfile(strings="fixed")
+    expression = write_expression(os.path.join(study_path, "matrix.hdf5"), profile=profile)
+    with h5py.File(expression.path, "r") as fopen:
+        for key in ["bioturing/barcodes", "bioturing/features", "countsT/barcodes", "countsT/features"]:
+            assert fopen[key].dtype.kind == "S"
+
+    expression = Expression(expression.path)
+    assert expression.barcodes == list(barcodes) and expression.features == list(features)
+    assert (expression.get_genes(features[5:7]) != expression.raw_matrix[5:7, :]).nnz == 0
+
+    raw = adata.X.T.tocsc()
+    blocks = Expression(os.path.join(study_path, "blocks.hdf5"))
+    assert blocks.write_blocks([(raw[:, :500], barcodes[:500]), (raw[:, 500:], barcodes[500:])],
+                               features, profile=profile)
+    with h5py.File(blocks.path, "r") as fopen:
+        assert fopen["bioturing/barcodes"].dtype.kind == "S"
+    assert blocks.barcodes == list(barcodes)
+
+def test_lookup_index():
+    study_path = tempfile.mkdtemp()
+    expression = Expression(os.path.join(study_path, "matrix.hdf5"))
+    expression.add_expression_data(raw_matrix=adata.X.T, barcodes=barcodes, features=features)
+    query = [barcodes[10], "unknown", barcodes[0], barcodes[-1]]
+    assert expression.lookup_barcodes(query).tolist() == [10, -1, 0, len(barcodes) - 1]
+    assert expression.write()
+
+    expression = Expression(expression.path)
+    with h5py.File(expression.path, "r") as fopen:
+        assert "index/barcodes" in fopen and "index/features" in fopen
+    assert expression.lookup_barcodes(query).tolist() == [10, -1, 0, len(barcodes) - 1]
+    assert expression.lookup_features([features[3], "ZZZ", features[0]]).tolist() == [3, -1, 0]
+    assert expression.lookup_barcodes(barcodes).tolist() == list(range(len(barcodes)))
+    assert len(expression.lookup_features([])) == 0
+
+    # Studies written before the index are indexed in memory
+    expression.close()
+    with h5py.File(expression.path, "a") as fopen:
+        del fopen["index"]
+    expression = Expression(expression.path)
+    assert expression.lookup_barcodes(query).tolist() == [10, -1, 0, len(barcodes) - 1]
+
+def test_append_cells():
+    from walnut.models import WriteProfile, MMAP_PROFILE
+
+    study_path = tempfile.mkdtemp()
+    reference = write_expression(os.path.join(study_path, "reference.hdf5"))
+    raw = adata.X.T.tocsc()
+
+    study_path = tempfile.mkdtemp()
+    study = make_study(study_path, raw[:, :700], cells=slice(700))
+    cluster_id = study.metadata.add_category("cluster", ["a"] * 350 + ["b"] * 350)
+    score_id = study.metadata.add_category("score", list(range(700)))
+
+    # Rows are matched by name
+    order = np.arange(n_gene)[::-1]
+    assert study.append_cells(raw[order, 700:], barcodes[700:], [features[i] for i in order])
+    assert study.n_cell == Study(study_path).n_cell == n_cell
+    labels = study.metadata.get(cluster_id)
+    assert len(labels) == n_cell and (labels[700:] == "Unassigned").all() and (labels[:350] == "a").all()
+    assert np.isnan(study.metadata.get(score_id)[700:]).all()
+
+    expression = Expression(os.path.join(study_path, "main", "matrix.hdf5"))
+    assert expression.barcodes == list(barcodes)
+    assert (expression.raw_matrix != reference.raw_matrix).nnz == 0
+    assert abs(expression.norm_matrix - reference.norm_matrix).max() < 1e-6
+    assert (expression.get_genes(features[:10]) != reference.get_genes(features[:10])).nnz == 0
+    assert expression.lookup_barcodes([barcodes[999], barcodes[0]]).tolist() == [999, 0]
+    assert np.allclose(expression.get_gene_stats("norm").values, reference.get_gene_stats("norm").values)
+    with h5py.File(expression.path, "r") as fopen:
+        assert np.allclose(fopen["colsum/raw"][:], reference.raw_matrix.sum(axis=0))
+    try:
+        expression.append_cells(raw[:, :10], barcodes[:10])
+        assert 1 == 0
+    except ValueError as e:
+        print(e)
+
+    # Several appends, without normalizedT and with non-resizable datasets
+    for name, profile in [("derived", WriteProfile(store_norm=False, dtypes="compact", strings="fixed")),
+                          ("mmap", MMAP_PROFILE)]:
+        expression = Expression(write_expression(os.path.join(study_path, "%s.hdf5" % name), raw[:, :400],
+                                                 cells=slice(400), profile=profile).path)
+        assert expression.append_cells(raw[:, 400:700], barcodes[400:700])
+        assert expression.append_cells(raw[:, 700:], barcodes[700:])
+        assert (expression.raw_matrix != reference.raw_matrix).nnz == 0
+        assert abs(expression.norm_matrix - reference.norm_matrix).max() < 1e-4
+        assert (expression.get_cells([999, 5]) != reference.get_cells([999, 5])).nnz == 0
+        assert np.allclose(expression.get_gene_stats("norm").values, reference.get_gene_stats("norm").values,
+                           rtol=1e-4, atol=1e-4)
+
+    # Space of rewritten groups is not left behind
+    for name, profile in [("legacy", WriteProfile(chunk_size=10000)),
+                          ("compact", WriteProfile(compression="gzip", compression_opts=4, shuffle=True,
+                                                   dtypes="compact"))]:
+        fresh = write_expression(os.path.join(study_path, "%s_fresh.hdf5" % name), raw, profile=profile)
+        expression = Expression(write_expression(os.path.join(study_path, "%s_appended.hdf5" % name), raw[:, :600],
+                                                 cells=slice(600), profile=profile).path)
+        for start in range(600, n_cell, 100):
+            assert expression.append_cells(raw[:, start:start + 100], barcodes[start:start + 100])
+        assert not os.path.exists(expression.path + ".tmp")
+        assert (expression.raw_matrix != reference.raw_matrix).nnz == 0
+        assert os.path.getsize(expression.path) < 1.2 * os.path.getsize(fresh.path)
+
+def test_anndata_bridge():
+    import pandas as pd
+    from walnut.models import MMAP_PROFILE
+
+    source = sc.AnnData(sparse.csr_matrix(adata.X))
+    source.obs_names, source.var_names = barcodes, features
+    source.obs["cluster"] = pd.Categorical(["a", "b"] * (n_cell // 2))
+    source.obs["score"] = np.arange(n_cell, dtype=float)
+    source.obsm["X_umap"] = np.random.rand(n_cell, 2)
+    h5ad = os.path.join(tempfile.mkdtemp(), "source.h5ad")
+    source.write_h5ad(h5ad)
+
+    study_path = tempfile.mkdtemp()
+    study = Study.from_anndata(study_path, h5ad, species="human", chunk_size=300, profile=MMAP_PROFILE)
+    assert study.n_cell == n_cell
+    assert (study.expression.raw_matrix != adata.X.T).nnz == 0
+    assert study.dimred.names == ["umap"]
+    h5py.File(h5ad, "a").close() # Not left open by the import
+
+    for backed in [False, True]:
+        study = Study(study_path)
+        result = study.to_anndata(backed=backed)
+        study.expression.close()
+        h5py.File(study.expression.path, "a").close() # Maps outlive the HDF5 handle
+        assert result.shape == (n_cell, n_gene)
+        assert (result.X != adata.X).nnz == 0
+        assert result.obs["cluster"].tolist() == source.obs["cluster"].tolist()
+        assert np.allclose(result.obs["score"], source.obs["score"])
+        assert np.allclose(result.obsm["X_umap"], source.obsm["X_umap"], atol=1e-5)
+        assert result.var_names.tolist() == features
+    assert not result.X.data.flags.writeable # Mapped from matrix.hdf5
+    assert (result.X != adata.X).nnz == 0
+    try:
+        Study.from_anndata(tempfile.mkdtemp(), source, species="human").to_anndata(backed=True)
+        assert 1 == 0
+    except ValueError as e:
+        print(e)
+
+    # Zero-copy hand over of the cached matrix
+    study = Study(study_path)
+    assert np.shares_memory(study.to_anndata().X.data, study.expression.raw_matrix.data)
+
+    add_subcluster(study_path, [3, 5, 7])
+    sub = study.to_anndata("abc", unit="norm")
+    assert sub.obs_names.tolist() == [barcodes[i] for i in [3, 5, 7]]
+    assert np.allclose(sub.X.toarray(), study.expression.norm_matrix[:, [3, 5, 7]].T.toarray())
+
+def test_normalize_total():
+    from walnut.expression import normalize_total
+
+    raw = adata.X.T.tocsc()
+    raw.data[raw.indptr[5]:raw.indptr[6]] = 0 # Empty cells stay empty
+    raw.eliminate_zeros()
+    reference = sc.AnnData(sparse.csr_matrix(raw.T, dtype="float32"))
+    sc.pp.normalize_total(reference, target_sum=1e4)
+
+    norm = Expression.normalize_expression(raw)
+    assert norm.dtype == np.float32 and raw.dtype == np.int8
+    assert np.allclose(norm.toarray(), reference.X.T.toarray(), rtol=1e-5)
+    assert norm[:, 5].nnz == 0
+
+    values = raw.astype("float64")
+    same = normalize_total(values, inplace=True)
+    assert same is values and np.allclose(same.toarray(), reference.X.T.toarray(), rtol=1e-5)
+
+def test_aggregate_expression():
+    from walnut.models import WriteProfile
+
+    study = make_study(tempfile.mkdtemp(), profile=WriteProfile(store_norm=False))
+    labels = np.array(["a", "b", "c"])[np.arange(n_cell) % 3]
+    meta_id = study.metadata.add_category("cluster", labels.tolist())
+    score_id = study.metadata.add_category("score", list(range(n_cell)))
+
+    raw = adata.X.T.toarray().astype("float64")
+    norm = study.expression.norm_matrix.toarray()
+    for stat, unit, values in [("sum", "raw", raw), ("mean", "norm", norm),
+                               ("fraction_expressed", "raw", raw != 0)]:
+        df = study.aggregate_expression(meta_id, stat=stat, unit=unit, n_jobs=2)
+        assert sorted(df.index) == ["a", "b", "c"] and df.columns.tolist() == features # No empty "Unassigned"
+        for label in df.index:
+            cells = labels == label
+            expected = values[:, cells].sum(axis=1)
+            if stat != "sum":
+                expected = expected / cells.sum()
+            assert np.allclose(df.loc[label].values, expected, rtol=1e-4)
+
+    genes = features[10:15][::-1]
+    df = study.expression.aggregate(np.arange(n_cell) % 3, genes, stat="mean", unit="raw",
+                                    transform="log2", chunk_size=100)
+    assert np.allclose(df[0], np.log2(raw[[features.index(g) for g in genes]][:, ::3] + 1).mean(axis=1))
+
+    try:
+        study.aggregate_expression(score_id)
+        assert 1 == 0
+    except ValueError as e:
+        print(e)
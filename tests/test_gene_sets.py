@@ -0,0 +1,33 @@
+from walnut.study import Study
+from helpers import n_gene, barcodes, features, make_study
+import tempfile
+import numpy as np
+
+
+def test_score_gene_sets():
+    from walnut.gene_sets import score_gene_sets
+
+    study_path = tempfile.mkdtemp()
+    study = make_study(study_path)
+    first = study.gallery.create_empty_collection("first")
+    for gene in features[:5]:
+        study.gallery.add_item(first, gene, [gene])
+    second = study.gallery.create_empty_collection("second")
+    study.gallery.add_item(second, "pair", features[3:5] + ["UNKNOWN"])
+    study.gallery.write()
+
+    values = np.log2(study.expression.norm_matrix.toarray().astype("float64") + 1)
+    df = Study(study_path).score_gene_sets([first, second], add_metadata=True)
+    assert df.columns.tolist() == [first, second] and df.index.tolist() == barcodes
+    assert np.allclose(df[first], values[:5].mean(axis=0), atol=1e-5)
+    assert np.allclose(df[second], values[3:5].mean(axis=0), atol=1e-5)
+    metadata = Study(study_path).metadata
+    assert [metadata.get_content_by_id(i).name for i in metadata.ids][-2:] == ["first", "second"]
+
+    # Controls drawn among all other genes
+    scores = score_gene_sets(study.expression, [features[:5], []], method="module_score", n_bins=1,
+                             ctrl_size=n_gene, chunk_size=50000)
+    assert np.allclose(scores[:, 0], values[:5].mean(axis=0) - values[5:].mean(axis=0), atol=1e-5)
+    assert np.isnan(scores[:, 1]).all()
+    scores = score_gene_sets(study.expression, [features[:5]], method="module_score", ctrl_size=20)
+    assert not np.allclose(scores[:, 0], values[:5].mean(axis=0))
@@ -11,3 +11,9 @@ def test_history():
     from walnut.models.history import History
     h = History.parse_obj({"created_by": "walnut", "created_at": 123, "hash_id": "acbs", "message": "test"})
     assert h.description == "test"
+
+def test_lazy_imports():
+    import subprocess, sys
+    code = "import sys, walnut.study; print([m for m in ['scanpy', 'anndata'] if m in sys.modules])"
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == "[]"
@@ -0,0 +1,50 @@
+from walnut.study import Study
+from helpers import n_gene, n_cell, features, make_study
+import scanpy as sc
+import tempfile
+import numpy as np
+import scipy.sparse as sparse
+
+
+def test_highly_variable_genes():
+    from walnut import hvg
+
+    rng = np.random.default_rng(0)
+    dispersion = np.where(np.arange(n_gene) % 10 == 0, 5.0, 0.2) # Every tenth gene overdispersed
+    rate = rng.gamma(1 / dispersion[:, None], (rng.gamma(0.5, 1, n_gene) * dispersion)[:, None], (n_gene, n_cell))
+    raw = rng.poisson(rate).astype("int32")
+    study_path = tempfile.mkdtemp()
+    study = make_study(study_path, sparse.csc_matrix(raw), ana_setting={"filter": {"top": 100}})
+
+    # Dispersions as Seurat, through scanpy
+    norm = study.expression.norm_matrix.toarray().astype("float64")
+    reference = sc.AnnData(sparse.csr_matrix(np.log1p(norm.T)))
+    reference.var_names = features
+    sc.pp.highly_variable_genes(reference, flavor="seurat", n_top_genes=200)
+    df = study.highly_variable_genes(n_top=200, flavor="dispersion")
+    assert np.allclose(df.loc[features, "score"], reference.var["dispersions_norm"], atol=1e-5, equal_nan=True)
+    assert set(df.index[df["highly_variable"]]) == set(reference.var_names[reference.var["highly_variable"]])
+
+    # Seurat v3 against dense clipped counts
+    mean, var = raw.mean(axis=1), raw.var(axis=1, ddof=1)
+    varying = var > 0
+    expected = 10 ** hvg.loess(np.log10(mean[varying]), np.log10(var[varying]))
+    clipped = np.minimum(raw[varying], (np.sqrt(expected * n_cell) + mean[varying])[:, None])
+    score = np.full(n_gene, np.nan)
+    score[varying] = ((clipped - mean[varying, None]) ** 2).sum(axis=1) / ((n_cell - 1) * expected)
+    df = study.highly_variable_genes(collection_name="HVG")
+    assert df["highly_variable"].sum() == 100 and (np.diff(df["score"][:100]) <= 0).all()
+    assert np.allclose(df.loc[features, "score"], score, equal_nan=True) and np.allclose(df.loc[features, "means"], mean)
+    assert (np.array([features.index(gene) for gene in df.index[:100]]) % 10 == 0).mean() > 0.8
+    gallery = Study(study_path).gallery
+    gallery.read()
+    assert sorted(gallery.get(gallery.collections.__root__[0].id)) == sorted(df.index[:100])
+
+    # Streamed per batch
+    batch_id = study.metadata.add_category("batch", np.array(["a", "b"])[np.arange(n_cell) % 2].tolist())
+    single = hvg.highly_variable_genes(study.expression, n_top=100, labels=np.zeros(n_cell), chunk_size=50000)
+    assert np.allclose(single["score"], df["score"], equal_nan=True) and single.index.tolist() == df.index.tolist()
+    df = study.highly_variable_genes(batch_meta_id=batch_id, n_jobs=2)
+    assert df["n_batches"].max() == 2 and np.allclose(df.loc[features, "means"], mean)
+    assert np.allclose(df.loc[features, "variances"], var)
+    assert (np.diff(df["n_batches"][:100]) <= 0).all()
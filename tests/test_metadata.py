@@ -1,6 +1,8 @@
 import os
 import tempfile
 import json
+import numpy
+import pandas
 from typing import Text
 
 from walnut.metadata import Metadata
@@ -164,3 +166,59 @@ def test_add_metadata_with_len_check():
     assert meta.get('abc').size == 6
     meta_id = meta.add_category('test 2', ['a', 'c', 'b', 'c', 'a', 'b'])
     assert meta.get(meta_id).size == 6
+
+def test_add_cells():
+    common.clear_folder(meta_folder)
+    meta = Metadata(meta_folder, TextReader())
+    meta.add_cells(2) # Nothing to grow
+    cluster_id = meta.add_category("cluster", ["a", "b", "a", "Unassigned"])
+    score_id = meta.add_category("score", [1, 2, None, 4], type="numeric")
+
+    meta.add_cells(2)
+    meta = Metadata(meta_folder, TextReader())
+    arr = meta.get(cluster_id)
+    assert arr.tolist() == ["a", "b", "a", "Unassigned", "Unassigned", "Unassigned"]
+    cate = meta.get_content_by_id(cluster_id)
+    assert cate.clusterName[0] == "Unassigned" and cate.clusterLength[0] == 3
+    assert len(cate.history) == 2
+    score = meta.get(score_id)
+    assert score.size == 6 and score[:2].tolist() == [1, 2]
+    assert numpy.isnan(score[[2, 4, 5]]).all()
+    assert meta.get_content_by_id(score_id).clusters[4:] == [None, None]
+    assert meta.to_df().shape == (6, 2)
+
+def test_get_column():
+    common.clear_folder(meta_folder)
+    meta = Metadata(meta_folder, TextReader())
+    cluster_id = meta.add_category("cluster", ["b", "a", "a", "Unassigned"])
+    score_id = meta.add_category("score", [1, None, 3, 4], type="numeric")
+
+    column = meta.get_column(cluster_id)
+    assert isinstance(column, pandas.Categorical)
+    assert column.tolist() == meta.get(cluster_id).tolist()
+    assert column.categories.tolist() == meta.get_content_by_id(cluster_id).clusterName
+    score = meta.get_column(score_id)
+    assert score.dtype == "float64" and score[0] == 1 and numpy.isnan(score[1])
+
+    # Duplicated cluster names are merged
+    with open(os.path.join(meta_folder, "metalist.json"), "w") as fopen:
+        json.dump({"abc": {
+            "name": "test",
+            "id": "abc",
+            "type": "category",
+            "clusterName": ["Unassigned", "x", "x"],
+            "clusterLength": [1, 1, 1],
+            "history": [{"created_by": "walnut", "created_at": 123, "description": "test", "hash_id": "abcde"}]
+        }}, fopen)
+    with open(os.path.join(meta_folder, "abc.json"), "w") as fopen:
+        json.dump({
+            "name": "test",
+            "id": "abc",
+            "type": "category",
+            "clusters": [0, 1, 2],
+            "clusterName": ["Unassigned", "x", "x"],
+            "clusterLength": [1, 1, 1],
+            "history": [{"created_by": "walnut", "created_at": 123, "description": "test", "hash_id": "abcde"}]
+        }, fopen)
+    column = Metadata(meta_folder, TextReader()).get_column("abc")
+    assert column.tolist() == ["Unassigned", "x", "x"] and len(column.categories) == 2
@@ -0,0 +1,59 @@
+from walnut.study import Study
+from helpers import n_cell, adata, features, make_study
+import tempfile
+import numpy as np
+import h5py
+
+
+def test_plot_stats():
+    study_path = tempfile.mkdtemp()
+    study = make_study(study_path, unit_settings={"RNA": {"type": "norm", "transform": "log2"}})
+    labels = np.array(["a", "b", "c"])[np.arange(n_cell) % 3]
+    meta_id = study.metadata.add_category("cluster", labels.tolist())
+    genes = features[20:30]
+
+    values = np.log2(study.expression.get_genes(genes, unit="norm").toarray().astype("float64") + 1)
+    df = study.get_plot_stats(meta_id, genes)
+    assert df.index.names == ["gene", "group"] and len(df) == 30
+    for gene, value in zip(genes, values):
+        for label in ["a", "b", "c"]:
+            row = df.loc[(gene, label)]
+            cells = value[labels == label]
+            assert np.isclose(row["mean"], cells.mean(), rtol=1e-5)
+            assert np.isclose(row["fraction_expressed"], (cells != 0).mean())
+            assert np.allclose(row[["q0", "q25", "q50", "q95", "q100"]],
+                               np.quantile(cells, [0, 0.25, 0.5, 0.95, 1]), rtol=1e-5)
+    key = study.plot_stats.key(meta_id, "norm", "log2")
+    assert study.plot_stats.info() == {key: 10}
+
+    # Cached genes are not read again, new genes are added
+    study = Study(study_path)
+    study.expression.get_genes = None
+    assert np.allclose(study.get_plot_stats(meta_id, genes[::-1]).loc[genes[3]], df.loc[genes[3]])
+    study = Study(study_path)
+    study.get_plot_stats(meta_id, features[25:35])
+    assert study.plot_stats.info() == {key: 15}
+
+    # Lookups only read, genes looked up last are kept
+    with h5py.File(study.plot_stats.path, "r"):
+        study.get_plot_stats(meta_id, features[20:22])
+    study.plot_stats.max_genes = 15
+    study.get_plot_stats(meta_id, features[40:45])
+    with h5py.File(study.plot_stats.path, "r") as fopen:
+        kept = set(fopen[key]["genes"].asstr()[:])
+    assert len(kept) == 15 and set(features[20:22] + features[40:45]) <= kept
+
+    # Edited metadata invalidates, bulk precompute and bounded size
+    study.metadata.add_label(meta_id, "d", list(range(10)))
+    study.plot_stats.max_genes = 100
+    study.precompute_plot_stats([meta_id], features[:150])
+    assert study.plot_stats.info() == {key: 100}
+    mean = np.asarray(adata.X[:, :150].mean(axis=0)).ravel()
+    with h5py.File(study.plot_stats.path, "r") as fopen:
+        kept = set(fopen[key]["genes"].asstr()[:])
+    assert kept == set(np.array(features)[np.argsort(-mean, kind="stable")[:100]])
+    df = study.get_plot_stats(meta_id, features[:2])
+    assert np.isclose(df.loc[(features[0], "d"), "fraction_expressed"],
+                      (adata.X[:10, 0].toarray() != 0).mean())
+    study.plot_stats.evict(meta_id)
+    assert study.plot_stats.info() == {}
@@ -0,0 +1,48 @@
+from walnut.streaming import value_keys, average_ranks, zero_rank, map_gene_chunks
+from walnut.de import rank_groups
+from walnut.coexpression import rank_block
+from helpers import n_gene, write_expression
+import os
+import tempfile
+import numpy as np
+import scipy.sparse as sparse
+from scipy import stats
+
+
+def read_nnz(positions, state):
+    return state["expression"].read_gene_chunk(positions, unit=state["unit"]).getnnz(axis=1)
+
+def test_average_ranks():
+    values = np.array([-1.5, 0.25, 2, 0.25, 3, -0.5, 7], dtype="float32")
+    assert (np.diff(value_keys(values)[np.argsort(values)].astype("int64")) >= 0).all()
+    assert np.array_equal(np.argsort(value_keys(np.array([3, -2, 0, 9])), kind="stable"), [1, 2, 0, 3])
+
+    # Two rows of 6 cells, non-zeros sorted by row then value
+    dense = np.array([[0, -1, 2, 2, 0, 5], [3, 0, 0, 0, 0, 1]], dtype="float64")
+    rows, cols = np.nonzero(dense)
+    data = dense[rows, cols]
+    order = np.lexsort((data, rows))
+    key = rows[order].astype("uint64") << np.uint64(32) | value_keys(data[order]).astype("uint64")
+    nnz = np.bincount(rows, minlength=2)
+    n_zero, n_neg = 6 - nnz, np.bincount(rows[data < 0], minlength=2)
+    tie_row, sizes, tie_rank = average_ranks(key, rows[order], np.r_[0, np.cumsum(nnz)], n_neg, n_zero)
+    expected = np.vstack([stats.rankdata(row) for row in dense])
+    assert np.allclose(np.repeat(tie_rank, sizes), expected[rows[order], cols[order]])
+    assert tie_row.tolist() == [0, 0, 0, 1, 1] and sizes.tolist() == [1, 2, 1, 1, 1]
+    assert np.allclose(zero_rank(n_neg, n_zero), [expected[0, 0], expected[1, 1]])
+    assert all(len(x) == 0 for x in average_ranks(key[:0], rows[:0], np.zeros(3, dtype="int64"), n_neg, n_zero))
+
+    # Both users agree with scipy
+    block = sparse.csr_matrix(dense)
+    assert np.allclose(rank_block(block).toarray() + zero_rank(n_neg, n_zero)[:, None], expected)
+    rank_sum, _, _ = rank_groups(data[order], rows[order], np.zeros(len(data), dtype="int64"), 2, 1, n_zero)
+    assert np.allclose(rank_sum[:, 0], np.where(dense != 0, expected, 0).sum(axis=1))
+
+def test_map_gene_chunks():
+    expression = write_expression(os.path.join(tempfile.mkdtemp(), "matrix.hdf5"))
+    chunks = expression.gene_chunks(chunk_size=20000)
+    assert len(chunks) > 2
+    expected = expression.raw_matrix.getnnz(axis=1)
+    for n_jobs in [1, 2]:
+        parts = map_gene_chunks(read_nnz, expression, chunks, {"unit": "raw"}, n_jobs=n_jobs)
+        assert np.array_equal(np.concatenate(parts), expected) and len(expected) == n_gene
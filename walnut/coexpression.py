@@ -0,0 +1,144 @@
+"""
+Gene-gene co-expression: Pearson or Spearman correlations across cells
+
+Correlations are never computed on densified genes. Query genes are read
+once; the other genes are streamed in chunks and correlated through the
+sparse product `query @ chunk.T`, corrected with the per-gene means and
+centered norms of both sides. Spearman correlations are Pearson correlations
+of ranks, shifted so that zeros keep rank 0 and blocks stay sparse. Means
+and norms of untransformed values of all cells are the gene statistics of
+matrix.hdf5 when it has them.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from walnut.expression import Expression, CHUNK_SIZE
+from walnut.streaming import value_keys, average_ranks, zero_rank, map_gene_chunks
+from walnut import constants
+
+def select_cells(block: sparse.csr_matrix, mapping: Optional[np.ndarray], n_cell: int) -> sparse.csr_matrix:
+    """Columns of a genes-by-cells block renumbered by `mapping`, -1 dropping cells"""
+    if mapping is None:
+        return block
+    new_indices = mapping[block.indices]
+    keep = new_indices >= 0
+    rows = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))[keep]
+    indptr = np.r_[0, np.cumsum(np.bincount(rows, minlength=block.shape[0]))]
+    return sparse.csr_matrix((block.data[keep], new_indices[keep], indptr), shape=(block.shape[0], n_cell))
+
+def rank_block(block: sparse.csr_matrix) -> sparse.csr_matrix:
+    """
+    Average ranks of each row among all its cells, zeros included, minus the
+    rank of zeros: zeros stay implicit and correlations of ranks are unchanged
+    """
+    n_row, n_cell = block.shape
+    rows = np.repeat(np.arange(n_row), np.diff(block.indptr))
+    keep = block.data != 0
+    data, rows, indices = block.data[keep], rows[keep], block.indices[keep]
+    nnz = np.bincount(rows, minlength=n_row)
+    n_zero = n_cell - nnz
+    n_neg = np.bincount(rows[data < 0], minlength=n_row)
+
+    key = rows.astype("uint64") << np.uint64(32) | value_keys(data).astype("uint64")
+    order = np.argsort(key, kind="stable")
+    indptr = np.r_[0, np.cumsum(nnz)]
+    tie_row, sizes, tie_rank = average_ranks(key[order], rows[order], indptr, n_neg, n_zero)
+    ranks = np.empty(len(key))
+    ranks[order] = np.repeat(tie_rank - zero_rank(n_neg, n_zero)[tie_row], sizes)
+    return sparse.csr_matrix((ranks, indices, indptr), shape=block.shape)
+
+def prepare_block(block: sparse.csr_matrix, mapping: Optional[np.ndarray], n_cell: int,
+                  method: constants.CORRELATION_METHOD_LIST="pearson",
+                  moments: Optional[Tuple[np.ndarray, np.ndarray]]=None) -> Tuple[sparse.csr_matrix, np.ndarray, np.ndarray]:
+    """
+    Genes of a block restricted to the selected cells, ranked for Spearman, with
+    their means and centered norms, computed unless given as `moments`
+    """
+    block = select_cells(block, mapping, n_cell)
+    block = rank_block(block) if method == "spearman" else sparse.csr_matrix(block, dtype="float64")
+    if moments is not None:
+        return (block, *moments)
+    rows = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+    mean = np.bincount(rows, weights=block.data, minlength=block.shape[0]) / n_cell
+    sumsq = np.bincount(rows, weights=block.data ** 2, minlength=block.shape[0])
+    return block, mean, np.sqrt(np.maximum(sumsq - n_cell * mean ** 2, 0))
+
+def correlate_prepared(query: Tuple[sparse.csr_matrix, np.ndarray, np.ndarray],
+                       target: Tuple[sparse.csr_matrix, np.ndarray, np.ndarray], n_cell: int) -> np.ndarray:
+    """Queries-by-targets correlations of two prepared blocks, NaN for constant genes"""
+    (q, q_mean, q_norm), (t, t_mean, t_norm) = query, target
+    dot = (q @ t.T).toarray()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (dot - n_cell * np.outer(q_mean, t_mean)) / np.outer(q_norm, t_norm)
+
+def correlate_chunk(positions: np.ndarray, state: Dict[str, Any]) -> np.ndarray:
+    """
+    Correlations of the query genes with genes at `positions`,
+    see :func:`walnut.streaming.map_gene_chunks`
+    """
+    block = state["expression"].read_gene_chunk(positions, unit=state["unit"], transform=state["transform"])
+    moments = None if state["moments"] is None else tuple(x[positions] for x in state["moments"])
+    target = prepare_block(block, state["mapping"], state["n_cell"], state["method"], moments)
+    return correlate_prepared(state["query"], target, state["n_cell"])
+
+def correlate(expression: Expression, query_ids: List[str], target_ids: Optional[List[str]]=None,
+              method: constants.CORRELATION_METHOD_LIST="pearson", cells: Optional[np.ndarray]=None,
+              unit: constants.UNIT_TYPE_LIST="norm", transform: constants.UNIT_TRANSFORM_LIST="log2",
+              chunk_size: int=CHUNK_SIZE, n_jobs: int=1) -> np.ndarray:
+    """
+    Queries-by-targets correlations across cells, or across `cells` only.
+    Targets (all genes by default) are streamed in chunks, spread over `n_jobs`
+    processes that read their own chunks. Pearson correlations of untransformed
+    values across all cells take gene means and norms from the gene statistics
+    of matrix.hdf5 if it has them
+    """
+    n_total = len(expression.barcodes)
+    mapping, n_cell = None, n_total
+    if cells is not None:
+        cells = np.unique(np.asarray(cells, dtype="int64"))
+        mapping = np.full(n_total, -1, dtype="int64")
+        mapping[cells] = np.arange(len(cells))
+        n_cell = len(cells)
+
+    moments = None
+    if method == "pearson" and transform == "none" and mapping is None and expression.has_gene_stats(unit):
+        stats = expression.get_gene_stats(unit)
+        moments = (stats["mean"].values, np.sqrt(stats["var"].values * max(n_cell - 1, 1)))
+
+    query = expression.get_genes(query_ids, unit=unit, transform=transform)
+    query_moments = None
+    if moments is not None:
+        position = expression.lookup_features(query_ids)
+        query_moments = tuple(x[position] for x in moments)
+    state = {"unit": unit, "transform": transform, "mapping": mapping, "n_cell": n_cell, "method": method,
+             "moments": moments, "query": prepare_block(query, mapping, n_cell, method, query_moments)}
+    chunks = expression.gene_chunks(target_ids, unit=unit, chunk_size=chunk_size)
+    if len(chunks) == 0:
+        return np.zeros((len(query_ids), 0))
+
+    return np.hstack(map_gene_chunks(correlate_chunk, expression, chunks, state, n_jobs=n_jobs))
+
+def top_partners(expression: Expression, query_ids: List[str], top_k: int=20,
+                 method: constants.CORRELATION_METHOD_LIST="pearson", cells: Optional[np.ndarray]=None,
+                 unit: constants.UNIT_TYPE_LIST="norm", transform: constants.UNIT_TRANSFORM_LIST="log2",
+                 chunk_size: int=CHUNK_SIZE, n_jobs: int=1) -> pd.DataFrame:
+    """
+    The `top_k` genes most correlated with each query gene, among all genes of
+    the study, see :func:`correlate`. Returns a DataFrame with `query`, `gene`
+    (IDs) and `correlation`, by query then decreasing correlation
+    """
+    corr = correlate(expression, query_ids, None, method=method, cells=cells, unit=unit, transform=transform,
+                     chunk_size=chunk_size, n_jobs=n_jobs)
+    features = np.array(expression.features, dtype=object)
+    corr[np.arange(len(query_ids)), expression.lookup_features(query_ids)] = np.nan # Not its own partner
+    corr = np.where(np.isnan(corr), -np.inf, corr)
+
+    frames = []
+    for i, query in enumerate(query_ids):
+        k = min(top_k, corr.shape[1])
+        best = np.argpartition(-corr[i], k - 1)[:k] if k > 0 else np.array([], dtype="int64")
+        best = best[np.argsort(-corr[i, best], kind="stable")]
+        best = best[np.isfinite(corr[i, best])]
+        frames.append(pd.DataFrame({"query": query, "gene": features[best], "correlation": corr[i, best]}))
+    return pd.concat(frames, ignore_index=True)
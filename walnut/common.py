@@ -76,13 +76,14 @@ def create_history(creator="walnut", description="Created automatically") -> His
                     description=description)
 
 def find_indices_in_list(needles: Collection, haystack: Collection) -> List[int]:
-    if len(numpy.unique(list(haystack))) != len(haystack):
-        raise ValueError("haystack must not contain any duplicate items")
-
     index: Dict[Any, int] = {}
     for i, item in enumerate(haystack):
         index[item] = i
 
+    # Duplicates collapse into one key, no need to sort the haystack to detect them
+    if len(index) != len(haystack):
+        raise ValueError("haystack must not contain any duplicate items")
+
     return [index.get(item, -1) for item in needles]
 
 def is_number(x) -> bool:
@@ -13,6 +13,11 @@ SPECIES_LIST = Literal["human", "mouse", "rat", "zebrafish", "fly",
 OMICS_LIST = Literal["RNA", "ADT", "PRTB", "spatial", "NA"]
 UNIT_TYPE_LIST = Literal["norm", "raw"]
 UNIT_TRANSFORM_LIST = Literal["none", "log2"]
+AGGREGATE_STAT_LIST = Literal["sum", "mean", "fraction_expressed"]
+DE_METHOD_LIST = Literal["wilcoxon", "t-test"]
+SCORE_METHOD_LIST = Literal["mean", "module_score"]
+CORRELATION_METHOD_LIST = Literal["pearson", "spearman"]
+HVG_FLAVOR_LIST = Literal["seurat_v3", "dispersion"]
 UNIT_LIST = Literal["umi", "lognorm", "read", "cpm", "tpm", "rpkm", "fpkm",
                     "unknown"]
 INPUT_FORMAT_LIST = Literal["fullmatrix", "mtx", "h5matrix",
@@ -0,0 +1,230 @@
+"""
+Differential expression between groups of cells
+
+Genes are streamed in chunks from the gene-major `countsT`/`normalizedT` groups
+of matrix.hdf5 and every chunk is reduced, at once for all groups, to per-gene
+counts, sums and rank sums. Zeros are never materialized: they are tied in bulk
+below (or above) the non-zero values of each gene.
+"""
+from typing import Any, Dict, List, Optional, Tuple, Union
+import numpy as np
+import pandas as pd
+from scipy import stats
+from walnut.expression import Expression, CHUNK_SIZE, transform_values
+from walnut.streaming import value_keys, average_ranks, zero_rank, map_gene_chunks
+from walnut import constants
+
+ROW_BITS = GROUP_BITS = 16 # Sort keys pack a row, a 32-bit value and a group
+
+def rank_groups(values: np.ndarray, rows: np.ndarray, group: np.ndarray, n_row: int, n_group: int,
+                n_zero: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Sums per row and group of the average ranks of the non-zero `values` among all
+    values of their row, `n_zero[row]` implicit zeros included. `rows` are sorted
+
+    Instead of sorting values row by row, (row, value, group) are packed into
+    64-bit keys sorted at once. Returns the rank sums, the rank shared by the
+    zeros of each row and the tie term `sum(t^3 - t)` of each row
+    """
+    if n_group > 1 << GROUP_BITS:
+        raise ValueError("Ranks are limited to %d groups" % (1 << GROUP_BITS))
+    n_neg = np.bincount(rows[values < 0], minlength=n_row)
+    rank_sum = np.zeros(n_row * n_group)
+    ties = n_zero.astype("float64") ** 3 - n_zero
+    keys = value_keys(values).astype("uint64") << np.uint64(GROUP_BITS) | group.astype("uint64")
+
+    row_starts = np.searchsorted(rows, np.arange(n_row + 1))
+    for lo in range(0, n_row, 1 << ROW_BITS):
+        hi = min(lo + (1 << ROW_BITS), n_row)
+        sel = slice(row_starts[lo], row_starts[hi])
+        key = (rows[sel] - lo).astype("uint64") << np.uint64(32 + GROUP_BITS) | keys[sel]
+        key.sort()
+        r = rows[sel] # Rows keep their place once sorted
+        g = (key & np.uint64((1 << GROUP_BITS) - 1)).astype("int64")
+
+        tie_row, sizes, tie_rank = average_ranks(key >> np.uint64(GROUP_BITS), r, row_starts - row_starts[lo],
+                                                 n_neg, n_zero)
+        rank_sum += np.bincount(r * n_group + g, weights=np.repeat(tie_rank, sizes), minlength=n_row * n_group)
+        ties += np.bincount(tie_row, weights=sizes.astype("float64") ** 3 - sizes, minlength=n_row)
+    return rank_sum.reshape(n_row, n_group), zero_rank(n_neg, n_zero), ties
+
+def scan_groups(data: np.ndarray, indices: np.ndarray, indptr: np.ndarray, labels: np.ndarray,
+                n_group: int, transform: constants.UNIT_TRANSFORM_LIST="log2",
+                ranks: bool=True) -> Dict[str, np.ndarray]:
+    """
+    Per-gene, per-group statistics of a genes-by-cells CSR block
+
+    `labels` holds the group of each cell, negative labels leave cells out.
+    Returns genes-by-groups arrays: non-zero counts (`nnz`), sums of the values as
+    read (`total`), sums and sums of squares of transformed values and, with `ranks`,
+    sums of the ranks of values among the cells of all groups (`rank_sum`,
+    transforms keep ranks). `ties` holds the tie term of each gene
+    """
+    n_gene = len(indptr) - 1
+    rows = np.repeat(np.arange(n_gene), np.diff(indptr))
+    group = labels[indices]
+    keep = (group >= 0) & (data != 0)
+    if not keep.all():
+        data, rows, group = data[keep], rows[keep], group[keep]
+    values = transform_values(data.astype("float64"), transform)
+
+    bins = rows * n_group + group
+    size = n_gene * n_group
+    result = {
+        "nnz": np.bincount(bins, minlength=size),
+        "total": np.bincount(bins, weights=data, minlength=size),
+        "sum": np.bincount(bins, weights=values, minlength=size),
+        "sumsq": np.bincount(bins, weights=values * values, minlength=size),
+    }
+    result = {key: value.reshape(n_gene, n_group) for key, value in result.items()}
+    if ranks:
+        n_cells = np.bincount(labels[labels >= 0], minlength=n_group)
+        n_zero = n_cells.sum() - result["nnz"].sum(axis=1)
+        rank_sum, zero_rank, result["ties"] = rank_groups(data, rows, group, n_gene, n_group, n_zero)
+        result["rank_sum"] = rank_sum + (n_cells[None, :] - result["nnz"]) * zero_rank[:, None]
+    return result
+
+def scan_chunk(positions: np.ndarray, state: Dict[str, Any]) -> Dict[str, np.ndarray]:
+    """:func:`scan_groups` of genes at `positions`, see :func:`walnut.streaming.map_gene_chunks`"""
+    block = state["expression"].read_gene_chunk(positions, unit=state["unit"])
+    return scan_groups(block.data, block.indices, block.indptr, *state["args"])
+
+def scan_expression(expression: Expression, labels: np.ndarray, gene_ids: Optional[List[str]]=None,
+                    unit: constants.UNIT_TYPE_LIST="norm", transform: constants.UNIT_TRANSFORM_LIST="log2",
+                    ranks: bool=True, chunk_size: int=CHUNK_SIZE, n_jobs: int=1) -> Dict[str, np.ndarray]:
+    """
+    :func:`scan_groups` over all genes of `gene_ids` (all genes by default).
+    With `n_jobs` > 1, chunks are read and reduced by a pool of processes
+    """
+    labels = np.asarray(labels, dtype="int64")
+    n_group = int(labels.max()) + 1 if (labels >= 0).any() else 0
+    chunks = expression.gene_chunks(gene_ids, unit=unit, chunk_size=chunk_size)
+    if len(chunks) == 0:
+        raise ValueError("No expression data found")
+
+    state = {"unit": unit, "args": (labels, n_group, transform, ranks)}
+    parts = map_gene_chunks(scan_chunk, expression, chunks, state, n_jobs=n_jobs)
+
+    result = {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+    result["n_cells"] = np.bincount(labels[labels >= 0], minlength=n_group)
+    return result
+
+def fdr_bh(p_values: np.ndarray) -> np.ndarray:
+    """Benjamini-Hochberg adjusted p-values"""
+    p_values = np.asarray(p_values, dtype="float64")
+    n = len(p_values)
+    order = np.argsort(p_values)
+    adjusted = p_values[order] * n / np.arange(1, n + 1)
+    adjusted = np.minimum.accumulate(adjusted[::-1])[::-1]
+    result = np.empty(n)
+    result[order] = np.minimum(adjusted, 1)
+    return result
+
+def compare_groups(stat_1: Dict[str, np.ndarray], stat_2: Dict[str, np.ndarray],
+                   n_1: Union[int, np.ndarray], n_2: Union[int, np.ndarray], ties: Optional[np.ndarray]=None,
+                   method: constants.DE_METHOD_LIST="wilcoxon") -> Dict[str, np.ndarray]:
+    """
+    Test genes between two groups from their per-gene statistics (one column of
+    :func:`scan_groups`). `ties` is the tie term of the cells of both groups,
+    required by the Wilcoxon test. Several pairs of groups are tested at once
+    with genes-by-pairs statistics, `n_1` and `n_2` then hold one size per pair
+
+    Returns `logFC` (log2 ratio of means of the values as read), the test
+    `statistic` (z-score or Welch t), `p_value`, and means and fractions of
+    expressing cells of both groups
+    """
+    mean_1, mean_2 = stat_1["total"] / np.maximum(n_1, 1), stat_2["total"] / np.maximum(n_2, 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if method == "wilcoxon":
+            n = n_1 + n_2
+            u = stat_1["rank_sum"] - n_1 * (n_1 + 1) / 2
+            sigma = np.sqrt(n_1 * n_2 / 12 * ((n + 1) - ties / (n * (n - 1))))
+            statistic = (u - n_1 * n_2 / 2) / sigma
+            p_value = 2 * stats.norm.sf(np.abs(statistic))
+        elif method == "t-test":
+            m_1, m_2 = stat_1["sum"] / n_1, stat_2["sum"] / n_2
+            var_1 = np.maximum(stat_1["sumsq"] - n_1 * m_1 ** 2, 0) / (n_1 - 1) / n_1
+            var_2 = np.maximum(stat_2["sumsq"] - n_2 * m_2 ** 2, 0) / (n_2 - 1) / n_2
+            statistic = (m_1 - m_2) / np.sqrt(var_1 + var_2)
+            df = (var_1 + var_2) ** 2 / (var_1 ** 2 / (n_1 - 1) + var_2 ** 2 / (n_2 - 1))
+            p_value = 2 * stats.t.sf(np.abs(statistic), df)
+        else:
+            raise ValueError("Unknown DE method: %s" % method)
+        logfc = np.log2((mean_1 + 1e-9) / (mean_2 + 1e-9))
+
+    # Constant genes
+    statistic = np.nan_to_num(statistic, nan=0)
+    p_value = np.nan_to_num(p_value, nan=1)
+    return {
+        "logFC": logfc,
+        "statistic": statistic,
+        "p_value": p_value,
+        "mean_1": mean_1,
+        "mean_2": mean_2,
+        "pct_1": stat_1["nnz"] / np.maximum(n_1, 1),
+        "pct_2": stat_2["nnz"] / np.maximum(n_2, 1),
+    }
+
+def differential_expression(expression: Expression, labels: np.ndarray, gene_ids: Optional[List[str]]=None,
+                            method: constants.DE_METHOD_LIST="wilcoxon", unit: constants.UNIT_TYPE_LIST="norm",
+                            transform: constants.UNIT_TRANSFORM_LIST="log2", chunk_size: int=CHUNK_SIZE,
+                            n_jobs: int=1) -> pd.DataFrame:
+    """
+    Test every gene between the cells labelled 0 and the cells labelled 1,
+    cells with other labels are left out
+
+    Tests run on transformed values (log2(x + 1) by default), `logFC` is
+    computed on the values as read. Returns a DataFrame indexed by gene ID with
+    `logFC`, `statistic`, `p_value`, `fdr` and the means and fractions of
+    expressing cells of both groups
+    """
+    labels = np.asarray(labels, dtype="int64")
+    labels = np.where(np.isin(labels, [0, 1]), labels, -1)
+    if not (labels == 0).any() or not (labels == 1).any():
+        raise ValueError("Both groups need at least one cell")
+    result = scan_expression(expression, labels, gene_ids, unit=unit, transform=transform,
+                             ranks=method == "wilcoxon", chunk_size=chunk_size, n_jobs=n_jobs)
+    n_1, n_2 = result.pop("n_cells")
+    ties = result.pop("ties", None)
+    columns = compare_groups({key: value[:, 0] for key, value in result.items()},
+                             {key: value[:, 1] for key, value in result.items()},
+                             int(n_1), int(n_2), ties, method)
+    df = pd.DataFrame(columns, index=pd.Index(expression.features if gene_ids is None else gene_ids))
+    df.insert(3, "fdr", fdr_bh(df["p_value"].values))
+    return df
+
+def rank_markers(expression: Expression, labels: np.ndarray, gene_ids: Optional[List[str]]=None,
+                 top_n: Optional[int]=20, method: constants.DE_METHOD_LIST="wilcoxon",
+                 unit: constants.UNIT_TYPE_LIST="norm", transform: constants.UNIT_TRANSFORM_LIST="log2",
+                 chunk_size: int=CHUNK_SIZE, n_jobs: int=1) -> pd.DataFrame:
+    """
+    Test every gene between each group of cells and the rest, cells with
+    negative labels are left out
+
+    The matrix is scanned once for all groups: statistics of the rest are those
+    of all cells minus those of the group, and ranks are shared by all groups.
+    Returns, for each non-empty group, its `top_n` genes (all with None) by
+    decreasing statistic. Columns are `group` (label), `gene` (ID), then as
+    :func:`differential_expression`, FDR being adjusted within each group
+    """
+    labels = np.asarray(labels, dtype="int64")
+    result = scan_expression(expression, labels, gene_ids, unit=unit, transform=transform,
+                             ranks=method == "wilcoxon", chunk_size=chunk_size, n_jobs=n_jobs)
+    n_cells = result.pop("n_cells")
+    ties = result.pop("ties", None)
+    rest = {key: value.sum(axis=1, keepdims=True) - value for key, value in result.items()}
+    columns = compare_groups(result, rest, n_cells, n_cells.sum() - n_cells,
+                             None if ties is None else ties[:, None], method)
+
+    genes = np.array(expression.features if gene_ids is None else gene_ids, dtype=object)
+    frames = []
+    for group in np.flatnonzero(n_cells > 0):
+        order = np.argsort(-columns["statistic"][:, group], kind="stable")[:top_n]
+        df = pd.DataFrame({key: value[order, group] for key, value in columns.items()})
+        df.insert(3, "fdr", fdr_bh(columns["p_value"][:, group])[order])
+        df.insert(0, "gene", genes[order])
+        df.insert(0, "group", group)
+        frames.append(df)
+    if len(frames) == 0:
+        raise ValueError("No group has any cell")
+    return pd.concat(frames, ignore_index=True)
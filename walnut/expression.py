@@ -1,34 +1,284 @@
-from typing import Union, List, Literal, Tuple, get_args, Any
+from typing import Union, List, Literal, Tuple, get_args, Any, Dict, Callable, Optional, Iterable, Iterator
 import os
+import zlib
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor
 import h5py
 import pandas as pd
 import numpy as np
 from scipy import sparse
-import scanpy as sc
-import anndata
-from walnut.models import ExpressionData
+from walnut.models import ExpressionData, WriteProfile, LEGACY_PROFILE
 from walnut import constants
-from anndata._core.sparse_dataset import SparseDataset
 
-class SparseExpression(SparseDataset):
+CHUNK_SIZE = 1 << 22 # entries, size of blocks when streaming a sparse group
+COALESCE_GAP = 1 << 14 # entries, neighbouring sparse slices closer than this are read at once
+GENE_STATS = ["nnz", "percent", "mean", "var", "max"]
+MIN_CHUNK_BYTES = 1 << 14
+MAX_CHUNK_BYTES = 1 << 20
+NORM_TARGET = 1e4 # total of each cell after normalization
+
+class ExpressionCache:
+    """
+    Memoize content decoded from matrix.hdf5.
+    Items stay until evicted explicitly or until the file changes on disk
+    """
+    def __init__(self, enabled: bool=True):
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.__items: Dict[str, Any] = {}
+
+    def get(self, key: str, loader: Callable[[], Any]) -> Any:
+        if key in self.__items:
+            self.hits += 1
+            return self.__items[key]
+
+        self.misses += 1
+        value = loader()
+        if self.enabled:
+            self.__items[key] = value
+        return value
+
+    def evict(self, *keys: str) -> None:
+        """Drop the given keys, or everything if no key is given"""
+        if len(keys) == 0:
+            self.__items.clear()
+            return
+        for key in keys:
+            self.__items.pop(key, None)
+
+    def keys(self) -> List[str]:
+        return list(self.__items.keys())
+
+    def info(self) -> Dict[str, Any]:
+        return {"hits": self.hits, "misses": self.misses, "keys": self.keys()}
+
+class GeneCache:
+    """
+    LRU cache of gene expression vectors, bounded in bytes
+
+    Keys are `(study path, file version, unit, gene id)`, values are
+    `(indices, data)` of the gene's non-zeros. Shared by all
+    :class:`Expression` objects through `GENE_CACHE` unless told otherwise
+    """
+    ENTRY_OVERHEAD = 200 # bytes, rough size of the key and containers
+
+    def __init__(self, max_bytes: int=256 << 20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.__items: "OrderedDict[tuple, Tuple[np.ndarray, np.ndarray]]" = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def __sizeof(cls, value: Tuple[np.ndarray, np.ndarray]) -> int:
+        return value[0].nbytes + value[1].nbytes + cls.ENTRY_OVERHEAD
+
+    def get_many(self, keys: List[tuple]) -> List[Optional[Tuple[np.ndarray, np.ndarray]]]:
+        """Look up several keys at once, None for misses"""
+        res = []
+        with self.__lock:
+            for key in keys:
+                value = self.__items.get(key)
+                if value is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    self.__items.move_to_end(key)
+                res.append(value)
+        return res
+
+    def put(self, key: tuple, value: Tuple[np.ndarray, np.ndarray]) -> None:
+        size = self.__sizeof(value)
+        if size > self.max_bytes:
+            return
+        value = (value[0].copy(), value[1].copy()) # Do not hold on to bigger buffers
+        with self.__lock:
+            if key in self.__items:
+                self.nbytes -= self.__sizeof(self.__items.pop(key))
+            self.__items[key] = value
+            self.nbytes += size
+            self.__shrink(self.max_bytes)
+
+    def __shrink(self, max_bytes: int) -> None:
+        while self.nbytes > max_bytes and len(self.__items) > 0:
+            _, value = self.__items.popitem(last=False)
+            self.nbytes -= self.__sizeof(value)
+
+    def resize(self, max_bytes: int) -> None:
+        with self.__lock:
+            self.max_bytes = max_bytes
+            self.__shrink(max_bytes)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__items.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self.__items)
+
+    def info(self) -> Dict[str, Any]:
+        return {"hits": self.hits, "misses": self.misses, "items": len(self.__items),
+                "nbytes": self.nbytes, "max_bytes": self.max_bytes}
+
+GENE_CACHE = GeneCache()
+
+class SparseExpression:
     """
-    Interface for on-disk sparse matrix from AnnData
-    Not used yet. Might be useful for big study.
+    Lazy, on-disk view of a sparse group of matrix.hdf5 (backed mode)
+
+    Nothing but `indptr` is loaded. Slicing reads only the needed columns
+    (or rows) from HDF5; sums and chunked iteration stream the group.
+    `format_str` is the major axis of the logical matrix: "csc" for groups
+    read as is, "csr" for gene-major groups (`countsT`, `normalizedT`) viewed
+    transposed as genes-by-cells. With `scale`, values read from a counts
+    group are normalized on the fly, see :func:`normalize_counts`.
     """
+    def __init__(self, group: h5py.Group, transpose: bool=False, scale: Optional[np.ndarray]=None):
+        self.group = group
+        self.indptr = group["indptr"][:]
+        self.scale = scale
+        self.__transpose = transpose
+        n_row, n_col = [int(x) for x in group["shape"][:].flatten()]
+        self.__shape = (n_col, n_row) if transpose else (n_row, n_col)
 
     @property
     def format_str(self) -> str:
-        return "csc"
+        return "csr" if self.__transpose else "csc"
 
     @property
     def shape(self) -> Tuple[int, int]:
-        shape = self.group["shape"]
-        return tuple(shape)  # type: ignore
+        return self.__shape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.group["data"].dtype if self.scale is None else self.scale.dtype
+
+    @property
+    def nnz(self) -> int:
+        return int(self.indptr[-1])
+
+    def __n_major_minor(self) -> Tuple[int, int]:
+        if self.format_str == "csc":
+            return self.__shape[1], self.__shape[0]
+        return self.__shape[0], self.__shape[1]
+
+    def __values(self, data: np.ndarray, indices: np.ndarray, indptr: np.ndarray, major: np.ndarray) -> np.ndarray:
+        """Stored values, normalized when a scale is given. Cells are the minor axis of gene-major groups"""
+        if self.scale is None:
+            return data
+        cells = indices if self.__transpose else np.repeat(major, np.diff(indptr))
+        return normalize_counts(data, cells, self.scale)
+
+    def __build(self, data, indices, indptr, n_major) -> Union[sparse.csc_matrix, sparse.csr_matrix]:
+        _, n_minor = self.__n_major_minor()
+        if self.format_str == "csc":
+            return sparse.csc_matrix((data, indices, indptr), shape=(n_minor, n_major))
+        return sparse.csr_matrix((data, indices, indptr), shape=(n_major, n_minor))
+
+    @staticmethod
+    def __to_indices(key, n: int) -> np.ndarray:
+        if isinstance(key, slice):
+            return np.arange(*key.indices(n))
+        if np.isscalar(key):
+            return np.array([key + n if key < 0 else key], dtype="int64")
+        key = np.asarray(key)
+        if key.dtype == bool:
+            return np.flatnonzero(key)
+        return np.where(key < 0, key + n, key).astype("int64")
+
+    def __getitem__(self, key) -> Union[sparse.csc_matrix, sparse.csr_matrix]:
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        major, minor = (cols, rows) if self.format_str == "csc" else (rows, cols)
+        n_major, _ = self.__n_major_minor()
+
+        major_idx = self.__to_indices(major, n_major)
+        data, indices, indptr = read_major_slices(self.group, self.indptr, major_idx)
+        data = self.__values(data, indices, indptr, major_idx)
+        mtx = self.__build(data, indices, indptr, n_major=len(major_idx))
+        if isinstance(minor, slice) and minor == slice(None):
+            return mtx
+        return mtx[minor, :] if self.format_str == "csc" else mtx[:, minor]
+
+    def chunks(self, chunk_size: int=CHUNK_SIZE):
+        """
+        Iterate over blocks of whole columns ("csc") or rows ("csr").
+        Yields `start`, `end` and the in-memory block
+        """
+        for start, end, data, indices in iter_major_chunks(self.group, self.indptr, chunk_size):
+            indptr = self.indptr[start:end + 1] - self.indptr[start]
+            data = self.__values(data, indices, indptr, np.arange(start, end))
+            yield start, end, self.__build(data, indices, indptr, n_major=end - start)
+
+    def sum(self, axis: Optional[int]=None, chunk_size: int=CHUNK_SIZE):
+        """
+        Same as `scipy.sparse.spmatrix.sum`, streamed from HDF5.
+        Sums along an axis are 2D arrays of shape (1, n) or (n, 1)
+        """
+        n_major, n_minor = self.__n_major_minor()
+        per_major_axis = 0 if self.format_str == "csc" else 1
+        total = 0.0
+        major_sum = np.zeros(n_major)
+        minor_sum = np.zeros(n_minor)
+        for start, end, data, indices in iter_major_chunks(self.group, self.indptr, chunk_size):
+            data = self.__values(data, indices, self.indptr[start:end + 1], np.arange(start, end))
+            if axis is None:
+                total += data.sum(dtype="float64")
+            elif axis == per_major_axis:
+                segment = np.repeat(np.arange(end - start), np.diff(self.indptr[start:end + 1]))
+                major_sum[start:end] = np.bincount(segment, weights=data, minlength=end - start)
+            else:
+                minor_sum += np.bincount(indices, weights=data, minlength=n_minor)
+
+        if axis is None:
+            return total
+        res = major_sum if axis == per_major_axis else minor_sum
+        return res.reshape(1, -1) if axis == 0 else res.reshape(-1, 1)
+
+    def to_memory(self) -> Union[sparse.csc_matrix, sparse.csr_matrix]:
+        n_major = self.__n_major_minor()[0]
+        indices = self.group["indices"][:]
+        data = self.__values(self.group["data"][:], indices, self.indptr, np.arange(n_major))
+        return self.__build(data, indices, self.indptr, n_major=n_major)
+
+    def __repr__(self):
+        return "<%dx%d backed %s matrix of type %s with %d stored elements>" % (
+                *self.__shape, self.format_str, self.dtype, self.nnz)
 
 class Expression:
-    def __init__(self, h5path):
+    def __init__(self, h5path, cache: bool=True, backed: bool=False, chunk_cache: Optional[int]=None,
+                 dtype: Optional[Union[str, np.dtype]]=None, gene_cache: Optional[GeneCache]=GENE_CACHE,
+                 mmap: bool=False):
+        """
+        Args:
+            h5path: path to matrix.hdf5
+            cache: memoize content read from the file
+            backed: `raw_matrix` and `norm_matrix` are lazy :class:`SparseExpression`
+                views instead of in-memory matrices, for studies that do not fit in memory
+            chunk_cache: size in bytes of the HDF5 chunk cache of each dataset,
+                worth raising for compressed files
+            dtype: type of the values of matrices read from the file. By default
+                they come as stored, e.g. uint16 counts of a compact study
+            gene_cache: where :func:`Expression.get_genes` keeps gene vectors,
+                None disables it
+            mmap: expose contiguous, unfiltered datasets as read-only `numpy.memmap`
+                instead of copying them, see `walnut.models.MMAP_PROFILE`.
+                Processes opening the same study then share the page cache
+        """
         self.path = h5path
+        self.backed = backed
+        self.chunk_cache = chunk_cache
+        self.dtype = dtype
+        self.gene_cache = gene_cache
+        self.mmap = mmap
         self.__expression_data = None
+        self.__norm_given = False # norm_matrix passed to add_expression_data, not computed
+        self.__h5file: Optional[h5py.File] = None
+        self.__h5stat: Optional[Tuple[int, int]] = None
+        self.cache = ExpressionCache(enabled=cache)
 
     def read_expression_data(self) -> None:
         """
@@ -38,10 +288,15 @@ class Expression:
             print("WARNING: No matrix.hdf5 found. This study has not been written yet")
             return
 
+        if self.backed:
+            print("WARNING: Expression is opened in backed mode, will not load all data")
+            return
+
         if self.raw_matrix is None:
             return
 
-        if self.norm_matrix is None:
+        norm_matrix = self.get_norm_matrix("csc") # ExpressionData only holds CSC
+        if norm_matrix is None:
             return
 
         if self.barcodes is None:
@@ -53,12 +308,48 @@ class Expression:
         if self.feature_type is None:
             return
 
-        self.__expression_data = ExpressionData(raw_matrix=self.raw_matrix,
-                                                norm_matrix=self.norm_matrix,
-                                                barcodes = self.barcodes,
-                                                features = self.features,
-                                                feature_type=self.feature_type)
+        self.__set_expression_data(ExpressionData(raw_matrix=self.raw_matrix,
+                                                  norm_matrix=norm_matrix,
+                                                  barcodes = self.barcodes,
+                                                  features = self.features,
+                                                  feature_type=self.feature_type))
 
+    def __open(self) -> h5py.File:
+        """
+        Return the shared read handle of matrix.hdf5.
+        The handle is reopened, and the cache dropped, when the file changes on disk
+        """
+        stat = os.stat(self.path)
+        h5stat = (stat.st_mtime_ns, stat.st_size)
+        if self.__h5file is None or h5stat != self.__h5stat:
+            self.close()
+            self.cache.evict()
+            kwargs = {} if self.chunk_cache is None else {"rdcc_nbytes": self.chunk_cache}
+            self.__h5file = h5py.File(self.path, "r", **kwargs)
+            self.__h5stat = h5stat
+        return self.__h5file
+
+    def close(self) -> None:
+        """Close the shared handle of matrix.hdf5, cached items are kept"""
+        if self.__h5file is not None:
+            self.__h5file.close()
+        self.__h5file = None
+        self.__h5stat = None
+
+    def __cached(self, key: str, loader: Callable[[h5py.File], Any]) -> Any:
+        fopen = self.__open()
+        return self.cache.get(key, lambda: loader(fopen))
+
+    def cache_info(self) -> Dict[str, Any]:
+        """Hits, misses and keys currently held by the cache"""
+        return self.cache.info()
+
+    def evict(self, *keys: str) -> None:
+        """
+        Free cached items, e.g. `expression.evict("raw_matrix")`.
+        Without arguments, the whole cache is emptied
+        """
+        self.cache.evict(*keys)
 
     @property
     def exists(self) -> bool:
@@ -76,9 +367,7 @@ class Expression:
             print("WARNING: No matrix.hdf5 found. This study has not been written yet")
             return None
 
-        with h5py.File(self.path, "r") as fopen:
-            features = self.get_1d_dataset(fopen, "bioturing/features")
-            return [x.decode() for x in features]
+        return self.__cached("features", self.__read_features)
 
 
     @property
@@ -90,9 +379,7 @@ class Expression:
             print("WARNING: No matrix.hdf5 found. This study has not been written yet")
             return None
 
-        with h5py.File(self.path, "r") as fopen:
-            barcodes = self.get_1d_dataset(fopen, "bioturing/barcodes")
-            return [x.decode() for x in barcodes]
+        return self.__cached("barcodes", self.__read_barcodes)
 
     @property
     def feature_type(self) -> Union[List[Literal[constants.FEATURE_TYPES]], None]:
@@ -103,63 +390,452 @@ class Expression:
             print("WARNING: No matrix.hdf5 found. This study has not been written yet")
             return None
 
-        with h5py.File(self.path, "r") as fopen:
-            h5bioturing = fopen["bioturing"]
+        return self.__cached("feature_type", self.__read_feature_type)
 
-            if not isinstance(h5bioturing, h5py.Group):
-                return None
+    @property
+    def raw_matrix(self) -> Union[sparse.csc_matrix, SparseExpression, None]:
+        if self.__expression_data:
+            return self.__expression_data.raw_matrix
+
+        if not self.exists:
+            print("WARNING: No matrix.hdf5 found. This study has not been written yet")
+            return None
+
+        if self.backed:
+            return self.__cached("backed/raw_matrix", lambda fopen: SparseExpression(fopen["bioturing"]))
+        return self.__cached("raw_matrix", self.__read_raw_matrix)
 
-            if "feature_type" in h5bioturing.keys(): # Old study does not have feature_type
-                feature_type = self.get_1d_dataset(fopen, "bioturing/feature_type")
-                feature_type = [x.decode() for x in feature_type] # Tolerate weird shape of feature_type
-            else :
-                print("WARNING: This study does not contain info for feature type")
-                features = self.get_1d_dataset(fopen, "bioturing/features")
-                features = [x.decode() for x in features]
-                feature_type = [self.detect_feature_type(x) for x in features]
-        return feature_type
 
     @property
-    def raw_matrix(self) -> Union[sparse.csc_matrix, None]:
+    def norm_matrix(self) -> Union[sparse.csr_matrix, sparse.csc_matrix, SparseExpression, None]:
+        """
+        Normalized genes-by-cells matrix, see :func:`Expression.get_norm_matrix`
+        """
+        return self.get_norm_matrix()
+
+    def get_norm_matrix(self, format: Optional[Literal["csr", "csc"]]=None) -> Union[sparse.csr_matrix, sparse.csc_matrix, SparseExpression, None]:
+        """
+        Normalized genes-by-cells matrix
+
+        It is stored transposed (`normalizedT`, cells-by-genes CSC), so the
+        cheapest orientation is its transpose: a CSR matrix sharing the same
+        buffers. This is what is returned unless `format` asks otherwise.
+        `format="csc"` converts once, the result is cached.
+        Studies written without `normalizedT` normalize `countsT` instead
+        """
         if self.__expression_data:
-            return self.__expression_data.raw_matrix
+            return self.__get_in_memory("norm", format or "csr")
 
         if not self.exists:
             print("WARNING: No matrix.hdf5 found. This study has not been written yet")
             return None
 
-        with h5py.File(self.path, "r") as fopen:
-            data = self.get_1d_dataset(fopen, "bioturing/data")
-            i = self.get_1d_dataset(fopen, "bioturing/indices")
-            p = self.get_1d_dataset(fopen, "bioturing/indptr")
-            shape = self.get_1d_dataset(fopen, "bioturing/shape")
+        if self.backed:
+            return self.__cached("backed/norm_matrix", self.__read_backed_norm_matrix)
+
+        if format == "csc":
+            return self.__cached("norm_matrix/csc",
+                                 lambda _: self.__cached("norm_matrix", self.__read_norm_matrix).tocsc())
+        return self.__cached("norm_matrix", self.__read_norm_matrix)
+
+    def __get_in_memory(self, unit: constants.UNIT_TYPE_LIST, format: Literal["csr", "csc"]) -> sparse.spmatrix:
+        """
+        Matrix of the expression data held in memory (CSC) in `format`.
+        Conversions are cached until new data is added
+        """
+        mtx = self.__expression_data.raw_matrix if unit == "raw" else self.__expression_data.norm_matrix
+        return self.cache.get("memory/%s_matrix/%s" % (unit, format), lambda: mtx.asformat(format))
+
+    def __set_expression_data(self, expression_data: ExpressionData) -> None:
+        """Hold new expression data, dropping conversions of the previous one"""
+        self.cache.evict(*[key for key in self.cache.keys() if key.startswith("memory/")])
+        self.__expression_data = expression_data
+
+    def __read_features(self, fopen: h5py.File) -> List[str]:
+        return decode_strings(self.get_1d_dataset(fopen, "bioturing/features")).tolist()
+
+    def __read_barcodes(self, fopen: h5py.File) -> List[str]:
+        return decode_strings(self.get_1d_dataset(fopen, "bioturing/barcodes")).tolist()
+
+    def __read_feature_type(self, fopen: h5py.File) -> Union[List[str], None]:
+        h5bioturing = fopen["bioturing"]
+
+        if not isinstance(h5bioturing, h5py.Group):
+            return None
+
+        if "feature_type" in h5bioturing.keys(): # Old study does not have feature_type
+            feature_type = self.get_1d_dataset(fopen, "bioturing/feature_type")
+            feature_type = decode_strings(feature_type).tolist() # Tolerate weird shape of feature_type
+        else :
+            print("WARNING: This study does not contain info for feature type")
+            features = self.__cached("features", self.__read_features)
+            feature_type = self.detect_feature_types(features)
+        return feature_type
+
+    def __read_array(self, fopen: h5py.File, key: str) -> np.ndarray:
+        """Memory-map a dataset if possible, read it otherwise"""
+        if self.mmap:
+            mapped = memmap_dataset(self.path, fopen[key])
+            if mapped is not None:
+                return mapped
+        return self.get_1d_dataset(fopen, key)
+
+    def __get_sparse_group(self, fopen: h5py.File, group: str) -> Union[h5py.Group, Dict[str, np.ndarray]]:
+        """
+        `data` and `indices` of a sparse group, memory-mapped if both can be.
+        Otherwise slices are read from the group, never the whole datasets
+        """
+        keys = ["data", "indices"]
+        if not self.mmap or any(mappable_offset(fopen[group][key]) is None for key in keys):
+            return fopen[group]
+        return {key: self.__cached("mmap/%s/%s" % (group, key),
+                                   lambda fopen: memmap_dataset(self.path, fopen["%s/%s" % (group, key)]))
+                    for key in keys}
+
+    def __read_raw_matrix(self, fopen: h5py.File) -> sparse.csc_matrix:
+        data = self.__read_array(fopen, "bioturing/data")
+        i = self.__read_array(fopen, "bioturing/indices")
+        p = self.__read_array(fopen, "bioturing/indptr")
+        shape = self.get_1d_dataset(fopen, "bioturing/shape")
 
         return sparse.csc_matrix(
-                (data, i, p),
+                (self.__as_dtype(data), i, p),
                 shape=shape
             )
 
+    def __read_norm_matrix(self, fopen: h5py.File) -> sparse.csr_matrix:
+        group = "countsT" if self.__derives_norm() else "normalizedT"
+        data = self.__read_array(fopen, "%s/data" % group)
+        i = self.__read_array(fopen, "%s/indices" % group)
+        p = self.__read_array(fopen, "%s/indptr" % group)
+        shape = self.get_1d_dataset(fopen, "%s/shape" % group)
+        if group == "countsT":
+            data = normalize_counts(data, i, self.__cached("norm_scale", self.__read_norm_scale))
 
-    @property
-    def norm_matrix(self) -> Union[sparse.csc_matrix, None]:
+        return sparse.csc_matrix(
+                (self.__as_dtype(data), i, p),
+                shape=shape
+            ).T # No copy, transpose of a CSC is a CSR
+
+    def __read_backed_norm_matrix(self, fopen: h5py.File) -> SparseExpression:
+        if self.__derives_norm():
+            return SparseExpression(fopen["countsT"], transpose=True,
+                                    scale=self.__cached("norm_scale", self.__read_norm_scale))
+        return SparseExpression(fopen["normalizedT"], transpose=True)
+
+    def is_mappable(self, unit: constants.UNIT_TYPE_LIST="raw") -> bool:
+        """
+        Whether `raw_matrix` (or `norm_matrix`) can be memory-mapped: its
+        `data` and `indices` are contiguous and unfiltered, see
+        `walnut.models.MMAP_PROFILE`. `indptr` is small and read anyway
+        """
+        if self.__expression_data or not self.exists:
+            return False
+        if unit == "norm" and self.__derives_norm(): # Normalized on read
+            return False
+        group = self.__open()["bioturing" if unit == "raw" else "normalizedT"]
+        return all(mappable_offset(group[key]) is not None for key in ["data", "indices"])
+
+    def __derives_norm(self) -> bool:
+        """Studies written with `WriteProfile(store_norm=False)` have no `normalizedT`"""
+        return "normalizedT" not in self.__open()
+
+    def __read_norm_scale(self, fopen: h5py.File) -> np.ndarray:
+        return get_norm_scale(self.get_1d_dataset(fopen, "colsum/raw"))
+
+    def __as_dtype(self, data: np.ndarray) -> np.ndarray:
+        return data if self.dtype is None else data.astype(self.dtype, copy=False)
+
+    def lookup_barcodes(self, barcodes: Iterable[str]) -> Union[np.ndarray, None]:
+        """
+        Positions of `barcodes` among the cells of the study, -1 for unknown ones.
+        Resolved at once against the sorted index stored in matrix.hdf5
+        """
+        return self.__lookup("barcodes", barcodes)
+
+    def lookup_features(self, features: Iterable[str]) -> Union[np.ndarray, None]:
+        """Positions of `features` among the genes of the study, -1 for unknown ones"""
+        return self.__lookup("features", features)
+
+    def __lookup(self, key: Literal["barcodes", "features"], values: Iterable[str]) -> Union[np.ndarray, None]:
+        values = list(values)
         if self.__expression_data:
-            return self.__expression_data.norm_matrix
+            sorted_keys, order = build_lookup_index(getattr(self.__expression_data, key))
+            return lookup_index(sorted_keys, order, values)
 
         if not self.exists:
             print("WARNING: No matrix.hdf5 found. This study has not been written yet")
             return None
 
-        with h5py.File(self.path, "r") as fopen:
-            data = self.get_1d_dataset(fopen, "normalizedT/data")
-            i = self.get_1d_dataset(fopen, "normalizedT/indices")
-            p = self.get_1d_dataset(fopen, "normalizedT/indptr")
-            shape = self.get_1d_dataset(fopen, "normalizedT/shape")
+        sorted_keys, order = self.__cached("index/%s" % key, lambda fopen: self.__read_lookup_index(fopen, key))
+        return lookup_index(sorted_keys, order, values)
 
-        return sparse.csc_matrix(
-                (data, i, p),
-                shape=shape
-            ).T.tocsc()
+    def __read_lookup_index(self, fopen: h5py.File, key: Literal["barcodes", "features"]) -> Tuple[np.ndarray, np.ndarray]:
+        if "index/%s" % key in fopen:
+            group = fopen["index/%s" % key]
+            return group["keys"][:], group["order"][:]
+        # Studies written before the index existed
+        reader = self.__read_barcodes if key == "barcodes" else self.__read_features
+        return build_lookup_index(self.__cached(key, reader))
+
+    def __get_gene_indices(self, gene_ids: List[str]) -> np.ndarray:
+        idx = self.lookup_features(gene_ids)
+        if idx is None: # Not written yet
+            return np.array([], dtype="int64")
+        if (idx < 0).any():
+            missing = [gene for gene, i in zip(gene_ids, idx) if i < 0]
+            raise ValueError("Genes not found in matrix.hdf5: %s" % ", ".join(missing[:10]))
+        return idx
+
+    def __read_indptr(self, group: str) -> Callable[[h5py.File], np.ndarray]:
+        return lambda fopen: self.__read_array(fopen, "%s/indptr" % group)
+
+    def get_genes(self, gene_ids: List[str], unit: constants.UNIT_TYPE_LIST="raw",
+                  transform: constants.UNIT_TRANSFORM_LIST="none") -> Union[sparse.csr_matrix, None]:
+        """
+        Read expression of a few genes without loading the whole matrix
+
+        Gene slices are read from the gene-contiguous `countsT` (raw) or
+        `normalizedT` (norm) groups. Without `normalizedT`, counts are normalized
+        as they are read. `transform="log2"` returns log2(x + 1). Returns a
+        genes-by-cells matrix whose rows follow the order of `gene_ids`
+        """
+        idx = self.__get_gene_indices(gene_ids)
+
+        if self.__expression_data:
+            mtx = self.__get_in_memory(unit, "csr")[idx, :]
+            mtx.data = transform_values(mtx.data, transform)
+            return mtx
+
+        if not self.exists:
+            print("WARNING: No matrix.hdf5 found. This study has not been written yet")
+            return None
+
+        derive = unit == "norm" and self.__derives_norm()
+        stored_unit = "raw" if derive else unit # Derived genes share cache entries with raw ones
+        group = "countsT" if stored_unit == "raw" else "normalizedT"
+        fopen = self.__open()
+        indptr = self.__cached("%s/indptr" % group, self.__read_indptr(group))
+        n_cell = len(self.__cached("barcodes", self.__read_barcodes))
+        if self.gene_cache is None:
+            data, indices, new_indptr = read_major_slices(self.__get_sparse_group(fopen, group), indptr, idx)
+        else:
+            data, indices, new_indptr = self.__read_cached_genes(fopen, group, stored_unit, gene_ids, idx, indptr)
+
+        if derive:
+            data = normalize_counts(data, indices, self.__cached("norm_scale", self.__read_norm_scale))
+        return sparse.csr_matrix((self.__as_dtype(transform_values(data, transform)), indices, new_indptr),
+                                 shape=(len(idx), n_cell))
+
+    def __read_cached_genes(self, fopen: h5py.File, group: str, unit: constants.UNIT_TYPE_LIST,
+                            gene_ids: List[str], idx: List[int],
+                            indptr: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Only genes missing from the cache are read, all at once"""
+        keys = [(self.path, self.__h5stat, unit, gene) for gene in gene_ids]
+        vectors = self.gene_cache.get_many(keys)
+        missing = sorted({i for i, vector in zip(idx, vectors) if vector is None})
+        if len(missing) > 0:
+            names = dict(zip(idx, gene_ids))
+            data, indices, new_indptr = read_major_slices(self.__get_sparse_group(fopen, group), indptr,
+                                                          np.array(missing))
+            fetched = {}
+            for j, i in enumerate(missing):
+                fetched[i] = (indices[new_indptr[j]:new_indptr[j + 1]], data[new_indptr[j]:new_indptr[j + 1]])
+                self.gene_cache.put((self.path, self.__h5stat, unit, names[i]), fetched[i])
+            vectors = [fetched[i] if vector is None else vector for i, vector in zip(idx, vectors)]
 
+        new_indptr = np.zeros(len(idx) + 1, dtype="int64")
+        np.cumsum([len(vector[0]) for vector in vectors], out=new_indptr[1:])
+        indices = np.concatenate([vector[0] for vector in vectors]) if vectors else np.array([], dtype="int32")
+        data = np.concatenate([vector[1] for vector in vectors]) if vectors else np.array([])
+        return data, indices, new_indptr
+
+    def get_cells(self, cell_indices: Union[List[int], np.ndarray], unit: constants.UNIT_TYPE_LIST="raw",
+                  transform: constants.UNIT_TRANSFORM_LIST="none") -> Union[sparse.csc_matrix, None]:
+        """
+        Read expression of a subset of cells without loading the whole matrix
+
+        Raw counts are read column by column from the CSC `bioturing` group,
+        contiguous cells being merged into single reads. Normalized values are
+        only stored gene-major (`normalizedT`), they are streamed in chunks of genes
+        and filtered. Without `normalizedT`, raw columns are read and normalized.
+        `transform="log2"` returns log2(x + 1). Returns a genes-by-cells matrix,
+        in the order of `cell_indices`
+        """
+        cell_idx = np.asarray(cell_indices, dtype="int64")
+
+        if self.__expression_data:
+            mtx = self.__get_in_memory(unit, "csc")[:, cell_idx]
+            mtx.data = transform_values(mtx.data, transform)
+            return mtx
+
+        if not self.exists:
+            print("WARNING: No matrix.hdf5 found. This study has not been written yet")
+            return None
+
+        fopen = self.__open()
+        n_gene = len(self.__cached("features", self.__read_features))
+        if unit == "raw" or self.__derives_norm():
+            indptr = self.__cached("bioturing/indptr", self.__read_indptr("bioturing"))
+            data, indices, new_indptr = read_major_slices(self.__get_sparse_group(fopen, "bioturing"), indptr,
+                                                          cell_idx)
+            if unit == "norm":
+                cells = np.repeat(cell_idx, np.diff(new_indptr))
+                data = normalize_counts(data, cells, self.__cached("norm_scale", self.__read_norm_scale))
+            return sparse.csc_matrix((self.__as_dtype(transform_values(data, transform)), indices, new_indptr),
+                                     shape=(n_gene, len(cell_idx)))
+
+        uniq, inverse = np.unique(cell_idx, return_inverse=True)
+        n_cell = len(self.__cached("barcodes", self.__read_barcodes))
+        position = np.full(n_cell, -1, dtype="int64")
+        position[uniq] = np.arange(len(uniq))
+
+        indptr = self.__cached("normalizedT/indptr", self.__read_indptr("normalizedT"))
+        rows, cols, values = [], [], []
+        for start, end, data, indices in iter_major_chunks(self.__get_sparse_group(fopen, "normalizedT"), indptr):
+            keep = position[indices] >= 0
+            genes = np.repeat(np.arange(start, end), np.diff(indptr[start:end + 1]))
+            rows.append(genes[keep])
+            cols.append(position[indices[keep]])
+            values.append(self.__as_dtype(data[keep]))
+
+        dtype = fopen["normalizedT/data"].dtype if self.dtype is None else self.dtype
+        mtx = sparse.csc_matrix((np.concatenate(values) if values else np.array([], dtype=dtype),
+                                (np.concatenate(rows) if rows else np.array([], dtype="int64"),
+                                 np.concatenate(cols) if cols else np.array([], dtype="int64"))),
+                                shape=(n_gene, len(uniq)))
+        mtx = mtx[:, inverse]
+        mtx.data = transform_values(mtx.data, transform)
+        return mtx
+
+    def gene_chunks(self, gene_ids: Optional[List[str]]=None, unit: constants.UNIT_TYPE_LIST="raw",
+                    chunk_size: int=CHUNK_SIZE) -> List[np.ndarray]:
+        """
+        Positions of genes, all of them by default, split in consecutive
+        chunks of about `chunk_size` non-zeros. See :func:`Expression.read_gene_chunk`
+        """
+        if self.__expression_data:
+            indptr = self.__get_in_memory(unit, "csr").indptr
+        elif not self.exists:
+            print("WARNING: No matrix.hdf5 found. This study has not been written yet")
+            return []
+        else:
+            group = "countsT" if unit == "raw" or self.__derives_norm() else "normalizedT"
+            indptr = self.__cached("%s/indptr" % group, self.__read_indptr(group))
+
+        idx = np.arange(len(indptr) - 1) if gene_ids is None else self.__get_gene_indices(gene_ids)
+        offsets = np.zeros(len(idx) + 1, dtype="int64")
+        np.cumsum(indptr[idx + 1] - indptr[idx], out=offsets[1:])
+        return [idx[start:end] for start, end in chunk_bounds(offsets, chunk_size)]
+
+    def read_gene_chunk(self, positions: np.ndarray, unit: constants.UNIT_TYPE_LIST="raw",
+                        transform: constants.UNIT_TRANSFORM_LIST="none") -> Union[sparse.csr_matrix, None]:
+        """
+        Same as :func:`Expression.get_genes` for genes given by position,
+        bypassing the gene cache
+        """
+        if self.__expression_data:
+            block = self.__get_in_memory(unit, "csr")[positions, :]
+            block.data = transform_values(block.data, transform)
+            return block
+
+        if not self.exists:
+            print("WARNING: No matrix.hdf5 found. This study has not been written yet")
+            return None
+
+        derive = unit == "norm" and self.__derives_norm()
+        group = "countsT" if unit == "raw" or derive else "normalizedT"
+        indptr = self.__cached("%s/indptr" % group, self.__read_indptr(group))
+        n_cell = len(self.__cached("barcodes", self.__read_barcodes))
+        data, indices, new_indptr = read_major_slices(self.__get_sparse_group(self.__open(), group), indptr, positions)
+        if derive:
+            data = normalize_counts(data, indices, self.__cached("norm_scale", self.__read_norm_scale))
+        return sparse.csr_matrix((self.__as_dtype(transform_values(data, transform)), indices, new_indptr),
+                                 shape=(len(positions), n_cell))
+
+    def iter_gene_chunks(self, gene_ids: Optional[List[str]]=None, unit: constants.UNIT_TYPE_LIST="raw",
+                         transform: constants.UNIT_TRANSFORM_LIST="none",
+                         chunk_size: int=CHUNK_SIZE) -> Iterator[Tuple[np.ndarray, sparse.csr_matrix]]:
+        """
+        Stream genes, all of them by default, about `chunk_size` non-zeros at a time.
+        Yields the positions of the genes in the study and their genes-by-cells block,
+        in the order of `gene_ids`
+        """
+        for positions in self.gene_chunks(gene_ids, unit=unit, chunk_size=chunk_size):
+            yield positions, self.read_gene_chunk(positions, unit=unit, transform=transform)
+
+    def aggregate(self, groups: np.ndarray, gene_ids: Optional[List[str]]=None,
+                  stat: constants.AGGREGATE_STAT_LIST="mean", unit: constants.UNIT_TYPE_LIST="raw",
+                  transform: constants.UNIT_TRANSFORM_LIST="none", chunk_size: int=CHUNK_SIZE,
+                  n_jobs: int=1) -> Union[np.ndarray, None]:
+        """
+        Expression summed, averaged or fraction of expressing cells per group of cells
+
+        `groups` holds the group code of each cell, negative codes leave cells out.
+        Gene chunks are multiplied by a sparse cells-by-groups indicator matrix,
+        on `n_jobs` threads. Returns a groups-by-genes array, columns follow
+        `gene_ids` (all genes by default). Groups without cells are NaN on average
+        """
+        if not self.__expression_data and not self.exists:
+            print("WARNING: No matrix.hdf5 found. This study has not been written yet")
+            return None
+
+        groups = np.asarray(groups, dtype="int64")
+        indicator = group_indicator(groups)
+        sizes = np.asarray(indicator.sum(axis=0)).reshape(-1)
+
+        columns: List[np.ndarray] = []
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            pending: deque = deque()
+            for _, block in self.iter_gene_chunks(gene_ids, unit=unit, transform=transform, chunk_size=chunk_size):
+                pending.append(executor.submit(aggregate_block, block, indicator, stat))
+                while len(pending) > 2 * n_jobs: # Bounds memory held by blocks
+                    columns.append(pending.popleft().result())
+            columns.extend(future.result() for future in pending)
+
+        result = np.hstack(columns) if columns else np.zeros((indicator.shape[1], 0))
+        if stat == "sum":
+            return result
+        mean = np.full(result.shape, np.nan)
+        np.divide(result, sizes[:, None], out=mean, where=sizes[:, None] > 0)
+        return mean
+
+    def get_gene_stats(self, unit: constants.UNIT_TYPE_LIST="raw") -> Union[pd.DataFrame, None]:
+        """
+        Per-gene number of expressing cells (`nnz`, `percent`), `mean`, `var` and `max`,
+        as a data frame indexed by features. Read from the `genestat` group,
+        studies written before it existed are scanned once
+        """
+        if self.__expression_data:
+            mtx = self.__get_in_memory(unit, "csr")
+            stats = summarize_genes(mtx.data, np.diff(mtx.indptr), mtx.shape[1])
+            return pd.DataFrame(stats, index=self.features, columns=GENE_STATS)
+
+        if not self.exists:
+            print("WARNING: No matrix.hdf5 found. This study has not been written yet")
+            return None
+
+        stats = self.__cached("genestat/%s" % unit, lambda fopen: self.__read_gene_stats(fopen, unit))
+        return pd.DataFrame(stats, index=self.features, columns=GENE_STATS)
+
+    def has_gene_stats(self, unit: constants.UNIT_TYPE_LIST="raw") -> bool:
+        """Whether matrix.hdf5 holds gene statistics of `unit`, read without a scan"""
+        if self.__expression_data or not self.exists:
+            return False
+        return "genestat/%s" % unit in self.__open()
+
+    def __read_gene_stats(self, fopen: h5py.File, unit: constants.UNIT_TYPE_LIST) -> Dict[str, np.ndarray]:
+        key = "genestat/%s" % unit
+        if key in fopen:
+            return {stat: fopen[key][stat][:] for stat in GENE_STATS}
+
+        print("WARNING: This study does not contain gene statistics, computing them")
+        derive = unit == "norm" and self.__derives_norm()
+        group = "countsT" if unit == "raw" or derive else "normalizedT"
+        indptr = self.__cached("%s/indptr" % group, self.__read_indptr(group))
+        n_cell = len(self.__cached("barcodes", self.__read_barcodes))
+        scale = self.__cached("norm_scale", self.__read_norm_scale) if derive else None
+        return scan_gene_stats(self.__get_sparse_group(fopen, group), indptr, n_cell, scale=scale)
 
     @staticmethod
     def detect_feature_type(feature: str) -> constants.FEATURE_TYPES:
@@ -168,12 +844,17 @@ class Expression:
             return prefix  # type: ignore
         return "RNA"
 
+    @staticmethod
+    def detect_feature_types(features: List[str]) -> List[constants.FEATURE_TYPES]:
+        """:func:`Expression.detect_feature_type` of many features at once"""
+        prefix = pd.Series(features, dtype=object).str.split("-", n=1).str[0]
+        return np.where(prefix.isin(get_args(constants.FEATURE_TYPES)), prefix, "RNA").tolist()
+
 
     @staticmethod
     def normalize_expression(raw_matrix: sparse.csc_matrix) -> sparse.csc_matrix:
-        adata = anndata.AnnData(raw_matrix)
-        sc.pp.normalize_total(adata, target_sum=1e4)
-        return adata.X  # type: ignore
+        """Scale each cell (column) of a genes-by-cells matrix to a total of `NORM_TARGET`"""
+        return normalize_total(sparse.csc_matrix(raw_matrix))
 
     def get_1d_dataset(self, fopen, group) -> List[Any]:
         h5data = fopen[group]
@@ -200,74 +881,899 @@ class Expression:
             norm = norm_matrix.tocsc()
 
         if feature_type is None:
-            feature_type = [self.detect_feature_type(x) for x in features]
+            feature_type = self.detect_feature_types(features)
 
-        self.__expression_data = ExpressionData(raw_matrix = raw,
-                                                norm_matrix = norm,
-                                                barcodes = barcodes,
-                                                features = features,
-                                                feature_type = feature_type)
+        self.__set_expression_data(ExpressionData(raw_matrix = raw,
+                                                  norm_matrix = norm,
+                                                  barcodes = barcodes,
+                                                  features = features,
+                                                  feature_type = feature_type))
+        self.__norm_given = norm_matrix is not None
 
 
-    def write(self) -> bool:
+    def write(self, profile: WriteProfile=LEGACY_PROFILE, n_jobs: int=1) -> bool:
+        """
+        Write matrix.hdf5. `profile` sets compression and chunk layout of the
+        sparse groups, see :class:`walnut.models.WriteProfile`.
+
+        Transposes, colsum and gzip compression of chunks run on `n_jobs`
+        threads while the calling thread writes finished buffers to the file.
+        One transpose is held at a time: the normalized one starts once
+        `countsT` is written and freed, whatever `n_jobs`
+        """
         if self.__expression_data is None:
             print("WARNING: Expression data has not been assigned")
             return False
         if self.exists:
             print("WARNING: matrix.hdf5 has been written, cannot overwrite")
             return False
+        if self.__norm_given and not profile.store_norm:
+            raise ValueError("`profile` normalizes counts on the fly, the given `norm_matrix` cannot be stored")
 
-
-        if self.raw_matrix is None:
+        if self.__expression_data.raw_matrix is None:
             return False
 
-        if self.norm_matrix is None:
+        if self.__expression_data.norm_matrix is None:
             return False
 
-        matrix = self.raw_matrix
-        with h5py.File(self.path, "w") as out_file:
+        matrix = self.__expression_data.raw_matrix
+        norm_matrix = self.__expression_data.norm_matrix
+        self.close()
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor, \
+                h5py.File(self.path, "w", **profile.file_kwargs()) as out_file:
+            # Sparse matrix have to be csc (legacy)
+            counts_t = executor.submit(lambda: matrix.transpose().tocsc())
+            colsums = executor.submit(compute_colsum, matrix, norm_matrix)
+
             write_sparse_matrix(out_file, "bioturing", matrix=matrix, barcodes=self.barcodes,
                                     features=self.features, feature_type=self.feature_type,
-                                    chunks=(min(10000, len(matrix.data)), ))
+                                    executor=executor, dtypes=get_sparse_dtypes(profile, matrix),
+                                    fixed_strings=profile.strings == "fixed",
+                                    **get_dataset_kwargs(profile, matrix, major="cell"))
 
             colsum = out_file.create_group("colsum")
-            write_array(colsum, "raw", np.array(matrix.sum(axis=0))[0])
+            for key, value in colsums.result().items():
+                write_array(colsum, key, value)
+            write_lookup_index(out_file, "barcodes", self.barcodes)
+            write_lookup_index(out_file, "features", self.features)
+
+            transposed = counts_t.result()
+            raw_stats = executor.submit(summarize_genes, transposed.data, np.diff(transposed.indptr),
+                                        transposed.shape[0])
+            write_sparse_matrix(out_file, "countsT", matrix=transposed, barcodes=self.features,
+                                    features=self.barcodes, executor=executor,
+                                    dtypes=get_sparse_dtypes(profile, transposed),
+                                    fixed_strings=profile.strings == "fixed",
+                                    **get_dataset_kwargs(profile, transposed, major="gene"))
+            raw_stats.result()
+            if not profile.store_norm:
+                # Readers normalize countsT, statistics describe what they get
+                scale = get_norm_scale(colsums.result()["raw"])
+                norm_stats = executor.submit(summarize_genes, normalize_counts(transposed.data, transposed.indices, scale),
+                                             np.diff(transposed.indptr), transposed.shape[0])
+            del transposed, counts_t # Free it before the normalized one is made
+
+            if profile.store_norm:
+                transposed = norm_matrix.transpose().tocsc()
+                norm_stats = executor.submit(summarize_genes, transposed.data, np.diff(transposed.indptr),
+                                             transposed.shape[0])
+                write_sparse_matrix(out_file, "normalizedT", matrix=transposed, barcodes=self.features,
+                                        features=self.barcodes, executor=executor,
+                                        dtypes=get_sparse_dtypes(profile, transposed, normalized=True),
+                                        fixed_strings=profile.strings == "fixed",
+                                        **get_dataset_kwargs(profile, transposed, major="gene"))
+
+            write_gene_stats(out_file, "raw", raw_stats.result())
+            write_gene_stats(out_file, "norm", norm_stats.result())
+
+        return True
+
+    def append_cells(self, raw_matrix: Union[sparse.csc_matrix, sparse.csr_matrix],
+                     barcodes: List[str],
+                     norm_matrix: Union[sparse.csc_matrix, sparse.csr_matrix, None]=None,
+                     chunk_size: int=CHUNK_SIZE) -> bool:
+        """
+        Add cells to a written matrix.hdf5
+
+        `raw_matrix` is genes-by-new cells, rows follow `features`. Every gene
+        of `countsT` and `normalizedT` gains entries, so these groups are
+        rewritten, gene range by gene range, without transposing old cells
+        again: an append reads and writes the whole file. As HDF5 does not
+        give back space of deleted datasets, the file is rebuilt next to the
+        study and swapped in once complete, keeping the size of a fresh write.
+        Resizable cell-major datasets (`bioturing`, `colsum`) are copied as
+        stored and grow by the new cells only
+        """
+        if self.__expression_data:
+            print("WARNING: Expression data has not been written yet, cannot append cells")
+            return False
+
+        if not self.exists:
+            print("WARNING: No matrix.hdf5 found. This study has not been written yet")
+            return False
+
+        n_gene = len(self.features)
+        raw = sparse.csc_matrix(raw_matrix)
+        if not raw.shape == (n_gene, len(barcodes)):
+            raise ValueError("New cells must be features-by-barcodes, got shape %s" % str(raw.shape))
+        if raw.nnz > 0 and raw.data.min() < 0:
+            raise ValueError("Raw count matrix with negative values are not supported")
+        if not len(set(barcodes)) == len(barcodes) or (self.lookup_barcodes(barcodes) >= 0).any():
+            raise ValueError("`barcodes` must be unique and not already in the study")
 
-            matrix = matrix.transpose().tocsc() # Sparse matrix have to be csc (legacy)
-            write_sparse_matrix(out_file, key="countsT", matrix=matrix, barcodes=self.features,
-                                    features=self.barcodes, chunks=(min(10000, len(matrix.data)), ))
+        derive = self.__derives_norm()
+        if derive and norm_matrix is not None:
+            raise ValueError("This study normalizes counts on the fly, `norm_matrix` cannot be stored")
+        norm = sparse.csc_matrix(self.normalize_expression(raw) if norm_matrix is None else norm_matrix)
+        if not norm.shape == raw.shape:
+            raise ValueError("Shape of raw_matrix and norm_matrix must match")
 
-            # log2 of just non-zeros
-            matrix.data = np.log2(matrix.data + 1)
+        self.close()
+        self.cache.evict()
+        tmp_path = self.path + ".tmp"
+        try:
+            with h5py.File(self.path, "r") as source, h5py.File(tmp_path, "w") as fopen:
+                old = source["bioturing"]
+                bioturing = fopen.create_group("bioturing")
+                n_entry = int(old["indptr"][-1])
+                n_cell = len(old["indptr"]) - 1 + len(barcodes)
+                extend_dataset(old, bioturing, "data", cast_counts(raw.data, old["data"].dtype), chunk_size)
+                extend_dataset(old, bioturing, "indices", raw.indices, chunk_size)
+                extend_dataset(old, bioturing, "indptr", raw.indptr[1:].astype("int64") + n_entry, chunk_size)
+                all_barcodes = decode_strings(old["barcodes"][:]).tolist() + list(barcodes)
+                fixed_strings = old["barcodes"].dtype.kind == "S"
+                write_list(bioturing, "barcodes", all_barcodes, fixed_strings=fixed_strings)
+                write_list(bioturing, "shape", [n_gene, n_cell])
+                for key in old:
+                    if key not in bioturing:
+                        source.copy(old[key], bioturing, key)
 
-            # Sum of rows for transposed mat
-            write_array(colsum, "log", np.array(matrix.sum(axis=1).reshape(-1))[0])
-            norm_matrix = self.norm_matrix
-            write_array(colsum, "lognorm", np.array(norm_matrix.sum(axis=0))[0])
-            matrix = norm_matrix.transpose().tocsc() # Sparse matrix have to be csc (legacy)
-            write_sparse_matrix(out_file, "normalizedT", matrix=matrix, barcodes=self.features,
-                                    features=self.barcodes, chunks=(min(10000, len(matrix.data)), ))
+                colsum = fopen.create_group("colsum")
+                for key, value in compute_colsum(raw, norm).items():
+                    extend_dataset(source["colsum"], colsum, key, value, chunk_size)
+                write_lookup_index(fopen, "barcodes", all_barcodes)
+                write_lookup_index(fopen, "features", self.features)
 
+                scale = get_norm_scale(colsum["raw"][:]) if derive else None
+                raw_stats, norm_stats = append_minor(source, fopen, "countsT", raw.tocsr(), all_barcodes,
+                                                     chunk_size, scale=scale)
+                if not derive:
+                    norm_stats, _ = append_minor(source, fopen, "normalizedT", norm.tocsr(), all_barcodes,
+                                                 chunk_size)
+                write_gene_stats(fopen, "raw", raw_stats)
+                write_gene_stats(fopen, "norm", norm_stats)
+                for key in source: # Anything else, as is
+                    if key not in fopen:
+                        source.copy(source[key], fopen, key)
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
         return True
 
-def write_sparse_matrix(f, key, matrix, barcodes, features, feature_type=None, **kwargs):
-    """Write sparse matrix a` la BioTuring format"""
+    def write_blocks(self, blocks: Iterable[Union[Tuple[Any, List[str]], Tuple[Any, List[str], Any]]],
+                     features: List[str],
+                     feature_type: Union[List[constants.FEATURE_TYPES], None]=None,
+                     chunk_size: int=CHUNK_SIZE,
+                     profile: WriteProfile=LEGACY_PROFILE) -> bool:
+        """
+        Write matrix.hdf5 from blocks of cells, see :class:`ExpressionWriter`
+
+        Args:
+            blocks: iterable of `(raw_matrix, barcodes)` or `(raw_matrix, barcodes, norm_matrix)`,
+                matrices are genes-by-cells
+        """
+        if self.exists:
+            print("WARNING: matrix.hdf5 has been written, cannot overwrite")
+            return False
+
+        self.close()
+        with ExpressionWriter(self.path, features, feature_type=feature_type,
+                              chunk_size=chunk_size, profile=profile) as writer:
+            for block in blocks:
+                writer.append(*block)
+        return True
+
+class ExpressionWriter:
+    """
+    Write matrix.hdf5 block by block, for studies too big to fit in memory
+
+    Blocks of cells are appended to resizable `bioturing` datasets as they come.
+    Their gene-major copies are spilled to a temporary file next to matrix.hdf5,
+    one sorted run per block, and merged into `countsT` and `normalizedT`
+    gene range by gene range on :func:`ExpressionWriter.close`. Peak memory is
+    about one block plus `chunk_size` entries. `normalizedT` is skipped when
+    the profile does not store it.
+
+    Example:
+    ```
+    with ExpressionWriter(h5path, features) as writer:
+        for raw, barcodes in blocks:
+            writer.append(raw, barcodes)
+    ```
+    """
+    def __init__(self, h5path: str, features: List[str],
+                 feature_type: Union[List[constants.FEATURE_TYPES], None]=None,
+                 chunk_size: int=CHUNK_SIZE,
+                 profile: WriteProfile=LEGACY_PROFILE):
+        if os.path.exists(h5path):
+            raise FileExistsError("%s already exists, cannot overwrite" % h5path)
+        if not len(set(features)) == len(features):
+            raise ValueError("Please make sure `features` contains no duplicates")
+        if feature_type is None:
+            feature_type = Expression.detect_feature_types(features)
+        if not len(feature_type) == len(features):
+            raise ValueError("Length of feature type and features must match")
+
+        self.path = h5path
+        self.features = list(features)
+        self.feature_type = list(feature_type)
+        self.chunk_size = chunk_size
+        self.profile = profile
+        self.n_cell = 0
+        self.__dtypes: Optional[Dict[str, np.dtype]] = None
+        self.__barcodes: List[str] = []
+        self.__barcode_set = set()
+        self.__runs: List[Tuple[int, np.ndarray]] = [] # (first cell, gene indptr) of each run
+        self.__tmp_path = h5path + ".tmp"
+        self.__out = h5py.File(self.path, "w", **profile.file_kwargs())
+        self.__tmp = h5py.File(self.__tmp_path, "w")
+        self.__bioturing = self.__out.create_group("bioturing")
+        self.__colsum: Dict[str, List[np.ndarray]] = {"raw": [], "log": [], "lognorm": []}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def __append_dataset(self, key: str, value: np.ndarray, **kwargs) -> None:
+        if key not in self.__bioturing:
+            kwargs = {"chunks": (10000,), **kwargs}
+            self.__bioturing.create_dataset(key, data=value, maxshape=(None,), **kwargs)
+            return
+        h5data = self.__bioturing[key]
+        n = h5data.shape[0]
+        h5data.resize((n + len(value),))
+        h5data[n:] = value
+
+    def append(self, raw_matrix: Union[sparse.csc_matrix, sparse.csr_matrix], barcodes: List[str],
+               norm_matrix: Union[sparse.csc_matrix, sparse.csr_matrix, None]=None) -> None:
+        """Append a genes-by-cells block of cells"""
+        raw = raw_matrix.tocsc()
+        if not raw.shape == (len(self.features), len(barcodes)):
+            raise ValueError("Block must be features-by-barcodes, got shape %s" % str(raw.shape))
+        if raw.nnz > 0 and raw.data.min() < 0:
+            raise ValueError("Raw count matrix with negative values are not supported")
+        if not len(set(barcodes)) == len(barcodes) or not self.__barcode_set.isdisjoint(barcodes):
+            raise ValueError("`barcodes` must be a list of unique values")
+        if norm_matrix is not None and not self.profile.store_norm:
+            raise ValueError("`profile` normalizes counts on the fly, the given `norm_matrix` cannot be stored")
+        self.__barcode_set.update(barcodes)
+        self.__barcodes.extend(barcodes)
+
+        norm = Expression.normalize_expression(raw) if norm_matrix is None else norm_matrix
+        norm = sparse.csc_matrix(norm)
+        if not norm.shape == raw.shape:
+            raise ValueError("Shape of raw_matrix and norm_matrix must match")
+
+        dtypes = self.__get_dtypes(raw)
+        raw.data = raw.data.astype(dtypes.get("data", raw.data.dtype), copy=False)
+        raw.indices = raw.indices.astype(dtypes.get("indices", raw.indices.dtype), copy=False)
+        norm.data = norm.data.astype(dtypes.get("norm", norm.data.dtype), copy=False)
+
+        # Cell-major data goes straight to the output
+        n_entry = self.__bioturing["data"].shape[0] if "data" in self.__bioturing else 0
+        indptr = raw.indptr[1:] + n_entry if self.n_cell > 0 else raw.indptr + n_entry
+        # Layout is tuned on the first block, the best estimate available.
+        # Resizable datasets have to be chunked
+        kwargs = get_dataset_kwargs(self.profile, raw, major="cell")
+        kwargs["chunks"] = kwargs.get("chunks", (min(max(raw.nnz, 1), MAX_CHUNK_BYTES // 8),))
+        self.__append_dataset("data", raw.data, **kwargs)
+        self.__append_dataset("indices", raw.indices, **kwargs)
+        self.__append_dataset("indptr", indptr.astype("int64"))
+
+        for key, value in compute_colsum(raw, norm).items():
+            self.__colsum[key].append(value)
+
+        # Gene-major copies are spilled as one sorted run
+        run = self.__tmp.create_group("run_%d" % len(self.__runs))
+        spilled = [("counts", raw.tocsr())]
+        if self.profile.store_norm:
+            spilled.append(("norm", norm.tocsr()))
+        for key, mtx in spilled:
+            write_array(run, "%s/data" % key, mtx.data)
+            write_array(run, "%s/indices" % key, mtx.indices)
+            write_array(run, "%s/indptr" % key, mtx.indptr.astype("int64"))
+        self.__runs.append((self.n_cell, np.vstack([mtx.indptr for _, mtx in spilled]).astype("int64")))
+        self.n_cell += raw.shape[1]
+
+    def __get_dtypes(self, raw: sparse.csc_matrix) -> Dict[str, np.dtype]:
+        """
+        Storage types under a compact profile. They are picked on the first block,
+        counts get at least uint32 as later blocks are unknown
+        """
+        if self.profile.dtypes == "keep":
+            return {}
+        counts_dtype = compact_counts_dtype(raw.data)
+        if self.__dtypes is None:
+            if counts_dtype.kind == "u":
+                counts_dtype = np.promote_types(counts_dtype, "uint32")
+            self.__dtypes = {"data": counts_dtype, "indices": compact_index_dtype(len(self.features)),
+                             "norm": np.dtype("float32")}
+        elif not np.can_cast(counts_dtype, self.__dtypes["data"]):
+            raise ValueError("Block values do not fit in %s, chosen from the first block" % self.__dtypes["data"])
+        return self.__dtypes
+
+    def __merge_runs(self, key: str, out_key: str, run_index: int) -> Dict[str, np.ndarray]:
+        """
+        k-way merge of the sorted runs into one gene-major group.
+        Returns per-gene statistics, computed on the way
+        """
+        n_gene = len(self.features)
+        indptr = np.sum([run_indptr[run_index] for _, run_indptr in self.__runs], axis=0)
+        dtype = self.__tmp["run_0/%s/data" % key].dtype
+
+        group = self.__out.create_group(out_key)
+        index_dtype = "int32" if self.n_cell < 2**31 else "int64"
+        kwargs = get_dataset_kwargs(self.profile, int(indptr[-1]), n_gene,
+                                    itemsize=max(np.dtype(dtype).itemsize, np.dtype(index_dtype).itemsize),
+                                    major="gene")
+        h5data = group.create_dataset("data", shape=(indptr[-1],), dtype=dtype, **kwargs)
+        h5indices = group.create_dataset("indices", shape=(indptr[-1],), dtype=index_dtype, **kwargs)
+        write_array(group, "indptr", indptr,
+                    dtype=compact_index_dtype(indptr[-1]) if self.profile.dtypes == "compact" else None)
+        write_list(group, "barcodes", self.features, fixed_strings=self.profile.strings == "fixed")
+        write_list(group, "features", self.__barcodes, fixed_strings=self.profile.strings == "fixed")
+        write_list(group, "shape", [self.n_cell, n_gene])
+
+        stats: List[Dict[str, np.ndarray]] = []
+        start = 0
+        while start < n_gene:
+            end = int(np.searchsorted(indptr, indptr[start] + self.chunk_size, side="right")) - 1
+            end = min(max(end, start + 1), n_gene)
+            genes, data, indices = [], [], []
+            for i, (first_cell, run_indptr) in enumerate(self.__runs):
+                p = run_indptr[run_index]
+                run = self.__tmp["run_%d/%s" % (i, key)]
+                genes.append(np.repeat(np.arange(start, end), np.diff(p[start:end + 1])))
+                data.append(run["data"][p[start]:p[end]])
+                indices.append(run["indices"][p[start]:p[end]].astype(index_dtype) + first_cell)
+            # Runs are ordered by cells, a stable sort by gene keeps cells sorted
+            order = np.argsort(np.concatenate(genes), kind="stable")
+            chunk_data = np.concatenate(data)[order]
+            h5data[indptr[start]:indptr[end]] = chunk_data
+            h5indices[indptr[start]:indptr[end]] = np.concatenate(indices)[order]
+            stats.append(summarize_genes(chunk_data, np.diff(indptr[start:end + 1]), self.n_cell))
+            start = end
+
+        return {key: np.concatenate([x[key] for x in stats]) for key in GENE_STATS}
+
+    def close(self) -> None:
+        """Build gene-major groups and colsum, then finalize matrix.hdf5"""
+        if self.n_cell == 0:
+            self.abort()
+            raise ValueError("No cells were written")
+
+        fixed_strings = self.profile.strings == "fixed"
+        # Barcodes are written at once, the width of fixed strings is only known now
+        write_list(self.__bioturing, "barcodes", self.__barcodes, fixed_strings=fixed_strings)
+        write_list(self.__bioturing, "features", self.features, fixed_strings=fixed_strings)
+        write_list(self.__bioturing, "feature_type", self.feature_type, fixed_strings=fixed_strings)
+        write_list(self.__bioturing, "shape", [len(self.features), self.n_cell])
+        if self.profile.layout == "contiguous":
+            # Appended datasets had to be chunked, lay them out for memory mapping
+            for key in ["data", "indices"]:
+                make_contiguous(self.__bioturing, key, self.chunk_size)
 
+        colsum = self.__out.create_group("colsum")
+        for key, values in self.__colsum.items():
+            write_array(colsum, key, np.concatenate(values))
+        write_lookup_index(self.__out, "barcodes", self.__barcodes)
+        write_lookup_index(self.__out, "features", self.features)
+
+        write_gene_stats(self.__out, "raw", self.__merge_runs("counts", "countsT", 0))
+        if self.profile.store_norm:
+            norm_stats = self.__merge_runs("norm", "normalizedT", 1)
+        else:
+            counts_t = self.__out["countsT"]
+            norm_stats = scan_gene_stats(counts_t, counts_t["indptr"][:], self.n_cell,
+                                         scale=get_norm_scale(colsum["raw"][:]))
+        write_gene_stats(self.__out, "norm", norm_stats)
+
+        self.__out.close()
+        self.__tmp.close()
+        os.remove(self.__tmp_path)
+
+    def abort(self) -> None:
+        """Discard everything written so far"""
+        self.__out.close()
+        self.__tmp.close()
+        for path in [self.path, self.__tmp_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+def append_minor(source: h5py.File, out: h5py.File, key: str, new: sparse.csr_matrix, barcodes: List[str],
+                 chunk_size: int=CHUNK_SIZE, scale: Optional[np.ndarray]=None) -> Tuple[Dict[str, np.ndarray], Optional[Dict[str, np.ndarray]]]:
+    """
+    Write a gene-major group of `source` to `out` with new cells, `new` being
+    genes-by-new cells. New cells come last, so each gene is its old entries
+    followed by its new ones: the group is copied gene range by gene range,
+    no sort needed.
+    Returns per-gene statistics, and those of counts normalized by `scale` if given
+    """
+    old = source[key]
+    old_indptr = old["indptr"][:]
+    n_old_cell, n_gene = [int(x) for x in old["shape"][:]]
+    n_cell = n_old_cell + new.shape[1]
+    indptr = old_indptr.astype("int64") + new.indptr
+    index_dtype = np.promote_types(old["indices"].dtype, compact_index_dtype(n_cell))
+
+    group = out.create_group(key)
+    h5data = group.create_dataset("data", shape=(indptr[-1],), dtype=old["data"].dtype,
+                                  **dataset_kwargs_like(old["data"]))
+    h5indices = group.create_dataset("indices", shape=(indptr[-1],), dtype=index_dtype,
+                                     **dataset_kwargs_like(old["indices"]))
+    new_data = cast_counts(new.data, old["data"].dtype)
+
+    stats, norm_stats = [], []
+    for start, end, data, indices in iter_major_chunks(old, old_indptr, chunk_size):
+        lengths = np.diff(indptr[start:end + 1])
+        new_slice = slice(new.indptr[start], new.indptr[end])
+        genes = np.concatenate([np.repeat(np.arange(start, end), np.diff(old_indptr[start:end + 1])),
+                                np.repeat(np.arange(start, end), np.diff(new.indptr[start:end + 1]))])
+        order = np.argsort(genes, kind="stable") # Old entries of a gene stay ahead of new ones
+        chunk_data = np.concatenate([data, new_data[new_slice]])[order]
+        chunk_indices = np.concatenate([indices.astype(index_dtype),
+                                        new.indices[new_slice].astype(index_dtype) + n_old_cell])[order]
+        h5data[indptr[start]:indptr[end]] = chunk_data
+        h5indices[indptr[start]:indptr[end]] = chunk_indices
+        stats.append(summarize_genes(chunk_data, lengths, n_cell))
+        if scale is not None:
+            norm_stats.append(summarize_genes(normalize_counts(chunk_data, chunk_indices, scale), lengths, n_cell))
+
+    write_array(group, "indptr", indptr, dtype=np.promote_types(old_indptr.dtype, compact_index_dtype(indptr[-1])))
+    fixed_strings = old["features"].dtype.kind == "S"
+    group.copy(old["barcodes"], "barcodes") # Features, unchanged
+    write_list(group, "features", barcodes, fixed_strings=fixed_strings)
+    write_list(group, "shape", [n_cell, n_gene])
+
+    merge = lambda items: {stat: np.concatenate([x[stat] for x in items]) for stat in GENE_STATS}
+    return merge(stats), merge(norm_stats) if scale is not None else None
+
+def extend_dataset(source: h5py.Group, out: h5py.Group, key: str, value: np.ndarray,
+                   chunk_size: int=CHUNK_SIZE) -> None:
+    """
+    Write a 1D numeric dataset of `source` to `out`, followed by `value`.
+    Resizable datasets are copied as stored and resized. Others, or those whose
+    type cannot hold the new values, are copied `chunk_size` entries at a time,
+    as resizable ones if chunked
+    """
+    h5data = source[key]
+    dtype = h5data.dtype
+    if dtype.kind in {"u", "i"} and len(value) > 0 and value.max() > np.iinfo(dtype).max:
+        dtype = np.promote_types(dtype, value.dtype)
+
+    n = h5data.shape[0]
+    if h5data.maxshape[0] is None and dtype == h5data.dtype:
+        source.copy(h5data, out, key)
+        out_data = out[key]
+        out_data.resize((n + len(value),))
+    else:
+        kwargs = dataset_kwargs_like(h5data)
+        if h5data.chunks is not None:
+            kwargs["maxshape"] = (None,)
+        out_data = out.create_dataset(key, shape=(n + len(value),), dtype=dtype, **kwargs)
+        for start in range(0, n, chunk_size):
+            end = min(start + chunk_size, n)
+            out_data[start:end] = h5data[start:end]
+    out_data[n:] = np.asarray(value).astype(dtype, copy=False)
+
+def make_contiguous(group: h5py.Group, key: str, chunk_size: int=CHUNK_SIZE) -> None:
+    """Rewrite a chunked 1D dataset contiguous and unfiltered, `chunk_size` entries at a time"""
+    h5data = group[key]
+    out = group.create_dataset(key + ".contiguous", shape=h5data.shape, dtype=h5data.dtype)
+    for start in range(0, h5data.shape[0], chunk_size):
+        out[start:start + chunk_size] = h5data[start:start + chunk_size]
+    del group[key]
+    group.move(key + ".contiguous", key)
+
+def dataset_kwargs_like(h5data: h5py.Dataset) -> dict:
+    """Layout and filters of an existing dataset, for `h5py.Group.create_dataset`"""
+    if h5data.chunks is None:
+        return {}
+    kwargs = {"chunks": h5data.chunks, "compression": h5data.compression, "shuffle": h5data.shuffle}
+    if h5data.compression == "gzip":
+        kwargs["compression_opts"] = h5data.compression_opts
+    return kwargs
+
+def cast_counts(values: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    """Cast new counts to the storage type of a study, refusing to alter them"""
+    cast = values.astype(dtype, copy=False)
+    if dtype.kind in {"u", "i"} and not np.array_equal(cast, values):
+        raise ValueError("New values do not fit in %s, the storage type of this study" % dtype)
+    return cast
+
+def read_major_slices(group: h5py.Group, indptr: np.ndarray, positions: np.ndarray,
+                      max_gap: int=COALESCE_GAP) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Read some columns of an on-disk CSC group (or rows of a CSR one)
+
+    Only `indptr` is required in memory. Slices that are at most `max_gap`
+    entries apart are merged into a single HDF5 read. Returns `data`, `indices`
+    and `indptr` of the selected slices, in the order of `positions`
+    """
+    positions = np.asarray(positions, dtype="int64")
+    h5data, h5indices = group["data"], group["indices"]
+    lengths = indptr[positions + 1] - indptr[positions]
+    new_indptr = np.zeros(len(positions) + 1, dtype="int64")
+    np.cumsum(lengths, out=new_indptr[1:])
+
+    uniq = np.unique(positions)
+    starts, ends = indptr[uniq], indptr[uniq + 1]
+    if len(uniq) == 0 or new_indptr[-1] == 0:
+        return (np.array([], dtype=h5data.dtype), np.array([], dtype=h5indices.dtype), new_indptr)
+
+    # Group slices into runs, each run is one HDF5 read
+    new_run = np.ones(len(uniq), dtype=bool)
+    new_run[1:] = (starts[1:] - ends[:-1]) > max_gap
+    run_id = np.cumsum(new_run) - 1
+    run_starts = starts[new_run]
+    run_ends = np.maximum.reduceat(ends, np.flatnonzero(new_run))
+    run_offsets = np.zeros(len(run_starts) + 1, dtype="int64")
+    np.cumsum(run_ends - run_starts, out=run_offsets[1:])
+
+    buf_data = np.empty(run_offsets[-1], dtype=h5data.dtype)
+    buf_indices = np.empty(run_offsets[-1], dtype=h5indices.dtype)
+    for run_start, run_end, offset in zip(run_starts, run_ends, run_offsets):
+        if run_end > run_start:
+            buf_data[offset:offset + run_end - run_start] = h5data[run_start:run_end]
+            buf_indices[offset:offset + run_end - run_start] = h5indices[run_start:run_end]
+
+    # Gather requested slices from the buffers
+    buf_starts = run_offsets[run_id] + (starts - run_starts[run_id])
+    req_starts = buf_starts[np.searchsorted(uniq, positions)]
+    take = np.repeat(req_starts - new_indptr[:-1], lengths) + np.arange(new_indptr[-1])
+    return buf_data[take], buf_indices[take], new_indptr
+
+def chunk_bounds(indptr: np.ndarray, chunk_size: int=CHUNK_SIZE) -> Iterator[Tuple[int, int]]:
+    """Split the slices of an `indptr` into ranges `[start, end)` of about `chunk_size` entries"""
+    n_major = len(indptr) - 1
+    start = 0
+    while start < n_major:
+        end = int(np.searchsorted(indptr, indptr[start] + chunk_size, side="right")) - 1
+        end = min(max(end, start + 1), n_major)
+        yield start, end
+        start = end
+
+def iter_major_chunks(group: h5py.Group, indptr: np.ndarray, chunk_size: int=CHUNK_SIZE):
+    """
+    Stream an on-disk CSC group (or CSR) by blocks of whole columns (or rows)
+
+    Each block holds about `chunk_size` entries. Yields the range `[start, end)`
+    of the block along the major axis together with its `data` and `indices`
+    """
+    for start, end in chunk_bounds(indptr, chunk_size):
+        first, last = indptr[start], indptr[end]
+        yield start, end, group["data"][first:last], group["indices"][first:last]
+
+def group_indicator(groups: np.ndarray) -> sparse.csr_matrix:
+    """Cells-by-groups 0/1 matrix of group codes, cells with negative codes belong to none"""
+    cells = np.flatnonzero(groups >= 0)
+    n_group = int(groups.max()) + 1 if len(cells) > 0 else 0
+    return sparse.csr_matrix((np.ones(len(cells), dtype="float64"), (cells, groups[cells])),
+                             shape=(len(groups), n_group))
+
+def aggregate_block(block: sparse.csr_matrix, indicator: sparse.csr_matrix,
+                    stat: constants.AGGREGATE_STAT_LIST="sum") -> np.ndarray:
+    """Sum, or count of non-zeros for "fraction_expressed", of a genes-by-cells block per group"""
+    if stat == "fraction_expressed":
+        block = sparse.csr_matrix(((block.data != 0).astype("float64"), block.indices, block.indptr),
+                                  shape=block.shape)
+    return (block @ indicator).T.toarray()
+
+def mappable_offset(dataset: h5py.Dataset) -> Optional[int]:
+    """
+    Offset in the file of a 1D dataset stored contiguous and unfiltered,
+    None if the dataset cannot be mapped
+    """
+    if dataset.ndim != 1 or dataset.dtype.kind not in {"u", "i", "f"} or dataset.size == 0:
+        return None
+    if dataset.id.get_create_plist().get_layout() != h5py.h5d.CONTIGUOUS:
+        return None
+    if dataset.id.get_create_plist().get_nfilters() > 0 or dataset.external:
+        return None
+    return dataset.id.get_offset()
+
+def memmap_dataset(path: str, dataset: h5py.Dataset) -> Optional[np.memmap]:
+    """Read-only memory map of a dataset, None if it cannot be mapped, see `mappable_offset`"""
+    offset = mappable_offset(dataset)
+    if offset is None:
+        return None
+    return np.memmap(path, mode="r", dtype=dataset.dtype, offset=offset, shape=dataset.shape)
+
+def tune_chunk_size(nnz: int, n_major: int, itemsize: int, sliced: bool) -> int:
+    """
+    Pick the chunk size, in entries, of `data` and `indices` of a sparse group
+
+    Groups that are read slice by slice get chunks of a few average slices, so
+    that one slice touches one or two chunks. Groups that are read in full or
+    streamed get the largest chunks
+    """
+    nbytes = 4 * itemsize * nnz / max(n_major, 1) if sliced else MAX_CHUNK_BYTES
+    nbytes = min(max(nbytes, MIN_CHUNK_BYTES), MAX_CHUNK_BYTES)
+    return int(max(1, min(nnz, nbytes // itemsize)))
+
+def get_dataset_kwargs(profile: WriteProfile, matrix: Union[sparse.spmatrix, int], n_major: Optional[int]=None,
+                       itemsize: Optional[int]=None, major: Literal["gene", "cell"]="cell") -> dict:
+    """
+    `create_dataset` arguments of `data` and `indices` of a sparse group
+    whose major axis is `major`. Pass a matrix, or its `nnz`, `n_major` and `itemsize`
+    """
+    if sparse.issparse(matrix):
+        nnz = matrix.nnz
+        n_major = matrix.shape[1] if matrix.format == "csc" else matrix.shape[0]
+        itemsize = max(matrix.data.dtype.itemsize, matrix.indices.dtype.itemsize)
+    else:
+        nnz = int(matrix)
+    if nnz == 0 or profile.layout == "contiguous": # Chunks cannot be empty, store contiguous
+        return {}
+    chunk_size = profile.chunk_size or tune_chunk_size(nnz, n_major, itemsize, sliced=profile.access == major)
+    return {"chunks": (min(chunk_size, nnz), ), **profile.filter_kwargs()}
+
+def compact_counts_dtype(data: np.ndarray) -> np.dtype:
+    """Smallest unsigned integer type holding `data`, if it is made of non-negative integers"""
+    if data.dtype.kind not in {"u", "i", "f"}:
+        return data.dtype
+    if len(data) == 0:
+        return np.dtype("uint8")
+    if data.dtype.kind == "f" and not np.array_equal(data, np.floor(data)):
+        return data.dtype
+    if data.min() < 0:
+        return data.dtype
+    max_value = data.max()
+    for dtype in ["uint8", "uint16", "uint32"]:
+        if max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return data.dtype
+
+def compact_index_dtype(max_value: int) -> np.dtype:
+    return np.dtype("int32") if max_value < 2**31 else np.dtype("int64")
+
+def get_sparse_dtypes(profile: WriteProfile, matrix: sparse.spmatrix, normalized: bool=False) -> Dict[str, np.dtype]:
+    """Storage types of `data`, `indices` and `indptr` of a sparse group under `profile`"""
+    if profile.dtypes == "keep":
+        return {}
+    return {
+        "data": np.dtype("float32") if normalized else compact_counts_dtype(matrix.data),
+        "indices": compact_index_dtype(max(matrix.shape)),
+        "indptr": compact_index_dtype(matrix.nnz),
+    }
+
+def summarize_genes(data: np.ndarray, lengths: np.ndarray, n_cell: int) -> Dict[str, np.ndarray]:
+    """
+    Statistics of consecutive genes given their concatenated non-zero values
+    and the number of non-zeros of each gene. Variance is unbiased (ddof=1)
+    """
+    segment = np.repeat(np.arange(len(lengths)), lengths)
+    data = data.astype("float64", copy=False)
+    total = np.bincount(segment, weights=data, minlength=len(lengths))
+    total_sq = np.bincount(segment, weights=data * data, minlength=len(lengths))
+    mean = total / n_cell
+    var = (total_sq - n_cell * mean * mean) / max(n_cell - 1, 1)
+
+    max_value = np.zeros(len(lengths))
+    nonempty = lengths > 0
+    if nonempty.any():
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        max_value[nonempty] = np.maximum.reduceat(data, starts[nonempty])
+    max_value = np.where(lengths < n_cell, np.maximum(max_value, 0), max_value) # Implicit zeros
+
+    return {
+        "nnz": lengths.astype("int64"),
+        "percent": lengths * 100 / max(n_cell, 1),
+        "mean": mean,
+        "var": np.maximum(var, 0),
+        "max": max_value,
+    }
+
+def write_gene_stats(f, unit: constants.UNIT_TYPE_LIST, stats: Dict[str, np.ndarray]) -> None:
+    group = f.require_group("genestat").create_group(unit)
+    for key in GENE_STATS:
+        write_array(group, key, stats[key])
+
+def compute_colsum(raw_matrix: sparse.csc_matrix, norm_matrix: sparse.spmatrix) -> Dict[str, np.ndarray]:
+    """Per-cell sums of raw counts, log2(counts + 1) and normalized values"""
+    raw = raw_matrix.tocsc()
+    cells = np.repeat(np.arange(raw.shape[1]), np.diff(raw.indptr))
+    return {
+        "raw": np.asarray(raw.sum(axis=0)).reshape(-1),
+        "log": np.bincount(cells, weights=np.log2(raw.data + 1), minlength=raw.shape[1]),
+        "lognorm": np.asarray(norm_matrix.sum(axis=0)).reshape(-1),
+    }
+
+def normalize_total(matrix: sparse.csc_matrix, target_sum: float=NORM_TARGET,
+                    inplace: bool=False) -> sparse.csc_matrix:
+    """
+    Scale each column (cell) of a CSC matrix to a total of `target_sum`, as
+    `scanpy.pp.normalize_total` does on cells-by-genes data. Integral counts
+    come out as float32. `inplace` reuses the buffers of float matrices
+    """
+    dtype = matrix.dtype if matrix.dtype.kind == "f" else np.dtype("float32")
+    totals = np.asarray(matrix.sum(axis=0, dtype="float64")).reshape(-1)
+    scale = np.zeros(len(totals), dtype=dtype)
+    np.divide(target_sum, totals, out=scale, where=totals > 0, casting="unsafe")
+    factors = np.repeat(scale, np.diff(matrix.indptr))
+    if inplace and matrix.dtype.kind == "f":
+        matrix.data *= factors
+        return matrix
+    return sparse.csc_matrix((np.multiply(matrix.data, factors, dtype=dtype), matrix.indices.copy(),
+                              matrix.indptr.copy()), shape=matrix.shape)
+
+def get_norm_scale(library_size: np.ndarray) -> np.ndarray:
+    """Per-cell factors bringing the total of each cell to `NORM_TARGET`"""
+    library_size = np.asarray(library_size, dtype="float64")
+    scale = np.zeros(len(library_size), dtype="float32")
+    np.divide(NORM_TARGET, library_size, out=scale, where=library_size > 0, casting="unsafe")
+    return scale
+
+def normalize_counts(data: np.ndarray, cells: np.ndarray, scale: np.ndarray) -> np.ndarray:
+    """
+    Normalize the counts `data` of a sparse slice, `cells` being the cell of
+    each entry and `scale` the output of :func:`get_norm_scale`.
+    Same as :func:`Expression.normalize_expression`, in float32
+    """
+    return np.multiply(data, scale[cells], dtype="float32")
+
+def transform_values(data: np.ndarray, transform: constants.UNIT_TRANSFORM_LIST="none") -> np.ndarray:
+    """Apply a unit transform to stored values, "log2" is log2(x + 1)"""
+    if transform == "none":
+        return data
+    values = np.asarray(data, dtype=np.result_type(data.dtype, np.float32)) + 1
+    return np.log2(values, out=values)
+
+def scan_gene_stats(group: Union[h5py.Group, Dict[str, np.ndarray]], indptr: np.ndarray, n_cell: int,
+                    scale: Optional[np.ndarray]=None) -> Dict[str, np.ndarray]:
+    """
+    Per-gene statistics of a gene-major group, streamed.
+    With `scale`, counts are normalized first, see :func:`normalize_counts`
+    """
+    stats = []
+    for start, end, data, indices in iter_major_chunks(group, indptr):
+        if scale is not None:
+            data = normalize_counts(data, indices, scale)
+        stats.append(summarize_genes(data, np.diff(indptr[start:end + 1]), n_cell))
+    return {stat: np.concatenate([x[stat] for x in stats]) for stat in GENE_STATS}
+
+def encode_chunk(value: np.ndarray, chunk_size: int, level: Optional[int], shuffle: bool,
+                 dtype: Optional[np.dtype]=None) -> bytes:
+    """Apply the HDF5 shuffle and deflate filters to one chunk, as the library would"""
+    if dtype is not None:
+        value = value.astype(dtype, copy=False)
+    if len(value) < chunk_size: # Edge chunks are stored full size
+        value = np.concatenate([value, np.zeros(chunk_size - len(value), dtype=value.dtype)])
+    value = np.ascontiguousarray(value)
+    if shuffle:
+        buf = value.view(np.uint8).reshape(len(value), value.dtype.itemsize).T.tobytes()
+    else:
+        buf = value.tobytes()
+    return zlib.compress(buf, 4 if level is None else level)
+
+def write_array_parallel(f, key, value: np.ndarray, executor: Executor, chunks: Tuple[int],
+                         dtype: Optional[np.dtype]=None, **kwargs):
+    """
+    Same as :func:`write_array` for gzip-compressed 1D arrays, chunks are
+    compressed by `executor` and written as they are ready, in order
+    """
+    chunk_size = chunks[0]
+    dtype = value.dtype if dtype is None else np.dtype(dtype)
+    h5data = f.create_dataset(key, shape=value.shape, dtype=dtype, chunks=chunks, **kwargs)
+    n_ahead = 4 * getattr(executor, "_max_workers", 1) # Bounds memory held by encoded chunks
+    pending: deque = deque()
+    for offset in range(0, len(value), chunk_size):
+        pending.append((offset, executor.submit(encode_chunk, value[offset:offset + chunk_size], chunk_size,
+                                                 kwargs.get("compression_opts"), kwargs.get("shuffle", False),
+                                                 dtype)))
+        while len(pending) > n_ahead or (offset + chunk_size >= len(value) and pending):
+            chunk_offset, future = pending.popleft()
+            h5data.id.write_direct_chunk((chunk_offset, ), future.result())
+
+def write_sparse_matrix(f, key, matrix, barcodes, features, feature_type=None,
+                        executor: Optional[Executor]=None, dtypes: Optional[Dict[str, np.dtype]]=None,
+                        fixed_strings: bool=False, **kwargs):
+    """
+    Write sparse matrix a` la BioTuring format.
+    `dtypes` optionally sets the storage types of `data`, `indices` and `indptr`,
+    `fixed_strings` stores string lists as fixed-width ASCII
+    """
+    dtypes = dtypes or {}
     group = f.create_group(key)
-    write_array(group, "data", matrix.data, **kwargs)
-    write_array(group, "indices", matrix.indices, **kwargs)
-    write_array(group, "indptr", matrix.indptr)
-    write_list(group, "barcodes", barcodes)
-    write_list(group, "features", features)
+    if executor is not None and kwargs.get("compression") == "gzip":
+        write_array_parallel(group, "data", matrix.data, executor, dtype=dtypes.get("data"), **kwargs)
+        write_array_parallel(group, "indices", matrix.indices, executor, dtype=dtypes.get("indices"), **kwargs)
+    else:
+        write_array(group, "data", matrix.data, dtype=dtypes.get("data"), **kwargs)
+        write_array(group, "indices", matrix.indices, dtype=dtypes.get("indices"), **kwargs)
+    write_array(group, "indptr", matrix.indptr, dtype=dtypes.get("indptr"))
+    write_list(group, "barcodes", barcodes, fixed_strings=fixed_strings)
+    write_list(group, "features", features, fixed_strings=fixed_strings)
     write_list(group, "shape", [matrix.shape[0], matrix.shape[1]])
     if feature_type:
-        write_list(group, "feature_type", feature_type)
+        write_list(group, "feature_type", feature_type, fixed_strings=fixed_strings)
 
-def write_array(f, key, value, **kwargs):
+def write_array(f, key, value, dtype: Optional[np.dtype]=None, fixed_strings: bool=False, **kwargs):
     if value.dtype.kind in {"U", "O"}:
-        # A` la anndata, will fail with compound dtypes
-        value = value.astype(h5py.special_dtype(vlen=str))
+        value = encode_strings(value, fixed=fixed_strings)
+    elif dtype is not None:
+        value = value.astype(dtype, copy=False)
     f.create_dataset(key, data=value, **kwargs)
 
 def write_list(f, key, value, **kwargs):
     write_array(f, key, np.array(value), **kwargs)
+
+def encode_strings(value: np.ndarray, fixed: bool=False) -> np.ndarray:
+    """
+    Storage form of a string array: variable-length UTF-8 a` la anndata, or
+    fixed-width ASCII bytes when `fixed` and every value is ASCII
+    """
+    if fixed and value.dtype.kind == "U":
+        try:
+            return value.astype("S")
+        except UnicodeEncodeError:
+            pass
+    # Will fail with compound dtypes
+    return value.astype(h5py.special_dtype(vlen=str))
+
+def encode_keys(values: Iterable[str]) -> np.ndarray:
+    """Strings as a numpy bytes array, ordered and compared byte-wise in C"""
+    values = np.asarray(values)
+    if values.dtype.kind == "S":
+        return values
+    values = values.astype("U")
+    try:
+        return values.astype("S")
+    except UnicodeEncodeError:
+        return np.char.encode(values, "utf-8")
+
+def build_lookup_index(values: Iterable[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Sorted keys of unique `values` and the position of each, see :func:`lookup_index`"""
+    keys = encode_keys(values)
+    order = np.argsort(keys, kind="stable")
+    return keys[order], order.astype("int32" if len(keys) < 2**31 else "int64")
+
+def lookup_index(sorted_keys: np.ndarray, order: np.ndarray, values: Iterable[str]) -> np.ndarray:
+    """Positions of `values` in an index built by :func:`build_lookup_index`, -1 if absent"""
+    keys = encode_keys(values)
+    if len(sorted_keys) == 0 or len(keys) == 0:
+        return np.full(len(keys), -1, dtype="int64")
+    pos = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return np.where(sorted_keys[pos] == keys, order[pos], -1).astype("int64")
+
+def write_lookup_index(f, key: str, values: List[str]) -> None:
+    """Persist the sorted index of `values` under `index/<key>`, replacing any previous one"""
+    sorted_keys, order = build_lookup_index(values)
+    index = f.require_group("index")
+    if key in index:
+        del index[key]
+    group = index.create_group(key)
+    group.create_dataset("keys", data=sorted_keys)
+    group.create_dataset("order", data=order)
+
+def decode_strings(value: np.ndarray) -> np.ndarray:
+    """
+    Decode strings read from HDF5, fixed-width or variable-length, to a numpy
+    unicode array. ASCII is converted by numpy at once, other UTF-8 one by one
+    """
+    if value.dtype.kind == "U":
+        return value
+    if value.dtype.kind == "O":
+        if len(value) > 0 and isinstance(value[0], str):
+            return value.astype("U")
+        value = value.astype("S")
+    try:
+        return value.astype("U")
+    except UnicodeDecodeError:
+        return np.char.decode(value, "utf-8")
@@ -0,0 +1,94 @@
+"""
+Per-cell scores of gene sets, e.g. the collections of a study's Gallery
+
+All sets are scored in one pass over the union of their genes (and control
+genes): each set is a row of a sparse weight matrix, multiplied with gene
+chunks read gene-wise from matrix.hdf5.
+"""
+from typing import List, Optional
+import numpy as np
+from scipy import sparse
+from walnut.expression import Expression, CHUNK_SIZE
+from walnut import constants
+
+def bin_genes(means: np.ndarray, n_bins: int=25) -> np.ndarray:
+    """Bins of about the same number of genes by increasing mean expression"""
+    ranks = np.argsort(np.argsort(means, kind="stable"), kind="stable")
+    return ranks * n_bins // max(len(means), 1)
+
+def control_genes(bins: np.ndarray, members: np.ndarray, ctrl_size: int=50,
+                  rng: Optional[np.random.Generator]=None) -> np.ndarray:
+    """
+    Positions of control genes of a set, as Seurat's AddModuleScore: `ctrl_size`
+    genes drawn in each expression bin of the members, members excluded
+    """
+    rng = np.random.default_rng(0) if rng is None else rng
+    control = []
+    for b in np.unique(bins[members]):
+        candidates = np.flatnonzero(bins == b)
+        control.append(rng.choice(candidates, min(ctrl_size, len(candidates)), replace=False))
+    control = np.unique(np.concatenate(control)) if control else np.array([], dtype="int64")
+    return np.setdiff1d(control, members)
+
+def score_cells(expression: Expression, weights: sparse.csr_matrix, gene_ids: List[str],
+                unit: constants.UNIT_TYPE_LIST="norm", transform: constants.UNIT_TRANSFORM_LIST="log2",
+                chunk_size: int=CHUNK_SIZE) -> np.ndarray:
+    """
+    Weighted sums of genes per cell: `weights` is scores-by-genes over `gene_ids`.
+    Genes are streamed by chunks. Returns a cells-by-scores array
+    """
+    weights = sparse.csc_matrix(weights)
+    result = np.zeros((weights.shape[0], len(expression.barcodes)))
+    start = 0
+    for positions, block in expression.iter_gene_chunks(gene_ids, unit=unit, transform=transform,
+                                                        chunk_size=chunk_size):
+        end = start + len(positions)
+        result += (weights[:, start:end] @ block).toarray()
+        start = end
+    return result.T
+
+def score_gene_sets(expression: Expression, gene_sets: List[List[str]],
+                    method: constants.SCORE_METHOD_LIST="mean", unit: constants.UNIT_TYPE_LIST="norm",
+                    transform: constants.UNIT_TRANSFORM_LIST="log2", n_bins: int=25, ctrl_size: int=50,
+                    random_state: int=0, chunk_size: int=CHUNK_SIZE) -> np.ndarray:
+    """
+    Score cells for each set of gene IDs
+
+    "mean" is the average expression of the genes of the set. "module_score"
+    subtracts the average of control genes of similar expression, genes being
+    binned by their mean stored in matrix.hdf5 (see :func:`control_genes`).
+    Genes unknown to the study are ignored, sets without known genes score NaN.
+    Returns a cells-by-sets array
+    """
+    features = expression.features
+    members = []
+    for genes in gene_sets:
+        position = expression.lookup_features(genes).astype("int64")
+        members.append(np.unique(position[position >= 0]))
+
+    rows, cols, vals = [], [], []
+    def add(row: int, genes: np.ndarray, weight: float):
+        rows.extend([row] * len(genes))
+        cols.extend(genes.tolist())
+        vals.extend([weight] * len(genes))
+
+    if method == "module_score":
+        bins = bin_genes(expression.get_gene_stats(unit)["mean"].values, n_bins)
+        rng = np.random.default_rng(random_state)
+    elif method != "mean":
+        raise ValueError("Unknown scoring method: %s" % method)
+    for i, genes in enumerate(members):
+        if len(genes) == 0:
+            continue
+        add(i, genes, 1 / len(genes))
+        if method == "module_score":
+            control = control_genes(bins, genes, ctrl_size, rng)
+            if len(control) > 0:
+                add(i, control, -1 / len(control))
+
+    union, cols = np.unique(np.array(cols, dtype="int64"), return_inverse=True)
+    weights = sparse.csr_matrix((vals, (rows, cols)), shape=(len(gene_sets), len(union)))
+    scores = score_cells(expression, weights, [features[i] for i in union], unit=unit,
+                         transform=transform, chunk_size=chunk_size)
+    scores[:, [len(genes) == 0 for genes in members]] = np.nan
+    return scores
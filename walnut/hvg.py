@@ -0,0 +1,184 @@
+"""
+Highly variable genes, as Seurat v3 (variance of standardized raw counts) or
+Seurat's dispersion (normalized dispersion within bins of mean expression)
+
+Both only need per-gene means and variances per batch, accumulated over
+gene chunks or read from the gene statistics of matrix.hdf5. "seurat_v3"
+takes a second pass over raw counts for the sums of clipped values. Genes
+are ranked in each batch, then by the number of batches they are highly
+variable in.
+"""
+from typing import List, Optional, Tuple
+import numpy as np
+import pandas as pd
+from walnut.expression import Expression, CHUNK_SIZE
+from walnut.de import scan_expression
+from walnut import constants
+
+def loess(x: np.ndarray, y: np.ndarray, span: float=0.3, n_grid: int=200) -> np.ndarray:
+    """
+    Local quadratic regression of `y` on `x`, with tricube weights over the
+    `span` fraction of nearest points. Fitted on `n_grid` quantiles of `x`
+    and interpolated in between
+    """
+    n = len(x)
+    if n == 0:
+        return np.array([])
+    k = min(max(int(np.ceil(span * n)), 3), n)
+    grid = np.unique(np.quantile(x, np.linspace(0, 1, min(n_grid, n))))
+    fitted = np.empty(len(grid))
+    for i, x0 in enumerate(grid):
+        dist = np.abs(x - x0)
+        near = np.argpartition(dist, k - 1)[:k]
+        radius = dist[near].max()
+        weight = (1 - (dist[near] / radius) ** 3) ** 3 if radius > 0 else np.ones(k)
+        dx = x[near] - x0
+        root = np.sqrt(weight)
+        design = np.stack([root, root * dx, root * dx * dx], axis=1)
+        fitted[i] = np.linalg.lstsq(design, root * y[near], rcond=None)[0][0]
+    return np.interp(x, grid, fitted)
+
+def gene_moments(expression: Expression, labels: np.ndarray, gene_ids: Optional[List[str]]=None,
+                 unit: constants.UNIT_TYPE_LIST="raw", chunk_size: int=CHUNK_SIZE,
+                 n_jobs: int=1) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Genes-by-batches means and variances (ddof=1) of genes, cells being in the
+    batch of their label (negative labels leave them out), and cells per batch
+    """
+    stat = scan_expression(expression, labels, gene_ids, unit=unit, transform="none", ranks=False,
+                           chunk_size=chunk_size, n_jobs=n_jobs)
+    n_cells = stat["n_cells"]
+    mean = stat["sum"] / n_cells
+    var = (stat["sumsq"] - n_cells * mean * mean) / np.maximum(n_cells - 1, 1)
+    return mean, np.maximum(var, 0), n_cells
+
+def clipped_sums(expression: Expression, labels: np.ndarray, clip: np.ndarray,
+                 gene_ids: Optional[List[str]]=None,
+                 chunk_size: int=CHUNK_SIZE) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Genes-by-batches sums and sums of squares of raw counts, clipped at
+    `clip` (genes-by-batches). Zeros are never clipped, only non-zeros are read
+    """
+    total, total_sq = np.zeros(clip.shape), np.zeros(clip.shape)
+    n_batch = clip.shape[1]
+    start = 0
+    for positions, block in expression.iter_gene_chunks(gene_ids, unit="raw", chunk_size=chunk_size):
+        rows = np.repeat(np.arange(start, start + len(positions)), np.diff(block.indptr))
+        batch = labels[block.indices]
+        keep = batch >= 0
+        rows, batch = rows[keep], batch[keep]
+        values = np.minimum(block.data[keep].astype("float64"), clip[rows, batch])
+        bins = rows * n_batch + batch
+        size = clip.size
+        total += np.bincount(bins, weights=values, minlength=size).reshape(clip.shape)
+        total_sq += np.bincount(bins, weights=values * values, minlength=size).reshape(clip.shape)
+        start += len(positions)
+    return total, total_sq
+
+def standardized_variance(expression: Expression, labels: np.ndarray, mean: np.ndarray, var: np.ndarray,
+                          n_cells: np.ndarray, gene_ids: Optional[List[str]]=None, span: float=0.3,
+                          chunk_size: int=CHUNK_SIZE) -> np.ndarray:
+    """
+    Seurat v3 variances of raw counts standardized by the variance expected
+    from their mean (a loess of log variance on log mean), values being clipped
+    at sqrt(cells) standard deviations. Genes-by-batches, NaN for constant genes
+    """
+    expected = np.zeros(mean.shape)
+    for b in range(mean.shape[1]):
+        varying = var[:, b] > 0
+        fitted = loess(np.log10(mean[varying, b]), np.log10(var[varying, b]), span=span)
+        expected[varying, b] = 10 ** fitted
+    std = np.sqrt(expected)
+    clip = std * np.sqrt(n_cells) + mean
+    total, total_sq = clipped_sums(expression, labels, clip, gene_ids, chunk_size=chunk_size)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        norm_var = (n_cells * mean * mean + total_sq - 2 * total * mean) / ((n_cells - 1) * expected)
+    return np.where(expected > 0, norm_var, np.nan)
+
+def normalized_dispersion(mean: np.ndarray, var: np.ndarray, n_bins: int=20) -> np.ndarray:
+    """
+    Seurat's log dispersions (variance over mean) of normalized values, z-scored
+    within `n_bins` equal-width bins of log1p mean. Genes-by-batches, NaN for
+    constant genes; a bin of one gene scores 1
+    """
+    result = np.full(mean.shape, np.nan)
+    for b in range(mean.shape[1]):
+        m = np.where(mean[:, b] == 0, 1e-12, mean[:, b])
+        with np.errstate(divide="ignore"):
+            dispersion = np.log(var[:, b] / m)
+        dispersion[np.isinf(dispersion)] = np.nan
+        df = pd.DataFrame({"bin": pd.cut(np.log1p(m), bins=n_bins, labels=False), "dispersion": dispersion})
+        grouped = df.groupby("bin")["dispersion"]
+        bin_mean, bin_std = grouped.transform("mean").values, grouped.transform("std").values
+        alone = np.isnan(bin_std)
+        bin_std[alone], bin_mean[alone] = bin_mean[alone], 0
+        result[:, b] = (dispersion - bin_mean) / bin_std
+    return result
+
+def highly_variable_genes(expression: Expression, gene_ids: Optional[List[str]]=None, n_top: int=2000,
+                          flavor: constants.HVG_FLAVOR_LIST="seurat_v3", labels: Optional[np.ndarray]=None,
+                          span: float=0.3, n_bins: int=20, chunk_size: int=CHUNK_SIZE,
+                          n_jobs: int=1) -> pd.DataFrame:
+    """
+    Rank genes of `gene_ids` (all genes by default) by variability
+
+    `labels` holds the batch of each cell, negative labels leaving cells out.
+    Without it, means and variances are the gene statistics of matrix.hdf5.
+    "seurat_v3" reads raw counts, "dispersion" normalized values. Scores are
+    computed per batch and averaged. Genes are ranked by the number of batches
+    they are among the `n_top` of, then by median rank ("seurat_v3") or mean
+    score ("dispersion"). Returns a DataFrame indexed by gene ID with `means`,
+    `variances`, `score`, `n_batches` and `highly_variable`, best genes first
+    """
+    if flavor not in ("seurat_v3", "dispersion"):
+        raise ValueError("Unknown flavor: %s" % flavor)
+    unit = "raw" if flavor == "seurat_v3" else "norm"
+    gene_ids = expression.features if gene_ids is None else gene_ids
+
+    if labels is None:
+        stats = expression.get_gene_stats(unit).loc[gene_ids]
+        mean, var = stats[["mean"]].values.astype("float64"), stats[["var"]].values.astype("float64")
+        n_cells = np.array([len(expression.barcodes)])
+        labels = np.zeros(n_cells[0], dtype="int64")
+    else:
+        labels = np.asarray(labels, dtype="int64").copy()
+        keep = labels >= 0
+        labels[keep] = np.unique(labels[keep], return_inverse=True)[1] # Drop empty batches
+        mean, var, n_cells = gene_moments(expression, labels, gene_ids, unit=unit,
+                                          chunk_size=chunk_size, n_jobs=n_jobs)
+
+    if flavor == "seurat_v3":
+        score = standardized_variance(expression, labels, mean, var, n_cells, gene_ids, span=span,
+                                      chunk_size=chunk_size)
+    else:
+        score = normalized_dispersion(mean, var, n_bins=n_bins)
+
+    # Ranks of genes in each batch, NaN beyond the top ones
+    order = np.argsort(np.where(np.isnan(score), np.inf, -score), axis=0, kind="stable")
+    ranks = np.empty(score.shape)
+    np.put_along_axis(ranks, order, np.arange(len(score), dtype="float64")[:, None], axis=0)
+    ranks[(ranks >= n_top) | np.isnan(score)] = np.nan
+    top = ~np.isnan(ranks)
+    n_batches = top.sum(axis=1)
+    median_rank = np.full(len(score), np.inf)
+    for i in np.flatnonzero(n_batches):
+        median_rank[i] = np.median(ranks[i, top[i]])
+    scored = ~np.isnan(score)
+    with np.errstate(invalid="ignore"):
+        mean_score = np.where(scored, score, 0).sum(axis=1) / scored.sum(axis=1)
+
+    n_total = n_cells.sum()
+    overall_mean = mean @ n_cells / n_total
+    sumsq = (var * np.maximum(n_cells - 1, 0) + n_cells * mean * mean).sum(axis=1)
+    overall_var = np.maximum(sumsq - n_total * overall_mean ** 2, 0) / max(n_total - 1, 1)
+
+    tie_break = median_rank if flavor == "seurat_v3" else -np.nan_to_num(mean_score, nan=-np.inf)
+    order = np.lexsort((-np.nan_to_num(mean_score, nan=-np.inf), tie_break, -n_batches))
+    df = pd.DataFrame({
+        "means": overall_mean,
+        "variances": overall_var,
+        "score": mean_score,
+        "n_batches": n_batches,
+    }, index=pd.Index(gene_ids)).iloc[order]
+    df["highly_variable"] = np.arange(len(df)) < n_top
+    return df
@@ -66,6 +66,10 @@ class Metadata:
     def length(self):
         return len(self.__metalist.get_category_ids())
 
+    @property
+    def ids(self) -> List[str]:
+        return self.__metalist.get_category_ids()
+
     def __write_metalist(self) -> None:
         self.__get_metalist_io().write(self.__metalist)
 
@@ -152,6 +156,30 @@ class Metadata:
 
         return category_id
 
+    def add_cells(self, n_new: int) -> None:
+        """
+        Grow every category by `n_new` cells appended to the study.
+        New cells are Unassigned in categorical metadata, missing in numeric ones
+        """
+        if self.length == 0:
+            return
+        for category_id in self.__metalist.get_category_ids():
+            content = self.__get_single_meta_content(category_id)
+            if content.type == constants.METADATA_TYPE_NUMERIC:
+                content.clusters.extend([None] * n_new)
+            else:
+                content.clusters.extend([0] * n_new) # Unassigned is always first
+                if len(content.clusterLength) > 0:
+                    content.clusterLength[0] += n_new
+            content.history.append(common.create_history(description="Add %d cells" % n_new))
+
+            self.__metalist.content[category_id] = CategoryMeta.parse_obj(CategoryMeta(**content.dict()))
+            self.__get_category_io(category_id).write(content)
+
+        self.__write_metalist()
+        if self.__n_cells is not None:
+            self.__n_cells += n_new
+
     def change_reader(self, reader: Reader) -> None:
         self.__file_reader = reader
 
@@ -217,6 +245,20 @@ class Metadata:
         return arr
 
 
+    def get_column(self, meta_id: str) -> Union[pandas.Categorical, numpy.ndarray]:
+        """
+        Same as :func:`Metadata.get` without building one label per cell:
+        categorical metadata come as a `pandas.Categorical` over the stored codes
+        """
+        clusters = self.__get_single_meta_content(meta_id).clusters
+        meta = self.__metalist.get_category_meta(meta_id)
+        if meta.type == constants.METADATA_TYPE_NUMERIC:
+            return numpy.array(clusters, dtype="float") # None -> np.nan
+        codes = numpy.array(clusters, dtype="int64")
+        if len(set(meta.clusterName)) != len(meta.clusterName): # Codes cannot be kept
+            return pandas.Categorical(numpy.array(meta.clusterName)[codes])
+        return pandas.Categorical.from_codes(codes, categories=meta.clusterName)
+
     def __read_categories(self) -> Dict[str, Category]:
         categories: Dict[str, Category] = {}
         for category_id in self.__metalist.get_category_ids():
@@ -45,3 +45,78 @@ class ExpressionData(BaseModel):
             raise ValueError("`barcodes` must be a list of unique values")
 
         return values
+
+class WriteProfile(BaseModel):
+    """
+    Storage layout of the sparse groups of matrix.hdf5
+
+    `chunk_size` is in entries, None lets walnut tune it from the number of
+    non-zeros and `access`: the groups sliced along that axis (`countsT` and
+    `normalizedT` for "gene", `bioturing` for "cell") get small chunks, the
+    others large ones. "lzf" is only readable through h5py.
+
+    `dtypes="compact"` stores integral counts as the smallest unsigned integer
+    type that fits, indices and indptr as int32 when possible and normalized
+    values as float32.
+
+    `layout="contiguous"` stores `data` and `indices` unchunked and unfiltered
+    so that readers can memory-map them. The streaming writer appends to
+    chunked `bioturing` datasets and rewrites them contiguous on close.
+
+    `store_norm=False` skips `normalizedT`, about half of the file. Readers
+    then normalize counts on the fly from `countsT` and `colsum/raw`, so only
+    use it for the default normalization (each cell scaled to a total of 1e4),
+    not for studies coming with their own normalized matrix.
+
+    `strings="fixed"` stores barcodes, features and feature types as
+    fixed-width ASCII, several times faster to read than variable-length
+    strings. Lists with non-ASCII characters stay variable-length.
+    """
+    compression: Optional[Literal["gzip", "lzf"]] = None
+    compression_opts: Optional[int] = None
+    shuffle: bool = False
+    chunk_size: Optional[int] = None
+    access: Literal["gene", "cell"] = "gene"
+    chunk_cache_nbytes: Optional[int] = None
+    chunk_cache_nslots: Optional[int] = None
+    dtypes: Literal["keep", "compact"] = "keep"
+    layout: Literal["chunked", "contiguous"] = "chunked"
+    store_norm: bool = True
+    strings: Literal["vlen", "fixed"] = "vlen"
+
+    @validator("layout")
+    def check_layout(cls, v, values):
+        if v == "contiguous" and (values.get("compression") or values.get("shuffle")):
+            raise ValueError("Contiguous datasets cannot be compressed")
+        return v
+
+    @validator("compression_opts")
+    def check_compression_opts(cls, v, values):
+        if v is not None and values.get("compression") != "gzip":
+            raise ValueError("`compression_opts` is only supported with gzip")
+        return v
+
+    def filter_kwargs(self) -> dict:
+        """Filter arguments of `h5py.Group.create_dataset`"""
+        kwargs: dict = {}
+        if self.compression:
+            kwargs["compression"] = self.compression
+        if self.compression_opts is not None:
+            kwargs["compression_opts"] = self.compression_opts
+        if self.shuffle:
+            kwargs["shuffle"] = True
+        return kwargs
+
+    def file_kwargs(self) -> dict:
+        """Chunk cache arguments of `h5py.File`"""
+        kwargs: dict = {}
+        if self.chunk_cache_nbytes is not None:
+            kwargs["rdcc_nbytes"] = self.chunk_cache_nbytes
+        if self.chunk_cache_nslots is not None:
+            kwargs["rdcc_nslots"] = self.chunk_cache_nslots
+        return kwargs
+
+LEGACY_PROFILE = WriteProfile(chunk_size=10000)
+FAST_PROFILE = WriteProfile(compression="lzf", shuffle=True)
+MMAP_PROFILE = WriteProfile(layout="contiguous")
+COMPACT_PROFILE = WriteProfile(compression="gzip", compression_opts=4, shuffle=True, dtypes="compact")
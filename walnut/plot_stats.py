@@ -0,0 +1,165 @@
+"""
+Per-group expression statistics of genes for dot plots and violin plots
+
+Statistics are persisted in an HDF5 file next to the study data, one group
+per (metadata, unit). Each group holds the genes computed so far, their
+statistics and when they were last used, and is tagged with the version
+of the metadata it was computed for.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+import os
+import time
+import h5py
+import numpy as np
+from scipy import sparse
+from walnut import constants
+
+QUANTILES = [0, 0.05, 0.25, 0.5, 0.75, 0.95, 1]
+STAT_NAMES = ["mean", "fraction_expressed"] + ["q%d" % round(q * 100) for q in QUANTILES]
+
+def group_stats(block: sparse.csr_matrix, labels: np.ndarray, n_group: int,
+                quantiles: List[float]=QUANTILES) -> np.ndarray:
+    """
+    Mean, fraction of expressing cells and quantiles of a genes-by-cells block
+    per group of cells, cells with negative labels being left out. Values are
+    assumed non-negative, zeros come first in each group.
+    Returns a genes-by-groups-by-statistics array, see `STAT_NAMES`
+    """
+    n_gene = block.shape[0]
+    rows = np.repeat(np.arange(n_gene), np.diff(block.indptr))
+    group = labels[block.indices]
+    keep = (group >= 0) & (block.data != 0)
+    values, rows, group = block.data[keep].astype("float64"), rows[keep], group[keep]
+
+    n_cells = np.bincount(labels[labels >= 0], minlength=n_group)
+    bins = rows * n_group + group
+    nnz = np.bincount(bins, minlength=n_gene * n_group)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.bincount(bins, weights=values, minlength=n_gene * n_group) / np.tile(n_cells, n_gene)
+        fraction = nnz / np.tile(n_cells, n_gene)
+
+    # Non-zeros sorted by (gene, group, value), each (gene, group) being one segment
+    values = np.r_[values[np.lexsort((values, bins))], 0]
+    starts = np.r_[0, np.cumsum(nnz)[:-1]]
+    size = np.tile(n_cells, n_gene)
+    zeros = size - nnz
+
+    def pick(i: np.ndarray) -> np.ndarray:
+        """i-th smallest value of each segment"""
+        return np.where(i < zeros, 0, values[np.clip(starts + i - zeros, 0, len(values) - 1)])
+
+    result = [mean, fraction]
+    for q in quantiles:
+        position = q * np.maximum(size - 1, 0)
+        lower, upper = np.floor(position).astype("int64"), np.ceil(position).astype("int64")
+        value = pick(lower) + (position - lower) * (pick(upper) - pick(lower))
+        result.append(np.where(size > 0, value, np.nan))
+    return np.stack(result, axis=-1).reshape(n_gene, n_group, len(result))
+
+class PlotStats:
+    """
+    Cache of :func:`group_stats` in an HDF5 file
+
+    Entries are keyed by metadata ID and unit. Each key is tagged with the
+    version of its metadata: storing another version drops it. At most
+    `max_genes` genes are kept per key, the least recently used go first.
+    Lookups only read the file, their use times are kept in memory and
+    written by the next :func:`PlotStats.put` of the key
+    """
+    def __init__(self, h5path: str, max_genes: int=2000):
+        self.path = h5path
+        self.max_genes = max_genes
+        self.__used: Dict[str, Dict[str, float]] = {} # Use times of genes found, per key
+
+    @staticmethod
+    def key(meta_id: str, unit: constants.UNIT_TYPE_LIST, transform: constants.UNIT_TRANSFORM_LIST) -> str:
+        return "%s/%s_%s" % (meta_id, unit, transform)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def __open(self) -> h5py.File:
+        if not self.exists(): # Space freed by rewritten entries is reused
+            return h5py.File(self.path, "w", fs_strategy="fsm", fs_persist=True)
+        return h5py.File(self.path, "a")
+
+    def get(self, key: str, version: str, genes: List[str]) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """
+        Cached statistics of `genes`. Returns whether each gene was found and
+        a genes-by-groups-by-statistics array of the found ones
+        """
+        found = np.zeros(len(genes), dtype=bool)
+        if not self.exists():
+            return found, None
+
+        with h5py.File(self.path, "r") as fopen:
+            if key not in fopen:
+                return found, None
+            group = fopen[key]
+            if group.attrs["version"] != version: # Metadata changed since, replaced on put
+                return found, None
+
+            cached = {gene: i for i, gene in enumerate(group["genes"].asstr()[:])}
+            rows = np.array([cached.get(gene, -1) for gene in genes], dtype="int64")
+            found = rows >= 0
+            if not found.any():
+                return found, None
+            uniq, inverse = np.unique(rows[found], return_inverse=True)
+            stats = group["stats"][uniq][inverse]
+        now = time.time()
+        self.__used.setdefault(key, {}).update((gene, now) for gene, hit in zip(genes, found) if hit)
+        return found, stats
+
+    def put(self, key: str, version: str, genes: List[str], stats: np.ndarray) -> None:
+        """Store statistics of `genes`, evicting least recently used genes beyond `max_genes`"""
+        with self.__open() as fopen:
+            if key in fopen and (fopen[key].attrs["version"] != version or
+                                 fopen[key]["stats"].shape[1:] != stats.shape[1:]):
+                del fopen[key]
+            if key in fopen:
+                group = fopen[key]
+                old_genes = group["genes"].asstr()[:].tolist()
+                known = set(old_genes)
+                new = [i for i, gene in enumerate(genes) if gene not in known]
+                all_genes = np.array(old_genes + [genes[i] for i in new], dtype=object)
+                all_stats = np.concatenate([group["stats"][:], stats[new]])
+                used = np.r_[group["used"][:], np.full(len(new), time.time())]
+                touched = self.__used.pop(key, {})
+                for i, gene in enumerate(old_genes):
+                    used[i] = max(used[i], touched.get(gene, 0))
+                del fopen[key]
+            else:
+                self.__used.pop(key, None)
+                all_genes, all_stats = np.array(genes, dtype=object), stats
+                used = np.full(len(genes), time.time())
+
+            if len(all_genes) > self.max_genes:
+                keep = np.sort(np.argsort(-used, kind="stable")[:self.max_genes])
+                all_genes, all_stats, used = all_genes[keep], all_stats[keep], used[keep]
+
+            group = fopen.create_group(key)
+            group.attrs["version"] = version
+            group.create_dataset("genes", data=all_genes, dtype=h5py.string_dtype())
+            group.create_dataset("stats", data=all_stats.astype("float32"))
+            group.create_dataset("used", data=used)
+
+    def evict(self, meta_id: Optional[str]=None) -> None:
+        """Drop statistics of a metadata, or all of them"""
+        self.__used = {} if meta_id is None else {key: used for key, used in self.__used.items()
+                                                  if not key.startswith(meta_id + "/")}
+        if not self.exists():
+            return
+        with h5py.File(self.path, "a") as fopen:
+            for name in list(fopen.keys()):
+                if meta_id is None or name == meta_id:
+                    del fopen[name]
+
+    def info(self) -> Dict[str, Any]:
+        """Number of genes held by each key"""
+        if not self.exists():
+            return {}
+        with h5py.File(self.path, "r") as fopen:
+            keys = []
+            fopen.visititems(lambda name, obj: keys.append(name) if isinstance(obj, h5py.Group)
+                             and "genes" in obj else None)
+            return {key: len(fopen[key]["genes"]) for key in keys}
@@ -22,6 +22,13 @@ class RunInfo():
             raise Exception("Run_info has not been written, failed to get n_cell")
         return self.__content.n_cell
 
+    def set_species(self, species: constants.SPECIES_LIST):
+        self.__content.species = species
+
+    def add_cells(self, n_new: int):
+        """Count cells appended to the study, see :func:`RunInfo.write`"""
+        self.__content.n_cell += n_new
+
     def read(self):
         if not self.exists():
             raise Exception("No run_info data to read")
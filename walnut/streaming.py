@@ -0,0 +1,75 @@
+"""
+Shared pieces of analyses streaming genes in chunks
+
+Ranks of sparse values are computed among implicit zeros without
+materializing them. Chunks of genes are spread over a pool of processes that
+open matrix.hdf5 themselves, so only gene positions and results cross processes.
+"""
+from typing import Any, Callable, Dict, List, Tuple
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+from walnut.expression import Expression
+
+def value_keys(values: np.ndarray) -> np.ndarray:
+    """Order-preserving uint32 image of `values`"""
+    if values.dtype == np.float16 or (values.dtype == np.float64 and
+                                      np.array_equal(values.astype("float32"), values)):
+        values = values.astype("float32")
+    if values.dtype == np.float32:
+        bits = values.view("uint32")
+        return np.where(bits >> 31, ~bits, bits | np.uint32(1 << 31))
+    if values.dtype.kind == "u" and values.dtype.itemsize <= 4:
+        return values.astype("uint32")
+    if values.dtype.kind == "i" and values.dtype.itemsize <= 4:
+        return (values.astype("int64") + (1 << 31)).astype("uint32")
+    return np.unique(values, return_inverse=True)[1].astype("uint32") # Dense ranks
+
+def average_ranks(key: np.ndarray, rows: np.ndarray, row_start: np.ndarray, n_neg: np.ndarray,
+                  n_zero: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Average ranks of non-zero values among all values of their row, `n_zero[row]`
+    implicit zeros included, sitting above the `n_neg[row]` negative values
+
+    `key` holds the sorted sort keys of the values, equal for ties and never across
+    rows, `rows` their row and `row_start[row]` where each row starts in `key`.
+    Returns the row, size and rank of each run of ties
+    """
+    if len(key) == 0:
+        return np.zeros(0, dtype="int64"), np.zeros(0, dtype="int64"), np.zeros(0)
+    first = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+    sizes = np.diff(np.r_[first, len(key)])
+    tie_row = rows[first]
+    position = first - row_start[tie_row] # Within the non-zeros of the row
+    tie_rank = position + (sizes + 1) / 2
+    tie_rank += np.where(position >= n_neg[tie_row], n_zero[tie_row], 0)
+    return tie_row, sizes, tie_rank
+
+def zero_rank(n_neg: np.ndarray, n_zero: np.ndarray) -> np.ndarray:
+    """Average rank shared by the zeros of each row, see :func:`average_ranks`"""
+    return n_neg + (n_zero + 1) / 2
+
+# State of pool workers, set once per process by `init_worker`
+_worker: Dict[str, Any] = {}
+
+def init_worker(path: str, mmap: bool, state: Dict[str, Any]) -> None:
+    _worker.update(state, expression=Expression(path, mmap=mmap, gene_cache=None))
+
+def run_in_worker(func: Callable[[np.ndarray, Dict[str, Any]], Any], positions: np.ndarray) -> Any:
+    return func(positions, _worker)
+
+def map_gene_chunks(func: Callable[[np.ndarray, Dict[str, Any]], Any], expression: Expression,
+                    chunks: List[np.ndarray], state: Dict[str, Any], n_jobs: int=1) -> List[Any]:
+    """
+    `func(positions, state)` over chunks of gene positions, `state["expression"]`
+    being the expression to read. With `n_jobs` > 1, chunks go to a pool of
+    processes, each holding `state` and its own :class:`Expression` of the study.
+    `func` has to be a module-level function
+    """
+    if n_jobs > 1 and len(chunks) > 1 and os.path.exists(expression.path):
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(chunks)), initializer=init_worker,
+                                 initargs=(expression.path, expression.mmap, state)) as executor:
+            return list(executor.map(partial(run_in_worker, func), chunks))
+    state = {**state, "expression": expression}
+    return [func(positions, state) for positions in chunks]
@@ -1,20 +1,26 @@
 import os
-from typing import List, Optional, Union
+from typing import List, Optional, Union, Iterable, Tuple, TYPE_CHECKING
 from walnut.readers import Reader
 from walnut.metadata import Metadata
 from walnut.dimred import Dimred
 from walnut.gallery import Gallery
 from walnut.expression import Expression
 from walnut.run_info import RunInfo
+from walnut.plot_stats import PlotStats, STAT_NAMES, group_stats
+from walnut.gene_sets import score_gene_sets
 from walnut.readers import TextReader
 from walnut.gene_db import StudyGeneDB
-from walnut.common import create_uuid
+from walnut.common import create_uuid, make_unique
+from walnut.models import WriteProfile, LEGACY_PROFILE
 from walnut import constants, graphcluster
 from scipy import sparse
 import numpy as np
 import pandas as pd
 import h5py
 
+if TYPE_CHECKING: # Imported on use, anndata is slow to import
+    import anndata
+
 class StudyStructure:
     def __init__(self, study_folder):
         self.path = study_folder
@@ -27,6 +33,7 @@ class StudyStructure:
         self.metadata = os.path.join(self.path, "main", "metadata")
         self.dimred = os.path.join(self.main_dir, "dimred")
         self.h5matrix = os.path.join(self.path, "main", "matrix.hdf5")
+        self.plot_stats = os.path.join(self.path, "main", "plot_stats.hdf5")
         self.h5pca = os.path.join(self.main_dir, "pca_result.hdf5")
         self.gene_db = os.path.join(self.main_dir, "gene")
         self.sub = os.path.join(self.path, "sub")
@@ -39,6 +46,7 @@ class Study:
         self.run_info = RunInfo(self.__location.run_info, reader)
         self.dimred = Dimred(self.__location.dimred, TextReader())
         self.gallery = Gallery(self.__location.main_dir, TextReader()) # Gallery is not encrypted
+        self.plot_stats = PlotStats(self.__location.plot_stats)
 
         # If the study exists, ensure gene_db is loaded so that other APIs
         # for genes can be converted correctly
@@ -78,7 +86,8 @@ class Study:
                               barcodes: List[str],
                               features: List[str],
                               norm_matrix: Union[sparse.csc_matrix, sparse.csr_matrix]=None,
-                              feature_type: List[str]=None):
+                              feature_type: List[str]=None,
+                              profile: WriteProfile=LEGACY_PROFILE):
 
         if self.exists():
           print("WARNING: This study already exists, cannot alter expression data")
@@ -102,8 +111,70 @@ class Study:
                                             features=gene_ids,
                                             norm_matrix=norm_matrix,
                                             feature_type=feature_type)
-        return self.expression.write()
+        return self.expression.write(profile=profile)
+
+    def write_expression_blocks(self, blocks: Iterable[Tuple],
+                                features: List[str],
+                                feature_type: List[str]=None,
+                                profile: WriteProfile=LEGACY_PROFILE) -> bool:
+        """
+        Same as :func:`Study.write_expression_data` for studies too big to fit in memory.
+        `blocks` yields `(raw_matrix, barcodes)` or `(raw_matrix, barcodes, norm_matrix)`
+        for consecutive groups of cells, matrices are genes-by-cells
+        """
+        if self.exists():
+          print("WARNING: This study already exists, cannot alter expression data")
+          return False
+
+        if self.gene_db.exists():
+          print("WARNING: Gene DB for this study already exists, prevent adding and writing new data")
+          return False
+
+        raw_features = features.copy()
+        self.gene_db.create(raw_features)
+
+        gene_ids = self.gene_db.convert(raw_features)
+        return self.expression.write_blocks(blocks, features=gene_ids, feature_type=feature_type,
+                                            profile=profile)
+
+    def append_cells(self, raw_matrix: Union[sparse.csc_matrix, sparse.csr_matrix],
+                     barcodes: List[str],
+                     features: List[str],
+                     norm_matrix: Union[sparse.csc_matrix, sparse.csr_matrix]=None) -> bool:
+        """
+        Add new cells, e.g. a new sample, to an existing study, see :func:`Expression.append_cells`
 
+        Rows of `raw_matrix` are matched to the genes of the study by `features`,
+        study genes missing from them get no counts, unknown ones are dropped.
+        Existing metadata label the new cells as Unassigned. Dimreds and
+        subclusters still describe the previous cells only
+        """
+        if not self.exists():
+            print("WARNING: This study has not been written yet, use `write_expression_data`")
+            return False
+
+        if not len(set(barcodes)) == len(barcodes):
+            print("WARNING: Please ensure `barcodes` contain no duplicates")
+            return False
+
+        gene_ids = self.gene_db.convert(features)
+        position = self.expression.lookup_features(gene_ids)
+        known = np.flatnonzero(position >= 0)
+        if len(known) < len(gene_ids):
+            print("WARNING: %d features are not in this study, they are dropped" % (len(gene_ids) - len(known)))
+
+        # Rows in the order of the study genes
+        n_gene, n_new = len(self.expression.features), len(barcodes)
+        select = sparse.csr_matrix((np.ones(len(known)), (position[known], known)), shape=(n_gene, len(gene_ids)))
+        raw = (select @ sparse.csr_matrix(raw_matrix)).astype(raw_matrix.dtype)
+        norm = None if norm_matrix is None else select @ sparse.csr_matrix(norm_matrix)
+        if not self.expression.append_cells(raw, barcodes, norm_matrix=norm):
+            return False
+
+        self.metadata.add_cells(n_new)
+        self.run_info.add_cells(n_new)
+        self.run_info.write()
+        return True
 
     def add_dimred(self, coords: np.ndarray, name: str, id: Optional[str]=None) -> str:
         """Add new dimred and return id of successfully added dimred"""
@@ -146,7 +217,13 @@ class Study:
         return meta_id
 
     def get_expression(self, subcluster_id="root", type: constants.UNIT_TYPE_LIST="raw") -> np.ndarray:
-        if type == "raw":
+        graph_cluster = graphcluster.GraphCluster(subcluster_id, self.__location.sub, reader=TextReader())
+        idx = graph_cluster.full_selected_array
+
+        if not isinstance(idx, slice):
+            # Only read the columns of selected cells
+            mtx = self.expression.get_cells(idx, unit=type)
+        elif type == "raw":
             mtx = self.expression.raw_matrix
         else:
             mtx = self.expression.norm_matrix
@@ -155,9 +232,407 @@ class Study:
             print("WARNING: No expression data found, returning empty array")
             return np.array([])
 
+        return mtx if not isinstance(idx, slice) else mtx[:, idx]
+
+    def aggregate_expression(self, meta_id: str, genes: Optional[List[str]]=None,
+                             stat: constants.AGGREGATE_STAT_LIST="mean",
+                             unit: constants.UNIT_TYPE_LIST="norm",
+                             transform: constants.UNIT_TRANSFORM_LIST="none",
+                             subcluster_id="root", n_jobs: int=1) -> pd.DataFrame:
+        """
+        Pseudobulk expression of the groups of a categorical metadata
+
+        Expression is summed, averaged or counted as expressing cells
+        ("fraction_expressed") per group, streaming gene chunks from matrix.hdf5,
+        see :func:`Expression.aggregate`. `genes` are names or IDs, all genes by
+        default. Returns a groups-by-genes DataFrame, groups without cells in the
+        (sub)cluster are left out
+        """
+        groups, categories = self.__get_group_codes(meta_id, subcluster_id)
+        result = self.expression.aggregate(groups, self.__to_gene_ids(genes), stat=stat, unit=unit,
+                                           transform=transform, n_jobs=n_jobs)
+        if result is None:
+            raise ValueError("No expression data found")
+
+        columns = self.expression.features if genes is None else genes
+        df = pd.DataFrame(result, index=pd.Index(categories[:result.shape[0]]), columns=columns)
+        present = np.bincount(groups[groups >= 0], minlength=result.shape[0]) > 0
+        return df[present]
+
+    def differential_expression(self, group_1: Union[str, List[str], np.ndarray],
+                                group_2: Union[str, List[str], np.ndarray, None]=None,
+                                meta_id: Optional[str]=None, genes: Optional[List[str]]=None,
+                                method: constants.DE_METHOD_LIST="wilcoxon",
+                                unit: constants.UNIT_TYPE_LIST="norm",
+                                transform: constants.UNIT_TRANSFORM_LIST="log2",
+                                subcluster_id="root", n_jobs: int=1) -> pd.DataFrame:
+        """
+        Differential expression of `group_1` against `group_2`, or against the
+        rest of the (sub)cluster
+
+        With `meta_id`, groups are labels (one or several) of a categorical
+        metadata, otherwise indices of cells. Genes are streamed in chunks over
+        `n_jobs` processes, see :func:`walnut.de.differential_expression`.
+        Returns a DataFrame indexed by gene ID, sorted by p-value
+        """
+        from walnut import de # Pulls scipy.stats, slow to import
+
+        graph_cluster = graphcluster.GraphCluster(subcluster_id, self.__location.sub, reader=TextReader())
+        selected = np.zeros(self.n_cell, dtype=bool)
+        selected[graph_cluster.full_selected_array] = True
+
+        if meta_id is not None:
+            column = self.metadata.get_column(meta_id)
+            if not isinstance(column, pd.Categorical):
+                raise ValueError("Metadata %s is not categorical" % meta_id)
+            labels = np.asarray(column.astype(object))
+            in_group = lambda group: np.isin(labels, [group] if isinstance(group, str) else list(group))
+        else:
+            def in_group(group):
+                mask = np.zeros(self.n_cell, dtype=bool)
+                mask[np.asarray(group, dtype="int64")] = True
+                return mask
+
+        mask_1 = in_group(group_1) & selected
+        mask_2 = (~mask_1 if group_2 is None else in_group(group_2)) & selected
+        if (mask_1 & mask_2).any():
+            raise ValueError("Groups of cells overlap")
+        codes = np.full(self.n_cell, -1, dtype="int64")
+        codes[mask_1], codes[mask_2] = 0, 1
+
+        df = de.differential_expression(self.expression, codes, self.__to_gene_ids(genes), method=method,
+                                        unit=unit, transform=transform, n_jobs=n_jobs)
+        df.insert(0, "name", self.gene_db.convert(df.index.tolist(), _from="gene_id", _to="name"))
+        return df.sort_values("p_value", kind="stable")
+
+    def rank_markers(self, meta_id: str, top_n: Optional[int]=20, genes: Optional[List[str]]=None,
+                     method: constants.DE_METHOD_LIST="wilcoxon",
+                     unit: constants.UNIT_TYPE_LIST="norm",
+                     transform: constants.UNIT_TRANSFORM_LIST="log2",
+                     subcluster_id="root", n_jobs: int=1) -> pd.DataFrame:
+        """
+        Markers of every group of a categorical metadata against the rest of the
+        (sub)cluster, in a single pass over the matrix, see :func:`walnut.de.rank_markers`.
+        Returns the `top_n` genes of each group by decreasing statistic, `group`
+        holding its label
+        """
+        from walnut import de # Pulls scipy.stats, slow to import
+
+        groups, categories = self.__get_group_codes(meta_id, subcluster_id)
+        df = de.rank_markers(self.expression, groups, self.__to_gene_ids(genes), top_n=top_n, method=method,
+                             unit=unit, transform=transform, n_jobs=n_jobs)
+        df["group"] = np.asarray(categories, dtype=object)[df["group"].values]
+        df.insert(2, "name", self.gene_db.convert(df["gene"].tolist(), _from="gene_id", _to="name"))
+        return df
+
+    def get_plot_stats(self, meta_id: str, genes: List[str]) -> pd.DataFrame:
+        """
+        Mean, fraction of expressing cells and quantiles of genes per group of a
+        categorical metadata, for dot plots and violin plots
+
+        Values are in the unit set for the omic of each gene (`unit_settings` of
+        run_info). They are kept in main/plot_stats.hdf5 until the metadata changes,
+        only genes missing from it are read. Returns a DataFrame indexed by
+        (gene, group), groups without cells being left out, with the columns
+        of `walnut.plot_stats.STAT_NAMES`
+        """
+        gene_ids = self.__to_gene_ids(genes)
+        groups, categories = self.__get_group_codes(meta_id)
+        version = self.__get_metadata_version(meta_id)
+        stats = np.empty((len(gene_ids), len(categories), len(STAT_NAMES)))
+        for unit, transform, idx in self.__group_by_unit(gene_ids):
+            key = self.plot_stats.key(meta_id, unit, transform)
+            ids = [gene_ids[i] for i in idx]
+            found, cached = self.plot_stats.get(key, version, ids)
+            if cached is not None:
+                stats[idx[found]] = cached
+            if not found.all():
+                missing = [gene for gene, hit in zip(ids, found) if not hit]
+                block = self.expression.get_genes(missing, unit=unit, transform=transform)
+                stats[idx[~found]] = group_stats(block, groups, len(categories))
+                self.plot_stats.put(key, version, missing, stats[idx[~found]])
+
+        present = np.bincount(groups[groups >= 0], minlength=len(categories)) > 0
+        index = pd.MultiIndex.from_product([gene_ids, categories[present]], names=["gene", "group"])
+        return pd.DataFrame(stats[:, present].reshape(-1, len(STAT_NAMES)), index=index, columns=STAT_NAMES)
+
+    def precompute_plot_stats(self, meta_ids: List[str], genes: Optional[List[str]]=None) -> None:
+        """
+        Fill the cache of :func:`Study.get_plot_stats` for popular metadata in one
+        pass over the matrix, for `genes` or all genes. The cache keeps at most
+        `plot_stats.max_genes` genes per metadata, so only that many are read:
+        those of highest mean count (gene statistics of matrix.hdf5)
+        """
+        gene_ids = self.expression.features if genes is None else self.__to_gene_ids(genes)
+        if len(gene_ids) > self.plot_stats.max_genes:
+            mean = self.expression.get_gene_stats("raw")["mean"].loc[gene_ids].values
+            top = np.sort(np.argsort(-mean, kind="stable")[:self.plot_stats.max_genes])
+            gene_ids = [gene_ids[i] for i in top]
+        codes = [self.__get_group_codes(meta_id) for meta_id in meta_ids]
+        versions = [self.__get_metadata_version(meta_id) for meta_id in meta_ids]
+        for unit, transform, idx in self.__group_by_unit(gene_ids):
+            ids = [gene_ids[i] for i in idx]
+            parts: List[List[np.ndarray]] = [[] for _ in meta_ids]
+            for _, block in self.expression.iter_gene_chunks(ids, unit=unit, transform=transform):
+                for part, (groups, categories) in zip(parts, codes):
+                    part.append(group_stats(block, groups, len(categories)))
+            for meta_id, version, part in zip(meta_ids, versions, parts):
+                self.plot_stats.put(self.plot_stats.key(meta_id, unit, transform), version, ids,
+                                    np.concatenate(part))
+
+    def score_gene_sets(self, col_ids: List[str], method: constants.SCORE_METHOD_LIST="mean",
+                        unit: constants.UNIT_TYPE_LIST="norm",
+                        transform: constants.UNIT_TRANSFORM_LIST="log2",
+                        add_metadata: bool=False, **kwargs) -> pd.DataFrame:
+        """
+        Per-cell scores of Gallery collections, all scored in one pass over the
+        union of their genes, see :func:`walnut.gene_sets.score_gene_sets`
+        (`kwargs`: n_bins, ctrl_size, random_state). With `add_metadata`, scores
+        are also added as numeric metadata named after the collections.
+        Returns a cells-by-collections DataFrame
+        """
+        if len(self.gallery.collections.__root__) == 0 and self.gallery.exists():
+            self.gallery.read()
+        gene_sets = [self.gallery.get(col_id) for col_id in col_ids]
+        scores = score_gene_sets(self.expression, gene_sets, method=method, unit=unit, transform=transform, **kwargs)
+
+        df = pd.DataFrame(scores, index=pd.Index(self.expression.barcodes), columns=col_ids)
+        if add_metadata:
+            names = {col.id: col.name for col in self.gallery.collections.__root__}
+            for col_id in col_ids:
+                if not df[col_id].isna().all():
+                    self.metadata.add_category(names[col_id], df[col_id].to_numpy(), type="numeric",
+                                               write_metalist=False)
+            self.metadata.write_all()
+        return df
+
+    def correlate_genes(self, genes: List[str], targets: Optional[List[str]]=None,
+                        method: constants.CORRELATION_METHOD_LIST="pearson",
+                        unit: constants.UNIT_TYPE_LIST="norm",
+                        transform: constants.UNIT_TRANSFORM_LIST="log2",
+                        subcluster_id="root", n_jobs: int=1) -> pd.DataFrame:
+        """
+        Correlations of `genes` with `targets` (the panel itself by default) across
+        the cells of the (sub)cluster, see :func:`walnut.coexpression.correlate`
+        """
+        from walnut import coexpression # Pulls scipy.stats, slow to import
+
+        targets = genes if targets is None else targets
+        corr = coexpression.correlate(self.expression, self.__to_gene_ids(genes), self.__to_gene_ids(targets),
+                                      method=method, cells=self.__get_cells(subcluster_id), unit=unit,
+                                      transform=transform, n_jobs=n_jobs)
+        return pd.DataFrame(corr, index=pd.Index(genes), columns=pd.Index(targets))
+
+    def top_correlated_genes(self, genes: List[str], top_k: int=20,
+                             method: constants.CORRELATION_METHOD_LIST="pearson",
+                             unit: constants.UNIT_TYPE_LIST="norm",
+                             transform: constants.UNIT_TRANSFORM_LIST="log2",
+                             subcluster_id="root", n_jobs: int=1) -> pd.DataFrame:
+        """
+        The `top_k` genes most correlated with each of `genes` across the cells of
+        the (sub)cluster, see :func:`walnut.coexpression.top_partners`
+        """
+        from walnut import coexpression # Pulls scipy.stats, slow to import
+
+        gene_ids = self.__to_gene_ids(genes)
+        df = coexpression.top_partners(self.expression, gene_ids, top_k=top_k, method=method,
+                                       cells=self.__get_cells(subcluster_id), unit=unit, transform=transform,
+                                       n_jobs=n_jobs)
+        df["query"] = df["query"].map(dict(zip(gene_ids, genes)))
+        df.insert(2, "name", self.gene_db.convert(df["gene"].tolist(), _from="gene_id", _to="name"))
+        return df
+
+    def highly_variable_genes(self, n_top: Optional[int]=None, flavor: constants.HVG_FLAVOR_LIST="seurat_v3",
+                              batch_meta_id: Optional[str]=None, subcluster_id="root",
+                              collection_name: Optional[str]=None, n_jobs: int=1, **kwargs) -> pd.DataFrame:
+        """
+        Highly variable RNA genes of the (sub)cluster, see
+        :func:`walnut.hvg.highly_variable_genes` (`kwargs`: span, n_bins).
+        `n_top` defaults to `ana_setting.filter.top` of run_info. Genes are
+        selected per batch of the categorical metadata `batch_meta_id`. With
+        `collection_name`, the `n_top` genes are saved as a Gallery collection.
+        Returns all genes ranked, with their names
+        """
+        from walnut import hvg # Pulls scipy.stats, slow to import
+
+        content = self.run_info.get_content()
+        n_top = content.ana_setting.filter.top if n_top is None else n_top
+        cells = self.__get_cells(subcluster_id)
+        labels = None
+        if batch_meta_id is not None:
+            labels, _ = self.__get_group_codes(batch_meta_id, subcluster_id)
+        elif cells is not None:
+            labels = np.full(self.n_cell, -1, dtype="int64")
+            labels[cells] = 0
+        elif content.n_batch > 1:
+            print("WARNING: This study has %d batches, pass `batch_meta_id` to select genes per batch"
+                  % content.n_batch)
+
+        gene_ids = [gene for gene, omic in zip(self.expression.features, self.expression.feature_type)
+                    if omic == "RNA"]
+        df = hvg.highly_variable_genes(self.expression, gene_ids, n_top=n_top, flavor=flavor, labels=labels,
+                                       n_jobs=n_jobs, **kwargs)
+        df.insert(0, "name", self.gene_db.convert(df.index.tolist(), _from="gene_id", _to="name"))
+        if collection_name is not None:
+            if len(self.gallery.collections.__root__) == 0 and self.gallery.exists():
+                self.gallery.read()
+            self.create_gene_collection(collection_name, df.index[df["highly_variable"]].tolist())
+        return df
+
+    def __get_cells(self, subcluster_id="root") -> Optional[np.ndarray]:
+        """Cells of a subcluster, None for all cells"""
+        graph_cluster = graphcluster.GraphCluster(subcluster_id, self.__location.sub, reader=TextReader())
+        idx = graph_cluster.full_selected_array
+        return None if isinstance(idx, slice) else np.asarray(idx)
+
+    def __get_metadata_version(self, meta_id: str) -> str:
+        history = self.metadata.get_content_by_id(meta_id).history
+        return "%d-%s" % (len(history), history[-1].hash_id if history else "")
+
+    def __group_by_unit(self, gene_ids: List[str]) -> List[Tuple[str, str, np.ndarray]]:
+        """Positions of genes per (unit, transform), as set for their omic in run_info"""
+        settings = self.run_info.get_content().unit_settings
+        position = self.expression.lookup_features(gene_ids)
+        if (position < 0).any():
+            raise ValueError("Genes not found in this study: %s" % ", ".join(np.array(gene_ids)[position < 0][:10]))
+        feature_type = np.array(self.expression.feature_type, dtype=object)[position]
+        units: dict = {}
+        for i, omic in enumerate(feature_type):
+            setting = getattr(settings, omic, settings.RNA)
+            units.setdefault((setting.type, setting.transform), []).append(i)
+        return [(unit, transform, np.array(idx)) for (unit, transform), idx in units.items()]
+
+    def __get_group_codes(self, meta_id: str, subcluster_id="root") -> Tuple[np.ndarray, pd.Index]:
+        """Category codes of a metadata per cell, -1 out of the (sub)cluster, and the categories"""
+        column = self.metadata.get_column(meta_id)
+        if not isinstance(column, pd.Categorical):
+            raise ValueError("Metadata %s is not categorical" % meta_id)
+
         graph_cluster = graphcluster.GraphCluster(subcluster_id, self.__location.sub, reader=TextReader())
         idx = graph_cluster.full_selected_array
-        return mtx[:, idx]
+        groups = np.full(len(column), -1, dtype="int64")
+        groups[idx] = column.codes[idx]
+        return groups, column.categories
+
+    def __to_gene_ids(self, genes: Optional[List[str]]) -> Optional[List[str]]:
+        if genes is not None and not self.gene_db.is_id(genes):
+            return self.gene_db.convert(genes)
+        return genes
+
+    def to_anndata(self, subcluster_id="root", backed: bool=False,
+                   unit: constants.UNIT_TYPE_LIST="raw") -> "anndata.AnnData":
+        """
+        Cells-by-genes AnnData of the study, or of a subcluster
+
+        `X` is the transpose of the stored genes-by-cells matrix and shares its
+        buffers. Metadata become `obs` columns, categorical ones over their stored
+        codes, and dimreds of the (sub)cluster become `obsm["X_<name>"]`.
+        With `backed`, `X` is memory-mapped from matrix.hdf5 instead of read,
+        for studies written with `walnut.models.MMAP_PROFILE`, other layouts
+        raise a ValueError. Cells of a subcluster are still copied out of the map
+        """
+        graph_cluster = graphcluster.GraphCluster(subcluster_id, self.__location.sub, reader=TextReader())
+        idx = graph_cluster.full_selected_array
+        expression = self.expression
+        if backed:
+            if not self.expression.is_mappable(unit):
+                raise ValueError("matrix.hdf5 cannot be memory-mapped, write the study with MMAP_PROFILE "
+                                 "or use backed=False")
+            expression = Expression(self.__location.h5matrix, mmap=True, gene_cache=None)
+
+        try:
+            if not isinstance(idx, slice):
+                mtx = expression.get_cells(idx, unit=unit)
+            elif unit == "raw":
+                mtx = expression.raw_matrix
+            else:
+                mtx = expression.norm_matrix
+            if mtx is None:
+                raise ValueError("No expression data found")
+            barcodes = np.array(expression.barcodes, dtype=object)[idx]
+            features = expression.features
+            feature_type = expression.feature_type
+        finally:
+            if backed: # Maps do not need the HDF5 handle
+                expression.close()
+
+        obs = pd.DataFrame(index=pd.Index(barcodes))
+        ids = self.metadata.ids
+        names = make_unique([self.metadata.get_content_by_id(meta_id).name for meta_id in ids])
+        for meta_id, name in zip(ids, names):
+            obs[name] = self.metadata.get_column(meta_id)[idx]
+
+        var = pd.DataFrame({"name": self.gene_db.convert(features, _from="gene_id", _to="name"),
+                            "feature_type": feature_type},
+                           index=pd.Index(features))
+
+        study_structure = StudyStructure(self.__location.path)
+        study_structure.set_root(subcluster_id)
+        dimred = self.dimred if subcluster_id == "root" else Dimred(study_structure.dimred, TextReader())
+        obsm = {}
+        keys = make_unique(["X_%s" % name for name in dimred.names])
+        for dimred_id, key in zip(dimred.ids, keys):
+            coords = getattr(dimred[dimred_id], "coords", None)
+            if coords is not None and len(coords) == len(barcodes):
+                obsm[key] = np.array(coords, dtype="float32")
+
+        import anndata
+        return anndata.AnnData(mtx.T, obs=obs, var=var, obsm=obsm)
+
+    @classmethod
+    def from_anndata(cls, study_folder: str, adata: Union[str, "anndata.AnnData"],
+                     species: constants.SPECIES_LIST, layer: Optional[str]=None,
+                     chunk_size: int=10000, profile: WriteProfile=LEGACY_PROFILE) -> "Study":
+        """
+        Create a study from an AnnData or an `.h5ad` file
+
+        `.h5ad` files are opened backed and their counts (`X`, or `layers[layer]`)
+        streamed `chunk_size` cells at a time, see :func:`Study.write_expression_blocks`.
+        `obs` columns become metadata, 2D and 3D `obsm` embeddings become dimreds
+        """
+        opened = isinstance(adata, str)
+        if opened:
+            import anndata
+            adata = anndata.read_h5ad(adata, backed="r")
+        try:
+            return cls.__import_anndata(study_folder, adata, species, layer, chunk_size, profile)
+        finally:
+            if opened:
+                adata.file.close()
+
+    @classmethod
+    def __import_anndata(cls, study_folder: str, adata: "anndata.AnnData", species: constants.SPECIES_LIST,
+                         layer: Optional[str], chunk_size: int, profile: WriteProfile) -> "Study":
+        study = cls(study_folder, species=species)
+        matrix = adata.X if layer is None else adata.layers[layer]
+        barcodes = adata.obs_names.tolist()
+
+        def blocks():
+            for start in range(0, adata.n_obs, chunk_size):
+                end = min(start + chunk_size, adata.n_obs)
+                yield sparse.csr_matrix(matrix[start:end]).T.tocsc(), barcodes[start:end]
+
+        if not study.write_expression_blocks(blocks(), features=adata.var_names.tolist(), profile=profile):
+            raise ValueError("Could not write expression data to %s" % study_folder)
+
+        study.run_info.set_species(species)
+        study.run_info.add_cells(adata.n_obs)
+        study.run_info.write()
+
+        for name, column in adata.obs.items():
+            if pd.api.types.is_numeric_dtype(column) and not pd.api.types.is_bool_dtype(column):
+                study.metadata.add_category(str(name), column.to_numpy(dtype="float"), type="numeric",
+                                            write_metalist=False)
+            else:
+                labels = column.astype(object).where(column.notna(), constants.UNASSIGNED).astype(str)
+                study.metadata.add_category(str(name), labels.tolist(), type="category", write_metalist=False)
+        study.metadata.write_all()
+
+        for key, coords in adata.obsm.items():
+            coords = np.asarray(coords)
+            if coords.ndim == 2 and coords.shape[1] in (2, 3):
+                study.add_dimred(coords, name=key[2:] if key.startswith("X_") else key)
+        return study
 
     def get_pca_result(self, subcluster_id="root", batch_correction: constants.BATCH_CORRECTION="none") -> np.ndarray:
         """